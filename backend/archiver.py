@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+from mongoengine import connect
+from shared.models import (
+    AnalysisResult,
+    CollectionData,
+    DataChannel,
+    Topic,
+)
+from shared import archive, storage
+from pymongo import UpdateOne
+import argparse
+import datetime
+import logging
+import time
+
+logging.getLogger().setLevel(logging.INFO)
+
+# --------------------------------------------------------------------------- #
+
+KIND_DATA    = "collection_data"
+KIND_RESULTS = "analysis_result"
+
+# --------------------------------------------------------------------------- #
+# Retention Policies                                                          #
+# --------------------------------------------------------------------------- #
+
+def retention_policies():
+    """
+    The retention in days of every channel that has one: its own
+    retention_days if set, else the longest of its topics'.
+    """
+    topics = {
+        topic['_id']: topic['retention_days'] for topic in
+        Topic.objects(retention_days__gt=0)
+                     .only('id', 'retention_days').as_pymongo()
+    }
+
+    channels = DataChannel.objects.only('id', 'retention_days', 'topics')
+
+    policies = {}
+    for channel in channels.as_pymongo():
+        days = channel.get('retention_days')
+        if not days:
+            days = max((topics[topic] for topic in channel.get('topics', [])
+                        if topic in topics), default=None)
+        if days:
+            policies[channel['_id']] = days
+    return policies
+
+# --------------------------------------------------------------------------- #
+# Archiver                                                                    #
+# --------------------------------------------------------------------------- #
+
+class Archiver:
+    """
+    Moves CollectionData older than its channel's retention policy, along
+    with the AnalysisResults produced from it, into compressed archive files
+    on local disk, leaving stubs in the database (see shared/archive.py).
+
+    Works in small batches with a pause after each, so it never holds the
+    database for long and collectors keep their ingest latency. Each batch
+    is written to its archive file before the records are stubbed, so an
+    interrupted run loses nothing and is picked up by the next.
+
+    Every run looks for unarchived records before each channel's cutoff, so
+    data stored later with older timestamps, such as bulk imports, is
+    archived too. The lookup uses the channel and timestamp index.
+    """
+    def __init__(self, batch_size=500, pause=1.0):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.results = AnalysisResult._get_collection()
+
+
+    def run(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        archived = 0
+
+        for channel_id, days in retention_policies().items():
+            cutoff = now - datetime.timedelta(days=days)
+            for collection in storage.data_collections():
+                archived += self.archive_channel(collection, channel_id,
+                                                 cutoff)
+
+        if archived:
+            logging.info(f"Archived {archived} records")
+        return archived
+
+
+    def archive_channel(self, collection, channel_id, cutoff):
+        query = dict(CollectionData.objects(channel=channel_id,
+                                            timestamp__lt=cutoff)._query)
+        query['archive.path'] = {'$exists': False}
+        archived = 0
+
+        while True:
+            batch = list(collection.find(query).sort('timestamp', 1)
+                                   .limit(self.batch_size))
+            if not batch:
+                return archived
+
+            self._archive_results([document['_id'] for document in batch])
+            self._archive(collection, KIND_DATA, batch)
+            archived += len(batch)
+
+            logging.info(f"Archived {archived} records from channel "
+                         f"{channel_id} older than {cutoff}")
+            time.sleep(self.pause)
+
+
+    def _archive_results(self, record_ids):
+        query = dict(AnalysisResult.objects(origin_data__in=record_ids)._query)
+        query['archive.path'] = {'$exists': False}
+        results = list(self.results.find(query))
+        if results:
+            self._archive(self.results, KIND_RESULTS, results)
+
+
+    def _archive(self, collection, kind, documents):
+        relative_path = archive.write_batch(kind, documents)
+        collection.bulk_write([
+            UpdateOne({'_id': document['_id'],
+                       'archive.path': {'$exists': False}},
+                      archive.stub_update(document, relative_path))
+            for document in documents
+        ], ordered=False)
+
+# --------------------------------------------------------------------------- #
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Archive collected data older than its retention policy")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=1.0,
+                        help="Seconds to wait between batches")
+    parser.add_argument('--interval', type=int, default=3600,
+                        help="Seconds between archiving runs")
+    parser.add_argument('--once', action='store_true',
+                        help="Run once and exit")
+    args = parser.parse_args()
+
+    connect(db="silvermoon", host="database")
+    archiver = Archiver(args.batch_size, args.pause)
+
+    while True:
+        try:
+            archiver.run()
+        except Exception as err:
+            if args.once:
+                raise
+            # Anything archived so far is kept, the next run carries on
+            logging.error(f"Archiving run failed, retrying in "
+                          f"{args.interval}s: {err}")
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+# --------------------------------------------------------------------------- #
+
+if __name__ == '__main__':
+    main()
+
+# --------------------------------------------------------------------------- #
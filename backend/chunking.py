@@ -0,0 +1,85 @@
+import re
+import tiktoken
+
+# --------------------------------------------------------------------------- #
+
+# Used for models tiktoken doesn't know about yet (gpt-4o family encoding)
+DEFAULT_ENCODING = "o200k_base"
+
+# Boundaries to split on, from most to least preferable. Text is only split on
+# a finer boundary when a piece is still too large after the coarser one.
+SEPARATORS = [
+    r"\n\s*\n",          # Paragraphs
+    r"\n",               # Lines
+    r"(?<=[.!?])\s+",    # Sentences
+    r"\s+",              # Words
+]
+
+# --------------------------------------------------------------------------- #
+
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+# --------------------------------------------------------------------------- #
+
+def count_tokens(text, model):
+    return len(get_encoding(model).encode(text))
+
+# --------------------------------------------------------------------------- #
+
+def split_text(text, max_tokens, model):
+    """
+    Split text into chunks of at most max_tokens tokens for the given model.
+    Chunks are packed as full as possible while preferring to break on
+    paragraph, then line, sentence and word boundaries. A single word that is
+    still over the limit is cut on token boundaries as a last resort.
+    """
+    if max_tokens < 1:
+        raise ValueError("max_tokens must be at least 1")
+
+    encoding = get_encoding(model)
+    return [chunk for chunk in _split(text, max_tokens, encoding, 0)
+            if chunk.strip()]
+
+# --------------------------------------------------------------------------- #
+
+def _split(text, max_tokens, encoding, level):
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return [text]
+
+    if level >= len(SEPARATORS):
+        return [encoding.decode(tokens[i:i + max_tokens])
+                for i in range(0, len(tokens), max_tokens)]
+
+    # Keep each separator attached to the piece before it so that joining the
+    # pieces back together reproduces the original text exactly
+    parts = re.split(f"({SEPARATORS[level]})", text)
+    pieces = ["".join(parts[i:i + 2]) for i in range(0, len(parts), 2)]
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        candidate = current + piece
+        if len(encoding.encode(candidate)) <= max_tokens:
+            current = candidate
+            continue
+
+        if current:
+            chunks.append(current)
+            current = ""
+
+        if len(encoding.encode(piece)) <= max_tokens:
+            current = piece
+        else:
+            chunks.extend(_split(piece, max_tokens, encoding, level + 1))
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+# --------------------------------------------------------------------------- #
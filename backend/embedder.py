@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+from worker import Worker, EVENT_NEW_DATA
+from shared.models import Analyser, CollectionData, uuid_forms
+from shared.similarity import Embedder, HashingEmbedder, normalise, store
+from shared import storage
+from openai import OpenAI
+import numpy as np
+import argparse
+import logging
+import threading
+import time
+
+logging.getLogger().setLevel(logging.INFO)
+
+# --------------------------------------------------------------------------- #
+
+# Minimum seconds between retraining the IVF index
+TRAIN_INTERVAL = 600
+
+# --------------------------------------------------------------------------- #
+# Embedders                                                                   #
+# --------------------------------------------------------------------------- #
+
+class OpenAIEmbedder(Embedder):
+    """
+    Embeddings from the OpenAI API. The models are multilingual, so messages
+    on the same subject are similar whatever language they are written in.
+    """
+    def __init__(self, api_key, model="text-embedding-3-small"):
+        self.ai = OpenAI(api_key=api_key)
+        self.model = model
+        self.name = f"openai-{model}"
+        self.dimensions = len(self.embed(["dimensions"])[0])
+
+
+    def embed(self, texts):
+        # The API rejects empty inputs
+        response = self.ai.embeddings.create(
+            model=self.model, input=[text or " " for text in texts])
+        return normalise(np.array([item.embedding for item in response.data],
+                                  dtype=np.float32))
+
+# --------------------------------------------------------------------------- #
+# Embedding Worker                                                            #
+# --------------------------------------------------------------------------- #
+
+class EmbeddingWorker(Worker):
+    """
+    Embeds the friendly text of new CollectionData into the similarity
+    store (see shared/similarity.py) as NEW_DATA events arrive, batching
+    records between idle periods so the embedder is called with many texts
+    at once. Retrains the store's IVF index as it grows, on a background
+    thread, so events keep being read and embedded while it trains.
+    """
+    def __init__(self):
+        super().__init__("Embedder")
+        self.db_entry = self._register_analyser()
+        self.register_config('embedder', 'hashing')
+        self.register_config('batch_size', 64)
+        self.register_config('openai_api_key', 'Your OpenAI API key, for the openai embedder.')
+        self.register_config('openai_model', 'text-embedding-3-small')
+        self.embedder = self._create_embedder()
+        self.batch_size = int(self.get_config('batch_size'))
+        self.last_trained = 0
+        self.training = None
+        store.create(self.embedder)
+
+
+    def _register_analyser(self):
+        existing = Analyser.objects(name=self.name).first()
+        if existing:
+            return existing
+        return Analyser(name=self.name).save()
+
+
+    def _create_embedder(self):
+        name = self.get_config('embedder')
+        if name == 'hashing':
+            return HashingEmbedder()
+        if name == 'openai':
+            return OpenAIEmbedder(self.get_config('openai_api_key'),
+                                  self.get_config('openai_model'))
+        raise ValueError(f"Unknown embedder '{name}'")
+
+
+    def embed(self, documents):
+        """
+        Embed raw CollectionData documents that have text and aren't in the
+        store yet. Returns the number embedded.
+        """
+        documents = [document for document in documents
+                     if document.get('friendly_text')]
+        embedded = store.contains([document['_id'] for document in documents])
+        documents = [document for document in documents
+                     if document['_id'] not in embedded]
+        if not documents:
+            return 0
+
+        vectors = self.embedder.embed([document['friendly_text']
+                                       for document in documents])
+        store.append([document['_id'] for document in documents], vectors)
+        self._start_training()
+
+        return len(documents)
+
+
+    def _start_training(self):
+        """
+        Retrain the IVF index in the background if it is due, one training
+        at a time. Rows appended meanwhile are searched by brute force until
+        the next training covers them.
+        """
+        if self.training is not None and self.training.is_alive():
+            return
+        if (time.time() - self.last_trained <= TRAIN_INTERVAL
+                or not store.needs_training()):
+            return
+
+        self.last_trained = time.time()
+        self.training = threading.Thread(target=self._train,
+                                         name="ivf-training", daemon=True)
+        self.training.start()
+
+
+    def _train(self):
+        try:
+            store.train()
+        except Exception:
+            self.on_error({'training': len(store)})
+
+
+    def flush(self, uuids):
+        if not uuids:
+            return
+        # New data is always written to the hot collection
+        documents = CollectionData.objects(
+            __raw__={'uuid': {'$in': uuid_forms(uuids)}}
+        ).only('id', 'friendly_text').as_pymongo()
+        try:
+            self.embed(list(documents))
+        except Exception:
+            self.on_error({'records': len(uuids)})
+
+
+    def start(self):
+        pending = []
+        for event in self.listen_for_events(timeout=1.0):
+            if event and event.name == EVENT_NEW_DATA:
+                pending.append(event.data['record_uuid'])
+                if len(pending) < self.batch_size:
+                    continue
+            self.flush(pending)
+            pending = []
+
+
+    def backfill(self):
+        """
+        Embed every stored record not already in the store, oldest
+        collection last.
+        """
+        count = 0
+        query = CollectionData.objects(friendly_text__nin=[None, ""])._query
+        for collection in storage.data_collections():
+            batch = []
+            for document in collection.find(query, {'friendly_text': 1}):
+                batch.append(document)
+                if len(batch) >= self.batch_size:
+                    count += self.embed(batch)
+                    batch = []
+            count += self.embed(batch)
+            logging.info(f"Embedded {count} records")
+
+        # Finish any background training, then cover everything embedded
+        if self.training is not None:
+            self.training.join()
+        if store.needs_training():
+            store.train()
+        return count
+
+# --------------------------------------------------------------------------- #
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Embed collected data for similarity search")
+    parser.add_argument('--backfill', action='store_true',
+                        help="Embed stored data not yet embedded, then exit")
+    args = parser.parse_args()
+
+    w = EmbeddingWorker()
+    if args.backfill:
+        w.backfill()
+    else:
+        w.start()
+
+# --------------------------------------------------------------------------- #
+
+if __name__ == '__main__':
+    main()
+
+# --------------------------------------------------------------------------- #
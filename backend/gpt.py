@@ -1,4 +1,7 @@
 from worker import AnalyserWorker
+from window import RecordWindow
+from chunking import count_tokens, split_text
+from concurrent.futures import ThreadPoolExecutor
 from jinja2 import Template
 from openai import OpenAI, OpenAIError
 import logging
@@ -17,6 +20,25 @@ their criteria is met. You must ALWAYS call "set_response" to provide your respo
 YOU MUST ALWAYS CALL debug_reasoning.
 """
 
+# Used to merge the partial results of a chunked analysis when the trigger
+# doesn't provide its own reduce_prompt
+REDUCE_PROMPT = """
+The following are partial responses to the same request, each produced from a
+different consecutive section of one long document. Merge them into a single
+response to the original request, as if the whole document had been analysed
+at once. Remove duplication and do not mention the sections.
+
+Original request:
+{{ prompt }}
+
+{% for result in results %}
+--- Partial response {{ loop.index }} of {{ results|length }} ---
+{{ result }}
+{% endfor %}
+"""
+
+DEFAULT_MODEL = "gpt-4o-mini"
+
 # --------------------------------------------------------------------------- #
 
 class GPTAnalyser(AnalyserWorker):
@@ -25,9 +47,14 @@ class GPTAnalyser(AnalyserWorker):
         super().__init__("GPTAnalyser")
         self.register_parameter('model', 'The GPT model to use (e.g. gpt3, gpt4o).')
         self.register_parameter('prompt', 'The prompt to be provided to the model.')
+        self.register_parameter('chunk_field', 'Optional payload field to split into chunks when it is too long for one prompt (e.g. message_text).')
+        self.register_parameter('chunk_tokens', 'Maximum tokens per chunk when chunk_field is set (default 3000).')
+        self.register_parameter('reduce_prompt', 'Optional prompt used to merge chunk results. Receives "results" and "prompt".')
         self.register_config('api_key', 'Your OpenAI API key.')
+        self.register_config('chunk_workers', 4)
+        self.register_config('max_chunks', 16)
+        self.register_config('request_timeout', 120)
         self.ai = OpenAI(api_key=self.get_config('api_key'))
-        self.title = None
         self.tools = [
             {
                "type": "function",
@@ -147,8 +174,9 @@ class GPTAnalyser(AnalyserWorker):
             logging.info("Sending API request..")
             completion = self.ai.chat.completions.create(
                 messages=messages,
-                model="gpt-4o-mini",
-                tools=tools
+                model=DEFAULT_MODEL,
+                tools=tools,
+                timeout=self.get_config('request_timeout')
             )
         except OpenAIError as err:
             logging.error(f"OpenAI API request failed! Error: {err}")
@@ -164,28 +192,189 @@ class GPTAnalyser(AnalyserWorker):
 
     # ----------------------------------------------------------------------- #
 
-    def _handle_function_calls(self, calls):
+    def _handle_function_calls(self, calls, outcome):
         if calls:
             for call in calls:
                 args = json.loads(call.function.arguments)
                 if call.function.name == 'set_response':
-                    self.response = args['response']
+                    outcome['response'] = args['response']
                 if call.function.name == 'set_title':
-                    self.title = args['title']
+                    outcome['title'] = args['title']
                 if call.function.name == 'discard_result':
                     logging.info(f"GPT is discarding because: {args['reason']}")
-                    self.save_flag = False
+                    outcome['save'] = False
                 if call.function.name == 'set_importance':
-                    self.importance = args['importance']
+                    outcome['importance'] = args['importance']
                 if call.function.name == 'debug_reasoning':
                     logging.info(f"GPT reasoning is: {args['reason']}")
 
     # ----------------------------------------------------------------------- #
 
+    def _analyse(self, prompt):
+        """
+        Run a single prompt through GPT and return the outcome of its function
+        calls along with the token usage, or None if the request failed.
+        Holds no state on the analyser, so may be called from several threads.
+        """
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
+
+        completion = self._create_completion(messages, self.tools)
+        if not completion:
+            return None
+
+        # These default options can be changed by GPT through function calls
+        outcome = {
+            'response': None,
+            'title': None,
+            'importance': 'normal',
+            'save': True,
+        }
+        self._handle_function_calls(completion.choices[0].message.tool_calls,
+                                    outcome)
+
+        outcome['usage'] = {
+            'completion_tokens': completion.usage.completion_tokens,
+            'prompt_tokens': completion.usage.prompt_tokens,
+            'total_tokens': completion.usage.total_tokens,
+            'model': completion.model,
+            'id': completion.id
+        }
+        return outcome
+
+    # ----------------------------------------------------------------------- #
+
+    def _analyse_chunks(self, template, payload, chunk_field, chunks):
+        """
+        Map step of a chunked analysis. Renders the prompt once per chunk, with
+        the chunk in place of the original field, and analyses them in
+        parallel. Returns the outcomes in chunk order.
+        """
+        def analyse_chunk(index):
+            chunk_payload = dict(payload)
+            chunk_payload[chunk_field] = chunks[index]
+            prompt = template.render(payload=chunk_payload,
+                                     chunk_index=index + 1,
+                                     chunk_count=len(chunks))
+            return self._analyse(prompt)
+
+        workers = max(1, int(self.get_config('chunk_workers') or 1))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(analyse_chunk, range(len(chunks))))
+
+    # ----------------------------------------------------------------------- #
+
+    def _get_chunks(self, trigger, payload):
+        """
+        Returns the field to chunk, the chunks to analyse and how many chunks
+        the field was split into, if the trigger has chunking enabled and the
+        field is over the token limit, otherwise (None, None, 0).
+        """
+        chunk_field = trigger['parameters'].get('chunk_field')
+        if not chunk_field:
+            return None, None, 0
+
+        text = payload.get(chunk_field)
+        if not isinstance(text, str):
+            return None, None, 0
+
+        chunk_tokens = int(trigger['parameters'].get('chunk_tokens') or 3000)
+        if count_tokens(text, DEFAULT_MODEL) <= chunk_tokens:
+            return None, None, 0
+
+        chunks = split_text(text, chunk_tokens, DEFAULT_MODEL)
+        chunks_total = len(chunks)
+
+        # Keep cost and wall time bounded on pathologically large inputs. The
+        # truncation is recorded in the result's usage metadata
+        max_chunks = int(self.get_config('max_chunks') or len(chunks))
+        if len(chunks) > max_chunks:
+            logging.warning(f"Payload split into {len(chunks)} chunks, only "
+                            f"analysing the first {max_chunks}")
+            chunks = chunks[:max_chunks]
+
+        return chunk_field, chunks, chunks_total
+
+    # ----------------------------------------------------------------------- #
+
+    def _total_usage(self, usage):
+        calls = usage['chunks'] + ([usage['reduce']] if 'reduce' in usage
+                                   else [])
+        for key in ['completion_tokens', 'prompt_tokens', 'total_tokens']:
+            usage[key] = sum(call[key] for call in calls)
+        usage['model'] = calls[-1]['model']
+        return usage
+
+    # ----------------------------------------------------------------------- #
+
+    def _process_chunked(self, template, trigger, payload, chunk_field, chunks,
+                         chunks_total):
+        """
+        Map-reduce analysis of a payload too long for a single prompt. Returns
+        a merged outcome in the same form as _analyse(), with usage recorded
+        per chunk and for the reduce step, or None if the analysis failed.
+        The usage also records whether only the first chunks were analysed.
+        """
+        logging.info(f"Analysing '{chunk_field}' in {len(chunks)} chunks")
+
+        outcomes = self._analyse_chunks(template, payload, chunk_field, chunks)
+        if not all(outcomes):
+            logging.error("One or more chunk API requests failed, terminating!")
+            return None
+
+        usage = {
+            'chunks': [outcome['usage'] for outcome in outcomes],
+            'chunk_field': chunk_field,
+            'chunks_total': chunks_total,
+            'chunks_analysed': len(chunks),
+            'truncated': len(chunks) < chunks_total,
+        }
+
+        kept = [outcome for outcome in outcomes
+                if outcome['save'] and outcome['response']]
+        if not kept:
+            logging.info("Every chunk was discarded, discarding result")
+            return {'response': None, 'title': None, 'importance': 'normal',
+                    'save': False, 'usage': self._total_usage(usage)}
+
+        # Reduce step - merge the partial responses into a single response
+        reduce_template = Template(trigger['parameters'].get('reduce_prompt')
+                                   or REDUCE_PROMPT)
+        # The original prompt is included without the long field, so the
+        # reduce step stays small however large the input was
+        request_payload = dict(payload)
+        request_payload[chunk_field] = "[Document analysed in sections]"
+        prompt = reduce_template.render(
+            payload=request_payload,
+            prompt=template.render(payload=request_payload),
+            results=[outcome['response'] for outcome in kept]
+        )
+
+        outcome = self._analyse(prompt)
+        if not outcome:
+            logging.error("Reduce API request failed, terminating!")
+            return None
+
+        usage['reduce'] = outcome['usage']
+        outcome['usage'] = self._total_usage(usage)
+
+        # Any chunk flagging high importance makes the whole result important
+        if any(chunk['importance'] == 'high' for chunk in kept):
+            outcome['importance'] = 'high'
+
+        return outcome
+
+    # ----------------------------------------------------------------------- #
+
     def start(self):
         for record, task, trigger in self.listen_for_tasks():
             try:
-                self.process_task(record, task, trigger)
+                if isinstance(record, RecordWindow):
+                    self.process_window(record, task, trigger)
+                else:
+                    self.process_task(record, task, trigger)
             except Exception as err:
                 logging.error("Unhandled exception occured in process_task()!")
                 logging.error(f"Details: {err}")
@@ -193,6 +382,68 @@ class GPTAnalyser(AnalyserWorker):
 
     # ----------------------------------------------------------------------- #
 
+    def _save_outcome(self, outcome, record, task, **kwargs):
+        if not outcome['save']:
+            return
+
+        payload = {
+            'result': outcome['response'],
+        }
+
+        # Defines how the result will appear in the UI, make dynamic in future
+        display = {
+            'result': 'markdown',
+        }
+
+        title = outcome['title'] or f"GPT Analysis - {task.name}"
+        logging.info(f"Saving result with title: '{title}'")
+
+        # Save some metadata to the database about the GPT calls
+        self.save_result(title,
+                         payload,
+                         record,
+                         task,
+                         importance=outcome['importance'],
+                         display=display,
+                         metadata=outcome['usage'],
+                         **kwargs)
+
+    # ----------------------------------------------------------------------- #
+
+    def process_window(self, window, task, trigger):
+        """
+        Analyse every record in a closed window with a single prompt. The
+        prompt can loop over the records with Jinja, e.g.:
+        {% for record in records %}{{ record.payload.message_text }}{% endfor %}
+        """
+        start_time = time.time()
+        logging.info(f"Window of {len(window)} records for task '{task.name}' "
+                     f"({window.start} - {window.end})")
+
+        if 'prompt' not in trigger['parameters']:
+            logging.error("Missing prompt in trigger params!")
+            return
+
+        records = window.records
+        if not records:
+            logging.error("Records in window no longer exist, skipping!")
+            return
+
+        template = Template(trigger['parameters']['prompt'])
+        prompt = template.render(records=records,
+                                 window_start=window.start,
+                                 window_end=window.end)
+
+        outcome = self._analyse(prompt)
+        if not outcome:
+            logging.error("Window API request failed, terminating!")
+            return
+
+        self._save_outcome(outcome, records[-1], task, origin_records=records)
+        logging.info(f"Window took {time.time() - start_time:.2f}s")
+
+    # ----------------------------------------------------------------------- #
+
     def process_task(self, record, task, trigger):
         start_time = time.time()
         logging.info("----------------------------------------------------")
@@ -204,61 +455,28 @@ class GPTAnalyser(AnalyserWorker):
         #logging.info(f"Trigger parameters: {trigger.parameters}")
         logging.info("")
 
-        # These default options can be changed by GPT through function calls
-        self.title = f"GPT Analysis - {task.name}"
-        self.importance = 'normal'
-        self.save_flag = True
-        self.response = None
-
         if 'parameters' not in trigger or 'prompt' not in trigger['parameters']:
             logging.error("Missing params in trigger OR prompt not in params!")
             return
 
         # Parse the prompt with Jinja to enable injection of data
         template = Template(trigger['parameters']['prompt'])
-        prompt = template.render(payload=record['payload'])
 
-        # Defines how the result will appear in the UI, make dynamic in future
-        display = {
-            'result': 'markdown',
-        }
-
-        # Add the prompt to the GPT conversation
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt},
-        ]
-
-        # Prompt 1 - Get textual response
-        completion = self._create_completion(messages, self.tools)
-        if not completion:
+        # Long payloads are analysed in chunks and merged, others in one go
+        chunk_field, chunks, chunks_total = self._get_chunks(trigger,
+                                                             record['payload'])
+        if chunks:
+            outcome = self._process_chunked(template, trigger,
+                                            record['payload'], chunk_field,
+                                            chunks, chunks_total)
+        else:
+            outcome = self._analyse(template.render(payload=record['payload']))
+
+        if not outcome:
             logging.error("Text API request failed, terminating!")
             return
 
-        # Process the function calls to get the response and other attributes
-        self._handle_function_calls(completion.choices[0].message.tool_calls)
-
-        payload = {
-            'result': self.response,
-        }
-
-        # Save some metadata to the database about the GPT calls
-        metadata = {
-            'completion_tokens': completion.usage.completion_tokens,
-            'prompt_tokens': completion.usage.prompt_tokens,
-            'total_tokens': completion.usage.total_tokens,
-            'model': completion.model,
-            'id': completion.id
-        }
-
-        if self.save_flag:
-            logging.info(f"Saving result with title: '{self.title}'")
-            self.save_result(self.title,
-                             payload,
-                             record,
-                             task,
-                             importance=self.importance,
-                             display=display)
+        self._save_outcome(outcome, record, task)
 
         end_time = time.time()
         logging.info("----------------------------------------------------")
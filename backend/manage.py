@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+from mongoengine import connect
+from shared.models import UUID_BINARY, UUID_STRING
+from shared import rollups, search, storage
+import argparse
+import logging
+import migrations
+import query_audit
+
+logging.getLogger().setLevel(logging.INFO)
+
+# --------------------------------------------------------------------------- #
+
+def dedupe_data(args):
+    migrations.dedupe_collection_data(args.batch_size)
+    migrations.repair_stats()
+
+# --------------------------------------------------------------------------- #
+
+def repair_stats(args):
+    migrations.repair_stats()
+
+# --------------------------------------------------------------------------- #
+
+def backfill_rollups(args):
+    count = rollups.backfill(args.batch_size)
+    logging.info(f"Backfilled {count} activity rollups")
+
+# --------------------------------------------------------------------------- #
+
+def split_stored_data(args):
+    migrations.split_stored_data(args.batch_size)
+
+# --------------------------------------------------------------------------- #
+
+def rollover_partitions(args):
+    storage.rollover(args.batch_size)
+
+# --------------------------------------------------------------------------- #
+
+def rebuild_search(args):
+    search.rebuild(args.batch_size)
+
+# --------------------------------------------------------------------------- #
+
+def convert_uuids(args):
+    migrations.convert_uuids(args.to, args.batch_size)
+
+# --------------------------------------------------------------------------- #
+
+def benchmark_uuids(args):
+    if args.database == "silvermoon":
+        raise SystemExit("The benchmark writes scratch collections, use a "
+                         "separate --database for benchmarking")
+    query_audit.benchmark_uuids(args.records, args.lookups)
+
+# --------------------------------------------------------------------------- #
+
+def ensure_indexes(args):
+    query_audit.ensure_indexes()
+
+# --------------------------------------------------------------------------- #
+
+def audit_queries(args):
+    if (args.seed or args.compare) and args.database == "silvermoon":
+        raise SystemExit("--seed and --compare modify the database, use a "
+                         "separate --database for benchmarking")
+
+    if args.seed:
+        query_audit.seed(args.seed, channels=args.channels)
+
+    if args.compare:
+        logging.info("Without indexes:")
+        query_audit.drop_indexes()
+        query_audit.audit(args.repeat)
+        query_audit.ensure_indexes()
+        logging.info("With indexes:")
+
+    if query_audit.audit(args.repeat):
+        raise SystemExit(1)
+
+# --------------------------------------------------------------------------- #
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Silvermoon maintenance and migration commands")
+    parser.add_argument('--database', default="silvermoon")
+    parser.add_argument('--host', default="database")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser(
+        'dedupe-data',
+        help="Remove duplicate collected data and apply natural keys")
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=dedupe_data)
+
+    command = commands.add_parser(
+        'repair-stats',
+        help="Recompute the stored channel and collector statistics")
+    command.set_defaults(func=repair_stats)
+
+    command = commands.add_parser(
+        'backfill-rollups',
+        help="Rebuild the activity rollups from the stored data")
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=backfill_rollups)
+
+    command = commands.add_parser(
+        'split-stored-data',
+        help="Copy collected data and results out of the shared stored_data "
+             "collection, to move to the split or partitioned layout")
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=split_stored_data)
+
+    command = commands.add_parser(
+        'rollover-partitions',
+        help="Move collected data older than STORAGE_HOT_MONTHS into monthly "
+             "partitions (partitioned layout only)")
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=rollover_partitions)
+
+    command = commands.add_parser(
+        'rebuild-search',
+        help="Rebuild the full-text search index from the stored data")
+    command.add_argument('--batch-size', type=int, default=5000)
+    command.set_defaults(func=rebuild_search)
+
+    command = commands.add_parser(
+        'convert-uuids',
+        help="Rewrite stored UUIDs as binary or strings (set UUID_STORAGE "
+             "to match first)")
+    command.add_argument('--to', choices=[UUID_BINARY, UUID_STRING],
+                         default=UUID_BINARY)
+    command.add_argument('--batch-size', type=int, default=1000)
+    command.set_defaults(func=convert_uuids)
+
+    command = commands.add_parser(
+        'benchmark-uuids',
+        help="Compare the index size and lookup latency of string and "
+             "binary UUIDs")
+    command.add_argument('--records', type=int, default=1000000)
+    command.add_argument('--lookups', type=int, default=2000)
+    command.set_defaults(func=benchmark_uuids)
+
+    command = commands.add_parser(
+        'ensure-indexes',
+        help="Create the indexes declared on the models")
+    command.set_defaults(func=ensure_indexes)
+
+    command = commands.add_parser(
+        'audit-queries',
+        help="Explain and time every query pattern the app uses, exiting "
+             "non-zero if any does a collection scan")
+    command.add_argument('--seed', type=int, default=0, metavar='RECORDS',
+                         help="Seed an empty database with a synthetic "
+                              "dataset of this many records first")
+    command.add_argument('--channels', type=int, default=200)
+    command.add_argument('--compare', action='store_true',
+                         help="Audit without indexes first, then with them")
+    command.add_argument('--repeat', type=int, default=5)
+    command.set_defaults(func=audit_queries)
+
+    args = parser.parse_args()
+
+    connect(db=args.database, host=args.host)
+    args.func(args)
+
+# --------------------------------------------------------------------------- #
+
+if __name__ == '__main__':
+    main()
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,196 @@
+from shared import storage
+from telethon.tl.types import MessageMediaWebPage
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+
+# --------------------------------------------------------------------------- #
+
+MEDIA_STORED  = "stored"
+MEDIA_PENDING = "pending"
+MEDIA_SKIPPED = "skipped"
+MEDIA_FAILED  = "failed"
+
+# --------------------------------------------------------------------------- #
+
+class MediaStore:
+    """
+    Content-addressed file store on local disk. Files are named by the SHA-256
+    of their contents and fanned out into two levels of directories, e.g.
+    ab/cd/abcd1234....jpg, so the same file posted twice is only stored once.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+
+    @property
+    def tmp_dir(self):
+        return os.path.join(self.root, 'tmp')
+
+
+    def tmp_path(self):
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+
+    def relative_path(self, digest, extension):
+        return os.path.join(digest[:2], digest[2:4], digest + (extension or ''))
+
+
+    def store_file(self, tmp_path, extension):
+        """
+        Move a downloaded file into the store, returning its digest, path
+        relative to the store root, and whether it was already stored.
+        """
+        sha256 = hashlib.sha256()
+        with open(tmp_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+
+        relative_path = self.relative_path(digest, extension)
+        path = os.path.join(self.root, relative_path)
+        duplicate = os.path.exists(path)
+
+        if duplicate:
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+
+        return digest, relative_path, duplicate
+
+# --------------------------------------------------------------------------- #
+
+class MediaDownloader:
+    """
+    Downloads message media in the background so message handling never
+    waits on it. Downloads are queued on a bounded queue and processed by a
+    fixed number of worker tasks; media is skipped rather than queued when it
+    is over the size limit or the queue is full. Once stored, the media
+    reference is written to the record's payload.media.
+    """
+    def __init__(self, client, store, max_size, queue_size, workers):
+        self.client = client
+        self.store = store
+        self.max_size = max_size
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.worker_count = workers
+        self.workers = []
+
+
+    def start(self, loop):
+        self.workers = [task for task in self.workers if not task.done()]
+        while len(self.workers) < self.worker_count:
+            self.workers.append(loop.create_task(self._worker()))
+
+
+    def downloadable(self, message):
+        """
+        Whether a message has media to download. Link previews are part of
+        the message rather than a file, so aren't.
+        """
+        return (message.media is not None
+                and not isinstance(message.media, MessageMediaWebPage))
+
+
+    def describe(self, message):
+        """
+        The initial payload.media entry for a message, before downloading.
+        """
+        return {
+            'status': MEDIA_PENDING,
+            'type': type(message.media).__name__,
+            'mime_type': message.file.mime_type if message.file else None,
+            'size': message.file.size if message.file else None,
+        }
+
+
+    def submit(self, message, record):
+        """
+        Queue a message's media for download into the given CollectionData
+        record. Never blocks.
+        """
+        if self._too_large(message, record):
+            return False
+
+        try:
+            self.queue.put_nowait((message, record.uuid))
+        except asyncio.QueueFull:
+            logging.warning(f"Media queue full, skipping media for message "
+                            f"{message.id}")
+            self._set_status(record.uuid, MEDIA_SKIPPED, 'queue_full')
+            return False
+
+        return True
+
+
+    async def submit_wait(self, message, record):
+        """
+        Queue a message's media for download like submit, but wait for room
+        on the queue rather than skipping it, for backfills.
+        """
+        if self._too_large(message, record):
+            return False
+
+        await self.queue.put((message, record.uuid))
+        return True
+
+
+    def _too_large(self, message, record):
+        size = message.file.size if message.file else None
+        if size and self.max_size and size > self.max_size:
+            self._set_status(record.uuid, MEDIA_SKIPPED, 'too_large')
+            return True
+        return False
+
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            message, record_uuid = await self.queue.get()
+            try:
+                await self._download(loop, message, record_uuid)
+            except Exception as err:
+                logging.error(f"Media download failed for message "
+                              f"{message.id}: {err}")
+                self._set_status(record_uuid, MEDIA_FAILED, str(err))
+            finally:
+                self.queue.task_done()
+
+
+    async def _download(self, loop, message, record_uuid):
+        tmp_path = await self.client.download_media(message,
+                                                    file=self.store.tmp_path())
+        if not tmp_path:
+            self._set_status(record_uuid, MEDIA_FAILED, 'no_media')
+            return
+
+        extension = message.file.ext if message.file else None
+
+        # Hashing and moving large files is blocking, keep it off the loop
+        digest, relative_path, duplicate = await loop.run_in_executor(
+            None, self.store.store_file, tmp_path, extension)
+
+        media = self.describe(message)
+        media.update({
+            'status': MEDIA_STORED,
+            'sha256': digest,
+            'path': relative_path,
+        })
+        storage.update_data(record_uuid, set__payload__media=media)
+
+        logging.debug(f"Stored media {relative_path} for message {message.id}"
+                      f"{' (duplicate)' if duplicate else ''}")
+
+
+    def _set_status(self, record_uuid, status, reason):
+        storage.update_data(record_uuid, **{
+            'set__payload__media__status': status,
+            'set__payload__media__reason': reason,
+        })
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,290 @@
+from shared.models import (
+    Collector,
+    DataChannel,
+    CollectionData,
+    AnalysisResult,
+    AnalysisTask,
+    Topic,
+    WorkerBase,
+    WorkerError,
+    STORAGE_LAYOUT,
+    LAYOUT_SHARED,
+    UUID_BINARY,
+    stored_uuid,
+)
+from shared import storage
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from bson import ObjectId
+import datetime
+import logging
+
+# --------------------------------------------------------------------------- #
+# Natural Key Deduplication                                                   #
+# --------------------------------------------------------------------------- #
+
+def dedupe_collection_data(batch_size=1000):
+    """
+    Remove duplicate CollectionData left by collection before natural keys
+    existed, and set the natural key on the records that remain so they are
+    covered by the unique index. For each channel whose collector declares a
+    natural key field, records are grouped by that payload field as a
+    string, the form natural keys are stored in; the record already carrying
+    the key (else the oldest) is kept, and analysis results pointing at the
+    duplicates are repointed to it. Safe to re-run.
+    """
+    collection = CollectionData._get_collection()
+    results = AnalysisResult._get_collection()
+    removed = 0
+
+    for collector in Collector.objects():
+        default_field = collector.metadata.get('natural_key_field')
+
+        for channel in DataChannel.objects(collector=collector):
+            field = ((channel.metadata or {}).get('natural_key_field')
+                     or default_field)
+            if not field:
+                continue
+
+            match = dict(CollectionData.objects(channel=channel)._query)
+            match[f'payload.{field}'] = {'$ne': None}
+            # Grouped by the key as stored, which is the field as a string,
+            # so e.g. 123 and "123" are duplicates of each other
+            groups = collection.aggregate([
+                {'$match': match},
+                {'$sort': {'timestamp': 1, '_id': 1}},
+                {'$group': {
+                    '_id': {'$toString': f'$payload.{field}'},
+                    'records': {'$push': {'_id': '$_id',
+                                          'key': '$natural_key'}},
+                }},
+            ], allowDiskUse=True)
+
+            updates = []
+            for group in groups:
+                records = group['records']
+                keep = next((record for record in records if record.get('key')),
+                            records[0])
+                duplicates = [record['_id'] for record in records
+                              if record['_id'] != keep['_id']]
+
+                if duplicates:
+                    results.update_many(
+                        {'origin_data': {'$in': duplicates}},
+                        {'$set': {'origin_data': keep['_id']}})
+                    for duplicate in duplicates:
+                        results.update_many(
+                            {'origin_records': duplicate},
+                            {'$set': {'origin_records.$': keep['_id']}})
+                    collection.delete_many({'_id': {'$in': duplicates}})
+                    removed += len(duplicates)
+
+                if not keep.get('key'):
+                    updates.append(UpdateOne(
+                        {'_id': keep['_id']},
+                        {'$set': {'natural_key': group['_id']}}))
+                if len(updates) >= batch_size:
+                    collection.bulk_write(updates, ordered=False)
+                    updates = []
+
+            if updates:
+                collection.bulk_write(updates, ordered=False)
+
+            logging.info(f"Deduplicated channel '{channel.name}'")
+
+    logging.info(f"Removed {removed} duplicate records, creating indexes")
+    CollectionData.ensure_indexes()
+    return removed
+
+# --------------------------------------------------------------------------- #
+# Stored Statistics                                                           #
+# --------------------------------------------------------------------------- #
+
+def repair_stats():
+    """
+    Recompute the stored entry counts, latest entry times and channel counts
+    of every channel and collector from the data itself, in one aggregation
+    over CollectionData. Use after data is removed or imported outside the
+    collectors, or if the statistics are ever suspected to have drifted.
+    Data stored while this runs may be missed until it is run again.
+    """
+    pipeline = [
+        {'$match': CollectionData.objects()._query},
+        {'$group': {
+            '_id': '$channel',
+            'count': {'$sum': 1},
+            'latest': {'$max': '$timestamp'},
+        }},
+    ]
+
+    # Summed over the hot collection and any partitions
+    channel_stats = {}
+    for collection in storage.data_collections():
+        for stats in collection.aggregate(pipeline, allowDiskUse=True):
+            total = channel_stats.setdefault(stats['_id'],
+                                             {'count': 0, 'latest': None})
+            total['count'] += stats['count']
+            if stats['latest'] and (total['latest'] is None
+                                    or stats['latest'] > total['latest']):
+                total['latest'] = stats['latest']
+
+    collector_stats = {}
+    updates = []
+    for channel in DataChannel.objects.only('id', 'collector').as_pymongo():
+        stats = channel_stats.get(channel['_id'], {})
+        count = stats.get('count', 0)
+        latest = stats.get('latest')
+        updates.append(UpdateOne(
+            {'_id': channel['_id']},
+            {'$set': {'entry_count': count, 'latest_entry_time': latest}}))
+
+        collector = collector_stats.setdefault(
+            channel['collector'], {'count': 0, 'latest': None, 'channels': 0})
+        collector['channels'] += 1
+        collector['count'] += count
+        if latest and (collector['latest'] is None
+                       or latest > collector['latest']):
+            collector['latest'] = latest
+
+    if updates:
+        DataChannel._get_collection().bulk_write(updates, ordered=False)
+
+    updates = []
+    for collector in Collector.objects.only('id').as_pymongo():
+        stats = collector_stats.get(collector['_id'],
+                                    {'count': 0, 'latest': None,
+                                     'channels': 0})
+        updates.append(UpdateOne(
+            {'_id': collector['_id']},
+            {'$set': {'entry_count': stats['count'],
+                      'last_data': stats['latest'],
+                      'channel_count': stats['channels']}}))
+
+    if updates:
+        WorkerBase._get_collection().bulk_write(updates, ordered=False)
+
+    logging.info(f"Repaired statistics of {len(channel_stats)} channels with "
+                 f"data and {len(updates)} collectors")
+
+# --------------------------------------------------------------------------- #
+# Storage Layout                                                              #
+# --------------------------------------------------------------------------- #
+
+SHARED_COLLECTION = 'stored_data'
+
+SPLIT_COLLECTIONS = [
+    ('StoredData.CollectionData', 'collection_data'),
+    ('StoredData.AnalysisResult', 'analysis_result'),
+]
+
+# How far before the newest record already copied a re-run starts, to catch
+# records written with slightly older ObjectIds by other processes
+RESUME_MARGIN = datetime.timedelta(minutes=10)
+
+
+def split_stored_data(batch_size=1000):
+    """
+    Copy CollectionData and AnalysisResult out of the shared 'stored_data'
+    collection into their own collections, dropping _cls, to move from the
+    shared layout to the split or partitioned one without downtime:
+
+      1. Run with the shared layout still in use, copying everything so far.
+      2. Set STORAGE_LAYOUT and restart the workers and frontend.
+      3. Run again, under the new layout, to copy anything stored in between
+         and create the indexes.
+
+    Each run resumes shortly before the newest record already copied, and
+    records copied before are skipped, so it can be interrupted and re-run.
+    'stored_data' is left in place, to be dropped once the copy is verified.
+    """
+    db = CollectionData._get_db()
+    source = db[SHARED_COLLECTION]
+
+    for class_name, target_name in SPLIT_COLLECTIONS:
+        target = db[target_name]
+        query = {'_cls': class_name}
+
+        newest = target.find_one({}, sort=[('_id', -1)], projection={'_id': 1})
+        if newest:
+            resume = newest['_id'].generation_time - RESUME_MARGIN
+            query['_id'] = {'$gte': ObjectId.from_datetime(resume)}
+
+        copied = 0
+        batch = []
+        for document in source.find(query).sort('_id', 1):
+            document.pop('_cls', None)
+            batch.append(document)
+            if len(batch) >= batch_size:
+                copied += _copy_batch(target, batch)
+                batch = []
+                logging.info(f"Copied {copied} records to '{target_name}'")
+
+        if batch:
+            copied += _copy_batch(target, batch)
+
+        logging.info(f"Copied {copied} new records to '{target_name}'")
+
+    if STORAGE_LAYOUT != LAYOUT_SHARED:
+        CollectionData.ensure_indexes()
+        AnalysisResult.ensure_indexes()
+
+
+def _copy_batch(collection, documents):
+    try:
+        result = collection.insert_many(documents, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as err:
+        if any(error['code'] != 11000
+               for error in err.details['writeErrors']):
+            raise
+        return err.details['nInserted']
+
+# --------------------------------------------------------------------------- #
+# UUID Storage                                                                #
+# --------------------------------------------------------------------------- #
+
+def convert_uuids(to=UUID_BINARY, batch_size=1000):
+    """
+    Rewrite every stored UUID in the given form ('binary' or 'string'), to
+    move between them without downtime:
+
+      1. Set UUID_STORAGE to the new form, with UUID_DUAL_READ on (the
+         default), and restart the workers and frontend so new records are
+         written in it and lookups match either form.
+      2. Run this to convert the existing records, in batches.
+      3. Optionally turn UUID_DUAL_READ off.
+
+    Only records still in the old form are read, so it can be interrupted
+    and re-run. Returns the number of records converted.
+    """
+    old_type = 'string' if to == UUID_BINARY else 'binData'
+
+    collections = {}
+    for model in [WorkerBase, AnalysisResult, AnalysisTask, Topic,
+                  DataChannel, WorkerError]:
+        collection = model._get_collection()
+        collections[collection.name] = collection
+    for collection in storage.data_collections():
+        collections[collection.name] = collection
+
+    converted = 0
+    for name, collection in collections.items():
+        query = {'uuid': {'$type': old_type}}
+        operations = []
+        for document in collection.find(query, {'uuid': 1}).sort('_id', 1):
+            operations.append(UpdateOne(
+                {'_id': document['_id'], 'uuid': document['uuid']},
+                {'$set': {'uuid': stored_uuid(document['uuid'], to)}}))
+            if len(operations) >= batch_size:
+                converted += collection.bulk_write(
+                    operations, ordered=False).modified_count
+                operations = []
+                logging.info(f"Converted {converted} UUIDs")
+        if operations:
+            converted += collection.bulk_write(
+                operations, ordered=False).modified_count
+        logging.info(f"Converted the UUIDs in '{name}' to {to}")
+
+    return converted
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,350 @@
+from shared.models import (
+    ActivityRollup,
+    Collector,
+    Analyser,
+    DataChannel,
+    CollectionData,
+    AnalysisResult,
+    AnalysisTask,
+    AnalysisTaskTrigger,
+    Topic,
+    WorkerError,
+    WorkerBase,
+    UUID_BINARY,
+    UUID_STRING,
+    stored_uuid,
+    uuid_forms,
+)
+from shared import rollups
+from bson import ObjectId
+import migrations
+import datetime
+import logging
+import random
+import statistics
+import time
+import uuid
+
+# --------------------------------------------------------------------------- #
+
+MODELS = [
+    WorkerBase,
+    CollectionData,
+    AnalysisResult,
+    AnalysisTask,
+    Topic,
+    DataChannel,
+    WorkerError,
+    ActivityRollup,
+]
+
+# --------------------------------------------------------------------------- #
+# Query Patterns                                                              #
+# --------------------------------------------------------------------------- #
+
+def _sample(model):
+    return model.objects.order_by('-id').first()
+
+
+def _after(queryset, record):
+    """
+    The page of a queryset after a record, as paginate_keyset() reads it.
+    """
+    timestamp = record.timestamp if record else datetime.datetime.utcnow()
+    record_id = record.id if record else ObjectId()
+    return queryset.filter(__raw__={
+        'timestamp': {'$lte': timestamp},
+        '$or': [{'timestamp': {'$lt': timestamp}}, {'_id': {'$lt': record_id}}],
+    }).order_by('-timestamp', '-id').limit(21)
+
+
+def query_patterns():
+    """
+    The query patterns the frontend and workers run, as (name, queryset)
+    pairs, using values sampled from the database to fill in filters.
+    """
+    channel = _sample(DataChannel)
+    collector = _sample(Collector)
+    analyser = _sample(Analyser)
+    data = _sample(CollectionData)
+    result = _sample(AnalysisResult)
+    missing = ObjectId()
+
+    channel_id = channel.id if channel else missing
+    month_ago = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+
+    return [
+        ("Data list (/data)",
+         CollectionData.objects.order_by('-timestamp', '-id').limit(21)),
+        ("Data list, later page (/data?cursor=)",
+         _after(CollectionData.objects, data)),
+        ("Channel recent data (/channel)",
+         CollectionData.objects(channel=channel_id)
+                       .order_by('-timestamp').limit(10)),
+        ("Channel latest entry",
+         CollectionData.objects(channel=channel_id)
+                       .order_by('-timestamp').limit(1)),
+        ("Channel entry count",
+         CollectionData.objects(channel=channel_id)),
+        ("Channel stats (last 30 days)",
+         ActivityRollup.objects(scope=rollups.SCOPE_CHANNEL,
+                                scope_id=channel_id, granularity=rollups.DAY,
+                                bucket__gte=month_ago)),
+        ("Collector latest entry",
+         CollectionData.objects(channel__in=DataChannel.objects(
+                                    collector=collector.id if collector
+                                    else missing))
+                       .order_by('-timestamp').limit(1)),
+        ("Data by UUID",
+         CollectionData.objects(uuid=data.uuid if data else uuid.uuid4())),
+        ("Data by natural key",
+         CollectionData.objects(channel=channel_id, natural_key="1")),
+        ("Results list (/results)",
+         AnalysisResult.objects.order_by('-timestamp', '-id').limit(21)),
+        ("Results list, later page (/results?cursor=)",
+         _after(AnalysisResult.objects, result)),
+        ("Result by UUID",
+         AnalysisResult.objects(uuid=result.uuid if result else uuid.uuid4())),
+        ("Unread errors",
+         WorkerError.objects(read=False)),
+        ("Errors list (/errors)",
+         WorkerError.objects.order_by('-timestamp').limit(20)),
+        ("Channel by UID",
+         DataChannel.objects(uid=channel.uid if channel else "0")),
+        ("Channel by collector and UID",
+         DataChannel.objects(collector=collector.id if collector else missing,
+                             uid=channel.uid if channel else "0")),
+        ("Worker by name",
+         Collector.objects(name=collector.name if collector else "")),
+        ("Task trigger lookup",
+         AnalysisTask.objects(analyser=analyser.id if analyser else missing,
+                              triggers__events__in=['NEW_DATA'])),
+    ]
+
+# --------------------------------------------------------------------------- #
+# Explain                                                                     #
+# --------------------------------------------------------------------------- #
+
+def _stages(plan):
+    """
+    Flatten a query plan into the list of its stages, outermost first.
+    """
+    stages = [plan.get('stage')]
+    for key in ['inputStage', 'queryPlan']:
+        if key in plan:
+            stages += _stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += _stages(child)
+    return stages
+
+
+def explain(queryset):
+    explanation = queryset.explain()
+    plan = explanation['queryPlanner']['winningPlan']
+    stats = explanation.get('executionStats', {})
+    stages = _stages(plan)
+
+    return {
+        'stages': stages,
+        'collscan': 'COLLSCAN' in stages,
+        'examined': stats.get('totalDocsExamined'),
+        'returned': stats.get('nReturned'),
+    }
+
+
+def time_query(queryset, repeat=5):
+    """
+    Median wall time in milliseconds to fully read the query's results.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        list(queryset.clone().as_pymongo())
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def audit(repeat=5):
+    """
+    Explain and time every query pattern, logging a report and returning the
+    names of the patterns that do a collection scan.
+    """
+    collscans = []
+
+    for name, queryset in query_patterns():
+        report = explain(queryset)
+        millis = time_query(queryset, repeat)
+        flag = "COLLSCAN" if report['collscan'] else "ok"
+        logging.info(f"{flag:>8}  {millis:9.2f}ms  "
+                     f"examined={report['examined']} "
+                     f"returned={report['returned']}  {name}  "
+                     f"[{' <- '.join(report['stages'])}]")
+        if report['collscan']:
+            collscans.append(name)
+
+    if collscans:
+        logging.warning(f"{len(collscans)} query patterns do a collection "
+                        f"scan: {', '.join(collscans)}")
+    return collscans
+
+# --------------------------------------------------------------------------- #
+# Indexes                                                                     #
+# --------------------------------------------------------------------------- #
+
+def ensure_indexes():
+    for model in MODELS:
+        logging.info(f"Ensuring indexes for {model.__name__}")
+        model.ensure_indexes()
+
+
+def drop_indexes():
+    for model in MODELS:
+        model._get_collection().drop_indexes()
+
+# --------------------------------------------------------------------------- #
+# Synthetic Dataset                                                           #
+# --------------------------------------------------------------------------- #
+
+def _document(model, **fields):
+    if model._meta.get('allow_inheritance'):
+        fields['_cls'] = model._class_name
+    return fields
+
+
+def seed(records, channels=200, days=90, batch_size=10000):
+    """
+    Fill the (empty) database with a synthetic dataset of the given number of
+    CollectionData records spread over channels and days, plus one result
+    per ten records and some errors. Inserted directly through pymongo, in
+    the same document shape the models produce, so it is quick to build.
+    """
+    if CollectionData.objects.only('id').first():
+        raise ValueError("Refusing to seed a database that already has data")
+
+    collector = Collector(name="Benchmark").save()
+    analyser = Analyser(name="BenchmarkAnalyser").save()
+    topic = Topic(name=f"benchmark-{uuid.uuid4().hex[:8]}").save()
+    channel_ids = [
+        DataChannel(name=f"Channel {i}", uid=str(i), collector=collector,
+                    topics=[topic]).save().id
+        for i in range(channels)
+    ]
+    task = AnalysisTask(
+        name="Benchmark", analyser=analyser,
+        triggers=[AnalysisTaskTrigger(events=['NEW_DATA'], worker=collector)]
+    ).save()
+
+    now = datetime.datetime.utcnow()
+    span = days * 86400
+    data_collection = CollectionData._get_collection()
+    start_time = time.time()
+
+    for offset in range(0, records, batch_size):
+        data = []
+        results = []
+        for i in range(offset, min(offset + batch_size, records)):
+            record_id = ObjectId()
+            timestamp = now - datetime.timedelta(seconds=random.random() * span)
+            data.append(_document(CollectionData, **{
+                '_id': record_id,
+                'uuid': stored_uuid(uuid.uuid4()),
+                'timestamp': timestamp,
+                'channel': random.choice(channel_ids),
+                'natural_key': str(i),
+                'payload': {'id': i, 'message_text': f"Message {i} " * 20},
+                'friendly_text': f"Message {i} " * 20,
+            }))
+            if i % 10 == 0:
+                results.append(_document(AnalysisResult, **{
+                    'uuid': stored_uuid(uuid.uuid4()),
+                    'name': f"Result {i}",
+                    'timestamp': timestamp,
+                    'payload': {'result': f"Analysis of message {i} " * 50},
+                    'importance': 'normal',
+                    'hidden': False,
+                    'analyser': analyser.id,
+                    'task': task.id,
+                    'origin_data': record_id,
+                }))
+
+        data_collection.insert_many(data, ordered=False)
+        if results:
+            AnalysisResult._get_collection().insert_many(results,
+                                                         ordered=False)
+        logging.info(f"Seeded {offset + len(data)}/{records} records "
+                     f"({time.time() - start_time:.0f}s)")
+
+    errors = [
+        {
+            'uuid': stored_uuid(uuid.uuid4()),
+            'worker_name': "Benchmark",
+            'error_summary': "Synthetic error",
+            'error_type': "Exception",
+            'timestamp': now - datetime.timedelta(seconds=random.random() * span),
+            'read': i % 50 != 0,
+        }
+        for i in range(min(records // 100, 100000))
+    ]
+    if errors:
+        WorkerError._get_collection().insert_many(errors)
+
+    migrations.repair_stats()
+    rollups.backfill()
+
+# --------------------------------------------------------------------------- #
+# UUID Storage Benchmark                                                      #
+# --------------------------------------------------------------------------- #
+
+def benchmark_uuids(records, lookups=2000, batch_size=10000):
+    """
+    Compare string and binary UUID storage: fill a scratch collection per
+    form with the given number of records, each with a unique uuid index,
+    then report the average document size, the uuid index size and the
+    median lookup latency, both for plain lookups and for the dual-read
+    lookups used during a conversion. The collections are dropped after.
+    """
+    db = CollectionData._get_db()
+    keys = [uuid.uuid4() for _ in range(records)]
+    sample = random.sample(keys, min(lookups, records))
+    report = {}
+
+    for form in [UUID_STRING, UUID_BINARY]:
+        collection = db[f"uuid_benchmark_{form}"]
+        collection.drop()
+        for offset in range(0, records, batch_size):
+            collection.insert_many([
+                {'uuid': stored_uuid(key, form),
+                 'timestamp': datetime.datetime.utcnow()}
+                for key in keys[offset:offset + batch_size]
+            ], ordered=False)
+        collection.create_index('uuid', unique=True)
+
+        stats = db.command('collStats', collection.name)
+        timings = {'single': [], 'dual': []}
+        for key in sample:
+            start = time.perf_counter()
+            collection.find_one({'uuid': stored_uuid(key, form)})
+            timings['single'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            collection.find_one({'uuid': {'$in': uuid_forms([key])}})
+            timings['dual'].append(time.perf_counter() - start)
+
+        report[form] = {
+            'document_bytes': stats.get('avgObjSize'),
+            'index_bytes': stats['indexSizes']['uuid_1'],
+            'lookup_ms': statistics.median(timings['single']) * 1000,
+            'dual_lookup_ms': statistics.median(timings['dual']) * 1000,
+        }
+        logging.info(f"{form:>8}  document={report[form]['document_bytes']}B  "
+                     f"uuid index={report[form]['index_bytes'] / 1024:.0f}KiB  "
+                     f"lookup={report[form]['lookup_ms']:.3f}ms  "
+                     f"dual-read lookup={report[form]['dual_lookup_ms']:.3f}ms")
+        collection.drop()
+
+    saving = 1 - (report[UUID_BINARY]['index_bytes']
+                  / report[UUID_STRING]['index_bytes'])
+    logging.info(f"Binary UUIDs save {saving:.0%} of the uuid index over "
+                 f"{records} records")
+    return report
+
+# --------------------------------------------------------------------------- #
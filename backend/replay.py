@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+from worker import CollectorWorker
+import argparse
+import datetime
+import gzip
+import ijson
+import json
+import logging
+import time
+
+logging.getLogger().setLevel(logging.INFO)
+
+# --------------------------------------------------------------------------- #
+
+MODE_BULK   = "bulk"
+MODE_REPLAY = "replay"
+
+# --------------------------------------------------------------------------- #
+# File Readers                                                                #
+# --------------------------------------------------------------------------- #
+
+def open_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+# --------------------------------------------------------------------------- #
+
+def parse_timestamp(value):
+    """
+    Parse an ISO 8601 or epoch timestamp into a naive UTC datetime.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.utcfromtimestamp(value)
+
+    timestamp = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(datetime.timezone.utc)
+        timestamp = timestamp.replace(tzinfo=None)
+    return timestamp
+
+# --------------------------------------------------------------------------- #
+
+def read_ndjson(path):
+    """
+    Yield records from a newline-delimited JSON file, one object per line with
+    'channel_uid', 'payload' and optionally 'channel_name', 'friendly_text'
+    and 'timestamp' (ISO 8601, UTC). This is the format of the data export.
+    """
+    with open_file(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            yield {
+                'channel_uid': str(entry.get('channel_uid')
+                                   or entry['channel']),
+                'channel_name': entry.get('channel_name'),
+                'payload': entry['payload'],
+                'friendly_text': entry.get('friendly_text'),
+                'timestamp': parse_timestamp(entry.get('timestamp')),
+            }
+
+# --------------------------------------------------------------------------- #
+
+def flatten_telegram_text(text):
+    # Formatted messages are exported as a list of strings and entities
+    if isinstance(text, list):
+        return "".join(part if isinstance(part, str) else part.get('text', '')
+                       for part in text)
+    return text or ""
+
+# --------------------------------------------------------------------------- #
+
+def read_telegram_export(path):
+    """
+    Yield records from a Telegram Desktop chat export (result.json), in the
+    same payload format as the live TelegramCollector. The messages array is
+    parsed incrementally, so memory use doesn't grow with the export size.
+    """
+    # The chat's name and ID come before its messages, so stop reading there
+    name = uid = None
+    with open_file(path) as file:
+        for prefix, event, value in ijson.parse(file):
+            if prefix == 'name':
+                name = value
+            elif prefix == 'id':
+                uid = str(value)
+            elif prefix == 'messages':
+                break
+
+    if uid is None:
+        raise ValueError(f"'{path}' does not look like a Telegram chat export")
+
+    with open_file(path) as file:
+        for message in ijson.items(file, 'messages.item'):
+            if message.get('type') != 'message':
+                continue
+
+            text = flatten_telegram_text(message.get('text'))
+            if not text:
+                continue
+
+            unixtime = message.get('date_unixtime')
+            yield {
+                'channel_uid': uid,
+                'channel_name': name,
+                'payload': {
+                    'id': int(message['id']),
+                    'message_text': text,
+                },
+                'friendly_text': text,
+                'timestamp': (datetime.datetime.utcfromtimestamp(int(unixtime))
+                              if unixtime else
+                              parse_timestamp(message.get('date'))),
+            }
+
+# --------------------------------------------------------------------------- #
+
+def read_file(path, file_format='auto'):
+    if file_format == 'auto':
+        stripped = path[:-3] if path.endswith('.gz') else path
+        file_format = 'telegram' if stripped.endswith('.json') else 'ndjson'
+
+    if file_format == 'telegram':
+        return read_telegram_export(path)
+    return read_ndjson(path)
+
+# --------------------------------------------------------------------------- #
+# Replay Collector                                                            #
+# --------------------------------------------------------------------------- #
+
+class ReplayCollector(CollectorWorker):
+    """
+    Collects from files instead of a live source, for importing exports and
+    archives or generating realistic load. Records go through the normal
+    add_data path, raising NEW_DATA events, so analysers see them exactly as
+    they would live data.
+
+    In bulk mode records are stored as fast as possible in batches, keeping
+    their original timestamps. In replay mode they are stored one at a time
+    at their original pace (divided by speed), timestamped as they are
+    stored, as a live collector would.
+    """
+
+    # Message IDs are unique within a channel, so importing the same records
+    # twice doesn't store them twice. Natural keys are scoped to channels,
+    # and these are the replay collector's own, so records are not matched
+    # against those collected live
+    natural_key_field = 'id'
+
+    def __init__(self, name="Replay", channel_prefix=""):
+        super().__init__(name)
+        self.channel_prefix = channel_prefix
+        self.known_channels = set()
+
+    # ----------------------------------------------------------------------- #
+
+    def start(self, paths, file_format='auto', mode=MODE_BULK, speed=1.0,
+              batch_size=500):
+        """
+        Import or replay each file in turn. Returns the number of records
+        stored.
+        """
+        count = 0
+        for path in paths:
+            logging.info(f"Reading '{path}'")
+            count += self.import_records(read_file(path, file_format), mode,
+                                         speed, batch_size)
+        return count
+
+    # ----------------------------------------------------------------------- #
+
+    def _ensure_channel(self, record):
+        uid = self.channel_prefix + record['channel_uid']
+        if uid not in self.known_channels:
+            name = record.get('channel_name') or record['channel_uid']
+            self.add_channel(self.channel_prefix + name, uid)
+            self.known_channels.add(uid)
+        return uid
+
+    # ----------------------------------------------------------------------- #
+
+    def import_records(self, records, mode=MODE_BULK, speed=1.0,
+                       batch_size=500):
+        start_time = time.time()
+        if mode == MODE_REPLAY:
+            count = self._replay(records, speed)
+        else:
+            count = self._bulk_import(records, batch_size)
+
+        elapsed = time.time() - start_time
+        logging.info(f"Stored {count} records in {elapsed:.2f}s "
+                     f"({count / max(elapsed, 0.001):.0f}/s)")
+        return count
+
+    # ----------------------------------------------------------------------- #
+
+    def _bulk_import(self, records, batch_size):
+        count = 0
+        batch = []
+        batch_channel = None
+
+        for record in records:
+            uid = self._ensure_channel(record)
+            if batch and (uid != batch_channel or len(batch) >= batch_size):
+                count += len(self.add_data_bulk(batch_channel, batch))
+                batch = []
+
+            batch_channel = uid
+            batch.append(record)
+
+        if batch:
+            count += len(self.add_data_bulk(batch_channel, batch))
+
+        return count
+
+    # ----------------------------------------------------------------------- #
+
+    def _replay(self, records, speed):
+        count = 0
+        first_timestamp = None
+        start_time = time.time()
+
+        for record in records:
+            uid = self._ensure_channel(record)
+            timestamp = record.get('timestamp')
+
+            if timestamp and speed > 0:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                offset = (timestamp - first_timestamp).total_seconds() / speed
+                delay = start_time + offset - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if self.add_data(uid, record['payload'], record.get('friendly_text')):
+                count += 1
+
+        return count
+
+# --------------------------------------------------------------------------- #
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import or replay collected data from files")
+    parser.add_argument('files', nargs='+',
+                        help="Telegram export JSON or NDJSON files, "
+                             "optionally gzipped")
+    parser.add_argument('--format', choices=['auto', 'telegram', 'ndjson'],
+                        default='auto')
+    parser.add_argument('--mode', choices=[MODE_BULK, MODE_REPLAY],
+                        default=MODE_BULK)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed multiplier, 0 for no delays")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--name', default="Replay",
+                        help="Name of the collector to store data under")
+    parser.add_argument('--channel-prefix', default="",
+                        help="Prefix for channel UIDs and names, to keep "
+                             "load tests apart from real channels")
+    args = parser.parse_args()
+
+    collector = ReplayCollector(args.name, args.channel_prefix)
+    collector.start(args.files, args.format, args.mode, args.speed,
+                    args.batch_size)
+
+# --------------------------------------------------------------------------- #
+
+if __name__ == '__main__':
+    main()
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,99 @@
+import bisect
+import hashlib
+import time
+
+# --------------------------------------------------------------------------- #
+
+class HashRing:
+    """
+    Consistent hash ring. Each node is placed on the ring many times (virtual
+    nodes) so keys spread evenly, and when a node leaves only the keys it
+    owned move to other nodes.
+    """
+    def __init__(self, nodes, replicas=100):
+        self.ring = []
+        for node in nodes:
+            for replica in range(replicas):
+                self.ring.append((self._hash(f"{node}:{replica}"), node))
+        self.ring.sort()
+        self.points = [point for point, _ in self.ring]
+
+
+    def _hash(self, key):
+        return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+
+    def get(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.points, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+# --------------------------------------------------------------------------- #
+
+class ShardMembership:
+    """
+    Tracks which shards of a logical collector are alive. Each shard refreshes
+    a heartbeat key in Redis, which expires if the shard dies.
+    """
+    def __init__(self, redis, collector_name, shard_id, ttl=30):
+        self.redis = redis
+        self.prefix = f"shard:{collector_name}:"
+        self.shard_id = shard_id
+        self.ttl = ttl
+
+
+    def heartbeat(self):
+        self.redis.set(self.prefix + self.shard_id, int(time.time()),
+                       ex=self.ttl)
+
+
+    def leave(self):
+        self.redis.delete(self.prefix + self.shard_id)
+
+
+    def live_shards(self):
+        keys = self.redis.scan_iter(match=self.prefix + "*")
+        return sorted(key.decode()[len(self.prefix):] for key in keys)
+
+# --------------------------------------------------------------------------- #
+
+class ShardAssignment:
+    """
+    Decides which shard owns each channel. Channels in the explicit map go to
+    their mapped shard while it is alive; all others, and those whose mapped
+    shard is down, are spread over the live shards by consistent hashing.
+    """
+    def __init__(self, shard_id, explicit_map=None):
+        self.shard_id = shard_id
+        self.explicit_map = {str(uid): str(shard)
+                             for uid, shard in (explicit_map or {}).items()}
+        self.live = []
+        self.ring = HashRing([])
+
+
+    def update(self, live):
+        """
+        Rebuild the assignment for the given live shards. Returns True if the
+        set of live shards changed.
+        """
+        live = sorted(set(live) | {self.shard_id})
+        if live == self.live:
+            return False
+        self.live = live
+        self.ring = HashRing(live)
+        return True
+
+
+    def owner(self, channel_uid):
+        channel_uid = str(channel_uid)
+        mapped = self.explicit_map.get(channel_uid)
+        if mapped in self.live:
+            return mapped
+        return self.ring.get(channel_uid)
+
+
+    def owns(self, channel_uid):
+        return self.owner(channel_uid) == self.shard_id
+
+# --------------------------------------------------------------------------- #
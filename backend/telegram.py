@@ -1,34 +1,257 @@
 #!/usr/bin/env python3
 
 import telethon
+import argparse
+import asyncio
 import logging
+import multiprocessing
+import sys
 import time
 from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
 from telethon.tl.functions.channels import GetFullChannelRequest
 from worker import CollectorWorker, ConfigMissingException
+from shared.models import Collector, DataChannel
+from media import MediaStore, MediaDownloader
+from sharding import ShardAssignment, ShardMembership
 
-logging.getLogger().setLevel(logging.DEBUG)
+logging.getLogger().setLevel(logging.INFO)
+
+# --------------------------------------------------------------------------- #
+
+class ChatInfoCache:
+    """
+    TTL cache of the per-chat facts needed when handling a message: whether
+    the chat is a linked discussion group, its title and its type. Facts are
+    fetched once when a chat is first seen, then refreshed by a background
+    task as they expire, so handling a message normally needs no API calls.
+    Refreshes are spaced out and back off on FloodWait errors.
+    """
+
+    # Seconds between background refreshes of individual chats
+    REFRESH_DELAY = 2
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+        self.entries = {}
+        self.pending = []
+
+    # ----------------------------------------------------------------------- #
+
+    def get(self, chat_id):
+        """
+        Returns the cached facts for a chat, even if stale (the background
+        task will refresh them), or None if the chat has never been fetched.
+        """
+        return self.entries.get(chat_id)
+
+    # ----------------------------------------------------------------------- #
+
+    def prime(self, chat):
+        """
+        Queue a chat to be fetched by the background task ahead of its first
+        message, e.g. for every dialog found on startup.
+        """
+        if chat.id not in self.entries:
+            self.pending.append(chat)
+
+    # ----------------------------------------------------------------------- #
+
+    async def fetch(self, chat):
+        """
+        Fetch and cache the facts for a chat entity. On a FloodWait the chat
+        is cached as unlinked and left for the background task to retry,
+        rather than stalling message handling.
+        """
+        info = {
+            'title': getattr(chat, 'title', None),
+            'type': self._chat_type(chat),
+            'linked': False,
+            'fetched': time.time(),
+        }
+
+        try:
+            if isinstance(chat, telethon.tl.types.Channel):
+                full_channel = await self.client(GetFullChannelRequest(chat))
+                info['linked'] = bool(full_channel.full_chat.linked_chat_id)
+        except FloodWaitError as err:
+            logging.warning(f"FloodWait of {err.seconds}s fetching chat "
+                            f"{chat.id}, will retry in the background")
+            info['fetched'] = 0
+        except Exception as err:
+            logging.warning(f"Failed to fetch linked chat for {chat.id}: {err}")
+
+        self.entries[chat.id] = info
+        return info
+
+    # ----------------------------------------------------------------------- #
+
+    async def refresh_loop(self):
+        while True:
+            while self.pending:
+                chat = self.pending.pop(0)
+                if chat.id not in self.entries:
+                    await self.fetch(chat)
+                    await asyncio.sleep(self.REFRESH_DELAY)
+
+            expired = [chat_id for chat_id, info in self.entries.items()
+                       if time.time() - info['fetched'] > self.ttl]
+
+            for chat_id in expired:
+                try:
+                    chat = await self.client.get_entity(chat_id)
+                    await self.fetch(chat)
+                except FloodWaitError as err:
+                    logging.warning(f"FloodWait of {err.seconds}s refreshing "
+                                    f"chat cache, pausing refreshes")
+                    await asyncio.sleep(err.seconds)
+                except Exception as err:
+                    logging.warning(f"Failed to refresh chat {chat_id}: {err}")
+                    self.entries[chat_id]['fetched'] = time.time()
+                await asyncio.sleep(self.REFRESH_DELAY)
+
+            await asyncio.sleep(self.REFRESH_DELAY)
+
+    # ----------------------------------------------------------------------- #
+
+    def _chat_type(self, chat):
+        if isinstance(chat, telethon.tl.types.Channel):
+            return 'megagroup' if chat.megagroup else 'channel'
+        if isinstance(chat, telethon.tl.types.Chat):
+            return 'group'
+        return 'user'
 
 # --------------------------------------------------------------------------- #
 
 class TelegramCollector(CollectorWorker):
+    """
+    Collects messages from every Telegram channel the account has joined.
+
+    Can run sharded, with each shard a separate process using its own session
+    file (and optionally its own account) from the SHARDS config, e.g.:
+    [{"id": "a", "SESSION_PATH": "/data/a.session"},
+     {"id": "b", "SESSION_PATH": "/data/b.session", "API_ID": ..., ...}]
+    Each channel is owned by one live shard, from the SHARD_MAP config of
+    {channel_uid: shard_id} or else by consistent hashing, and other shards
+    ignore it. When a shard dies its channels move to the remaining shards,
+    which backfill them, so accounts should be joined to any channels they may
+    take over. All shards report as the same Collector.
+    """
 
-    def __init__(self):
+    # Telegram message IDs are unique within a channel
+    natural_key_field = 'id'
+
+    def __init__(self, shard_id=None):
         super().__init__("Telegram")
+        self.shard_id = shard_id
+        self.assignment = None
 
         try:
             self.API_ID = self.get_config('API_ID')
             self.API_HASH = self.get_config('API_HASH')
             self.SESSION_PATH = self.get_config('SESSION_PATH')
+            self.register_config('SHARDS', [])
+            self.register_config('SHARD_MAP', {})
+            self.register_config('SHARD_HEARTBEAT', 10)
+            self.register_config('CHANNEL_SYNC_INTERVAL', 600)
+            self.register_config('CHAT_CACHE_TTL', 3600)
+            self.register_config('BACKFILL_LIMIT', 100)
+            self.register_config('BACKFILL_CONCURRENCY', 4)
+            self.register_config('BACKFILL_BATCH_SIZE', 100)
+            self.register_config('MEDIA_PATH', '/data/media')
+            self.register_config('MEDIA_MAX_SIZE', 50 * 1024 * 1024)
+            self.register_config('MEDIA_QUEUE_SIZE', 100)
+            self.register_config('MEDIA_WORKERS', 2)
+
+            if shard_id is not None:
+                self._configure_shard(shard_id)
 
+            # process_message is registered by telegram_init, once the
+            # high-water marks have been snapshotted for the backfill
             self.client = TelegramClient(self.SESSION_PATH, self.API_ID,
                                          self.API_HASH)
-            self.client.on(events.NewMessage)(self.process_message)
+            self.first_live_ids = {}
+            self.chats = ChatInfoCache(self.client,
+                                       self.get_config('CHAT_CACHE_TTL'))
+            self.chat_refresh_task = None
+            self.backfill_task = None
+            self.shard_task = None
+            self.channel_sync_task = None
+            self.flood_wait_until = 0
+            self.media = MediaDownloader(
+                self.client,
+                MediaStore(self.get_config('MEDIA_PATH')),
+                int(self.get_config('MEDIA_MAX_SIZE') or 0),
+                int(self.get_config('MEDIA_QUEUE_SIZE') or 100),
+                int(self.get_config('MEDIA_WORKERS') or 1)
+            )
         except Exception as err:
             self.on_error()
        
     # ----------------------------------------------------------------------- #
 
+    def _configure_shard(self, shard_id):
+        shards = check_shards(self.get_config('SHARDS') or [])
+        if shard_id not in shards:
+            raise ValueError(f"Shard '{shard_id}' is not in the SHARDS config")
+
+        # Shards can override the account, else use the default one
+        shard = shards[shard_id]
+        self.API_ID = shard.get('API_ID', self.API_ID)
+        self.API_HASH = shard.get('API_HASH', self.API_HASH)
+        self.SESSION_PATH = shard['SESSION_PATH']
+
+        heartbeat = int(self.get_config('SHARD_HEARTBEAT') or 10)
+        self.membership = ShardMembership(self.redis, self.name, shard_id,
+                                          ttl=heartbeat * 3)
+        self.assignment = ShardAssignment(shard_id,
+                                          self.get_config('SHARD_MAP'))
+
+    # ----------------------------------------------------------------------- #
+
+    def owns(self, channel_uid):
+        return self.assignment is None or self.assignment.owns(channel_uid)
+
+    # ----------------------------------------------------------------------- #
+
+    def _update_shards(self):
+        """
+        Heartbeat and rebuild the channel assignment from the live shards.
+        Returns the channels this shard has newly taken over.
+        """
+        channels = list(DataChannel.objects(collector=self.db_entry))
+        owned_before = {channel.uid for channel in channels
+                        if self.owns(channel.uid)}
+
+        self.membership.heartbeat()
+        if not self.assignment.update(self.membership.live_shards()):
+            return []
+
+        logging.info(f"Shard '{self.shard_id}' sees live shards "
+                     f"{self.assignment.live}")
+        return [channel for channel in channels
+                if self.owns(channel.uid) and channel.uid not in owned_before]
+
+    # ----------------------------------------------------------------------- #
+
+    async def shard_loop(self):
+        heartbeat = int(self.get_config('SHARD_HEARTBEAT') or 10)
+
+        while True:
+            await asyncio.sleep(heartbeat)
+            try:
+                taken_over = self._update_shards()
+                if taken_over:
+                    # Fill the gap since the previous owner stopped collecting
+                    logging.info(f"Took over {len(taken_over)} channels")
+                    self.client.loop.create_task(self.backfill(
+                        taken_over, self._snapshot_marks(taken_over)))
+            except Exception as err:
+                self.on_error({'shard': self.shard_id})
+
+    # ----------------------------------------------------------------------- #
+
     def start(self):
         try:
             if not all([self.API_ID, self.API_HASH, self.SESSION_PATH]):
@@ -41,6 +264,7 @@ class TelegramCollector(CollectorWorker):
 
         while True:
             try:
+                self.client.remove_event_handler(self.process_message)
                 self.client.start()
                 self.client.loop.run_until_complete(self.telegram_init())
                 self.client.run_until_disconnected()
@@ -52,98 +276,399 @@ class TelegramCollector(CollectorWorker):
     # ----------------------------------------------------------------------- #
 
     async def telegram_init(self):
+        # Snapshot the high-water marks before live messages can move them,
+        # so the backfill covers the whole gap since collection stopped.
+        # Inactive channels are included, as syncing may reactivate them
+        marks = self._snapshot_marks(DataChannel.objects(
+            collector=self.db_entry))
+        self.first_live_ids = {}
+        self.client.add_event_handler(self.process_message, events.NewMessage)
+
+        await self.sync_dialogs()
+
+        if self.chat_refresh_task is None or self.chat_refresh_task.done():
+            self.chat_refresh_task = self.client.loop.create_task(
+                self.chats.refresh_loop())
+
+        self.media.start(self.client.loop)
+
+        if self.assignment is not None:
+            self._update_shards()
+            if self.shard_task is None or self.shard_task.done():
+                self.shard_task = self.client.loop.create_task(
+                    self.shard_loop())
+
+        if self.channel_sync_task is None or self.channel_sync_task.done():
+            self.channel_sync_task = self.client.loop.create_task(
+                self.channel_sync_loop())
+
+        # Catch up on anything missed while disconnected, in the background
+        if self.backfill_task is None or self.backfill_task.done():
+            self.backfill_task = self.client.loop.create_task(
+                self.backfill(marks=marks))
+
+    # ----------------------------------------------------------------------- #
+
+    async def sync_dialogs(self):
+        """
+        Sync the stored channels with the account's current channel dialogs.
+        In sharded mode each account may only be in some of the channels, so
+        missing channels aren't marked inactive.
+        """
+        channels = []
         async for dialog in self.client.iter_dialogs():
             if isinstance(dialog.entity, telethon.tl.types.Channel):
-                print(f"Channel ID: {dialog.entity.id}, "
-                      f"Name: {dialog.entity.title}")
-                self.add_channel(dialog.entity.title, str(dialog.entity.id),
-                                 None, None)
+                channels.append({
+                    'uid': str(dialog.entity.id),
+                    'name': dialog.entity.title,
+                })
+                self.chats.prime(dialog.entity)
+
+        return self.sync_channels(channels,
+                                  deactivate_missing=self.assignment is None)
 
     # ----------------------------------------------------------------------- #
 
-    async def is_linked_supergroup(self, chat_id):
+    async def channel_sync_loop(self):
         """
-        Returns True if the given chat_id belongs to a linked supergroup
-        (discussion group of a channel).
+        Periodically pick up channels joined or renamed while running, and
+        backfill newly joined channels.
         """
-        try:
-            chat = await self.client.get_entity(chat_id)
-            if isinstance(chat, telethon.tl.types.Channel):
-                full_channel = await self.client(GetFullChannelRequest(chat))
-                if full_channel.full_chat.linked_chat_id:
-                    return True
-        except Exception as err:
-            print(f"Failed to fetch linked chat for {chat_id}: {err}")
-        return False
+        interval = int(self.get_config('CHANNEL_SYNC_INTERVAL') or 600)
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changes = await self.sync_dialogs()
+                if changes['added'] or changes['reactivated']:
+                    channels = list(DataChannel.objects(
+                        collector=self.db_entry,
+                        uid__in=changes['added'] + changes['reactivated']))
+                    self.client.loop.create_task(self.backfill(
+                        channels, self._snapshot_marks(channels)))
+            except Exception as err:
+                self.on_error()
+
+    # ----------------------------------------------------------------------- #
+
+    def _snapshot_marks(self, channels):
+        """
+        The high-water mark (the last message ID stored in its metadata) of
+        each channel, by uid. Must be taken before live collection of the
+        channels starts, as live messages raise the stored marks.
+        """
+        marks = {}
+        for channel in channels:
+            marks[channel.uid] = (channel.metadata or {}).get('last_message_id')
+            # Any earlier live message predates the gap being backfilled
+            self.first_live_ids.pop(channel.uid, None)
+        return marks
+
+    # ----------------------------------------------------------------------- #
+
+    async def backfill(self, channels=None, marks=None):
+        """
+        Fetch messages posted since each channel's high-water mark in marks
+        and store them in batches, stopping at the first message collected
+        live. Channels not in marks use their current mark, and channels
+        never collected from before get their latest BACKFILL_LIMIT messages.
+        Channels run concurrently, up to BACKFILL_CONCURRENCY at once.
+        """
+        if channels is None:
+            channels = list(DataChannel.objects(collector=self.db_entry,
+                                                active__ne=False))
+        channels = [channel for channel in channels if self.owns(channel.uid)]
+        marks = marks or {}
+
+        limit = asyncio.Semaphore(int(self.get_config('BACKFILL_CONCURRENCY')
+                                      or 1))
+
+        async def run(channel):
+            async with limit:
+                if channel.uid in marks:
+                    high_water_mark = marks[channel.uid]
+                else:
+                    high_water_mark = (channel.metadata or {}).get(
+                        'last_message_id')
+                await self.backfill_channel(channel, high_water_mark)
+
+        start_time = time.time()
+        await asyncio.gather(*[run(channel) for channel in channels])
+        logging.info(f"Backfilled {len(channels)} channels in "
+                     f"{time.time() - start_time:.2f}s")
+
+    # ----------------------------------------------------------------------- #
+
+    async def backfill_channel(self, channel, high_water_mark):
+        """
+        Backfill a single channel from the given high-water mark, resuming
+        from the last message stored after a FloodWait. All channels pause
+        together until a FloodWait has passed, since the limit applies to the
+        whole account.
+        """
+        # Not re-read from the channel, live collection moves the stored mark
+        progress = {'mark': high_water_mark, 'count': 0}
+
+        while True:
+            await asyncio.sleep(max(0, self.flood_wait_until - time.time()))
+
+            try:
+                await self._backfill_from(channel, progress)
+                if progress['count']:
+                    logging.info(f"Backfilled {progress['count']} messages "
+                                 f"for channel '{channel.name}'")
+                return
+            except FloodWaitError as err:
+                logging.warning(f"FloodWait of {err.seconds}s during backfill "
+                                f"of '{channel.name}', pausing backfill")
+                self.flood_wait_until = max(self.flood_wait_until,
+                                            time.time() + err.seconds)
+            except Exception as err:
+                self.on_error({'channel': channel.uid})
+                return
+
+    # ----------------------------------------------------------------------- #
+
+    async def _backfill_from(self, channel, progress):
+        """
+        Store the channel's messages after progress['mark'], up to the first
+        message collected live, updating progress as each batch is stored.
+        """
+        entity = await self.client.get_entity(
+            telethon.tl.types.PeerChannel(int(channel.uid)))
+
+        if progress['mark']:
+            messages = self.client.iter_messages(entity,
+                                                 min_id=progress['mark'],
+                                                 reverse=True)
+        else:
+            limit = int(self.get_config('BACKFILL_LIMIT') or 0)
+            if not limit:
+                return
+            # Newest first, so collect the (small) set then store oldest first
+            messages = [message async for message in
+                        self.client.iter_messages(entity, limit=limit)]
+            messages = self._iter_list(reversed(messages))
+
+        linked = await self.is_linked_supergroup(entity)
+        batch_size = int(self.get_config('BACKFILL_BATCH_SIZE') or 100)
+        batch = []
+
+        async for message in messages:
+            # Live collection has everything from here on
+            first_live_id = self.first_live_ids.get(channel.uid)
+            if first_live_id is not None and message.id >= first_live_id:
+                break
+            if linked and not message.post:
+                continue
+            if not (message.message or message.media):
+                continue
+
+            batch.append(message)
+
+            if len(batch) >= batch_size:
+                await self._store_backfill_batch(channel, batch, progress)
+                batch = []
+
+        await self._store_backfill_batch(channel, batch, progress)
+
+    # ----------------------------------------------------------------------- #
+
+    async def _store_backfill_batch(self, channel, messages, progress):
+        if not messages:
+            return
+
+        records = self.add_data_bulk(channel.uid, [{
+            'payload': self._message_data(message),
+            'friendly_text': message.message or None,
+            'timestamp': message.date.replace(tzinfo=None),
+        } for message in messages])
+        progress['count'] += len(records)
+
+        # Media is downloaded as for live messages, but the backfill waits
+        # for room on the download queue rather than skipping media
+        messages = {message.id: message for message in messages}
+        for record in records:
+            message = messages[record.payload['id']]
+            if self.media.downloadable(message):
+                await self.media.submit_wait(message, record)
+
+        # Stored after each batch, so an interrupted backfill resumes here
+        progress['mark'] = max(messages)
+        self.advance_high_water_mark(channel.uid, progress['mark'])
+
+    # ----------------------------------------------------------------------- #
+
+    async def _iter_list(self, items):
+        for item in items:
+            yield item
+
+    # ----------------------------------------------------------------------- #
+
+    async def is_linked_supergroup(self, chat):
+        """
+        Returns True if the given chat is a linked supergroup (discussion
+        group of a channel). Served from the chat cache; the API is only
+        called the first time a chat is seen.
+        """
+        info = self.chats.get(chat.id)
+        if info is None:
+            info = await self.chats.fetch(chat)
+        return info['linked']
 
     # ----------------------------------------------------------------------- #
 
     async def process_message(self, event: telethon.events.NewMessage.Event):
-        sender = await event.get_sender()
+        # Resolved once per message, normally from Telethon's entity cache
         chat = await event.get_chat()
 
+        # Another shard is responsible for this channel
+        if not self.owns(chat.id):
+            return
+
+        # Where the backfill of this channel stops
+        self.first_live_ids.setdefault(str(chat.id), event.message.id)
+
         # Check if message is from a discussion group
-        if await self.is_linked_supergroup(chat.id):
+        if await self.is_linked_supergroup(chat):
             # Allow only messages that are original posts, not user comments
             if not event.message.post:
-                print(f"Ignoring user comment in linked supergroup: "
-                      f"{chat.title} ({chat.id})")
+                logging.debug(f"Ignoring user comment in linked supergroup: "
+                              f"{chat.title} ({chat.id})")
                 return
 
-        if event.message and event.message.message:
-            if len(event.message.message):
-                try:
-                    await self.print_message(event)
+        if event.message and (event.message.message or event.message.media):
+            try:
+                self.print_message(event, chat)
 
-                    data = {
-                        'id': event.message.id,
-                        'message_text': event.message.message,
-                    }
+                data = self._message_data(event.message)
+                record = self.add_data(str(chat.id), data,
+                                       event.message.message or None)
+                self.advance_high_water_mark(str(chat.id), event.message.id)
+
+                # Downloaded in the background, never delays the next message
+                if record and self.media.downloadable(event.message):
+                    self.media.submit(event.message, record)
+            except Exception as err:
+                self.on_error({'message_event': self.safe_str(event)})
 
-                    self.add_data(str(chat.id), data, event.message.message)
-                except Exception as err:
-                    self.on_error({'message_event': self.safe_str(event)})
- 
     # ----------------------------------------------------------------------- #
 
-    async def print_message(self, event):
-        sender = await event.get_sender()
+    def _message_data(self, message):
+        data = {
+            'id': message.id,
+            'message_text': message.message,
+        }
+        if self.media.downloadable(message):
+            data['media'] = self.media.describe(message)
+        return data
 
-        # Message basic information
-        logging.info(f"Message ID: {event.message.id}")
-        logging.info(f"Date: {event.message.date}")
-        logging.info(f"Message Text: {event.message.message}")
+    # ----------------------------------------------------------------------- #
 
-        # Chat/Channel information
-        chat = await event.get_chat()
-        if event.is_group or event.is_channel:
-            logging.info(f"Chat/Channel ID: {chat.id}")
-            logging.info(f"Chat/Channel Name: {chat.title}")
-        else:
-            logging.info("Private Message")
+    def print_message(self, event, chat):
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+
+        # Only uses the sender already attached to the event, never fetches it
+        sender = event.sender
+        logging.debug(
+            f"Message {event.message.id} at {event.message.date} in "
+            f"'{getattr(chat, 'title', None)}' ({chat.id}) from "
+            f"{getattr(sender, 'username', None)} "
+            f"({getattr(sender, 'id', None)}), "
+            f"private={event.is_private} group={event.is_group} "
+            f"channel={event.is_channel} "
+            f"forwarded={event.message.fwd_from is not None} "
+            f"media={event.message.media is not None}: "
+            f"{event.message.message}"
+        )
+
+# --------------------------------------------------------------------------- #
 
-        # Sender information
-        sender = await event.get_sender()
-        logging.info(f"Sender ID: {sender.id}")
-        logging.info(f"Sender Username: {sender.username}")
+def check_shards(shards):
+    """
+    Returns the SHARDS config by shard ID, raising ValueError unless every
+    shard has its own SESSION_PATH. Telethon sessions can't be shared between
+    processes, and the session can't default to the unsharded one, as every
+    shard would then use it.
+    """
+    by_id = {}
+    session_paths = set()
 
-        # Media information (if any)
-        if event.message.media:
-            logging.info(f"Media: {event.message.media}")
+    for shard in shards:
+        shard_id = str(shard.get('id'))
+        session_path = shard.get('SESSION_PATH')
+        if not session_path:
+            raise ValueError(f"Shard '{shard_id}' has no SESSION_PATH")
+        if session_path in session_paths:
+            raise ValueError(f"Shard '{shard_id}' shares SESSION_PATH "
+                             f"'{session_path}' with another shard")
+        session_paths.add(session_path)
+        by_id[shard_id] = shard
 
-        # Additional details
-        logging.info(f"Is Private: {event.is_private}")
-        logging.info(f"Is Group: {event.is_group}")
-        logging.info(f"Is Channel: {event.is_channel}")
-        logging.info(f"Forwarded: {event.message.fwd_from is not None}")
+    return by_id
 
 # --------------------------------------------------------------------------- #
 
-def main():
-    tc = TelegramCollector()
+def run_shard(shard_id):
+    tc = TelegramCollector(shard_id)
+    if tc.assignment is None:
+        logging.error(f"Shard '{shard_id}' is misconfigured, not starting")
+        sys.exit(1)
     tc.start()
 
 # --------------------------------------------------------------------------- #
+
+def run_shards(shard_ids):
+    """
+    Run each shard in its own process, restarting any that exit. Processes
+    are spawned rather than forked so each has its own database connections.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+
+    while True:
+        for shard_id in shard_ids:
+            process = processes.get(shard_id)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                logging.error(f"Shard '{shard_id}' exited with code "
+                              f"{process.exitcode}, restarting")
+
+            process = context.Process(target=run_shard, args=(shard_id,),
+                                      name=f"telegram-{shard_id}")
+            process.start()
+            processes[shard_id] = process
+
+        time.sleep(10)
+
+# --------------------------------------------------------------------------- #
+
+def main():
+    parser = argparse.ArgumentParser(description="Telegram collector")
+    parser.add_argument('--shard', help="Run only this shard from the SHARDS "
+                                        "config")
+    args = parser.parse_args()
+
+    if args.shard:
+        run_shard(args.shard)
+        return
+
+    collector = Collector.objects(name="Telegram").first()
+    shards = collector.get_config('SHARDS') if collector else None
+    if shards:
+        try:
+            shard_ids = list(check_shards(shards))
+        except ValueError as err:
+            logging.error(f"Invalid SHARDS config, not starting: {err}")
+            sys.exit(1)
+        run_shards(shard_ids)
+    else:
+        tc = TelegramCollector()
+        tc.start()
+
+# --------------------------------------------------------------------------- #
     
 if __name__ == '__main__':
     main()
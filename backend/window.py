@@ -0,0 +1,184 @@
+from shared import storage
+import datetime
+import logging
+import math
+import time
+
+# --------------------------------------------------------------------------- #
+
+GROUP_TASK    = "task"
+GROUP_CHANNEL = "channel"
+GROUP_TOPIC   = "topic"
+
+# --------------------------------------------------------------------------- #
+
+class RecordWindow:
+    """
+    A closed window of CollectionData records to be analysed together, in the
+    order they were received.
+    """
+    def __init__(self, key, record_ids, start, end):
+        self.key = key
+        self.record_ids = record_ids
+        self.start = start
+        self.end = end
+        self._records = None
+
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = storage.get_data_by_ids(self.record_ids)
+        return self._records
+
+
+    def __len__(self):
+        return len(self.record_ids)
+
+# --------------------------------------------------------------------------- #
+
+class WindowSpec:
+    """
+    The windowing options of a trigger, parsed from its parameters:
+
+      window_seconds - Length of each window. Windowing is off without it.
+      window_slide   - How often a window closes. Defaults to window_seconds,
+                       giving tumbling windows. Smaller values give sliding
+                       windows that overlap.
+      window_max     - Close the window early once it holds this many records.
+      window_group   - Buffer separately per 'task' (default), 'channel' or
+                       'topic'.
+
+    Windows are aligned to multiples of window_slide since the epoch (UTC), so
+    a window_seconds of 86400 closes at midnight every day.
+    """
+    def __init__(self, parameters):
+        self.length = int(parameters['window_seconds'])
+        self.slide = int(parameters.get('window_slide') or self.length)
+        self.cap = int(parameters.get('window_max') or 0)
+        self.group = parameters.get('window_group') or GROUP_TASK
+
+        if self.length <= 0 or self.slide <= 0:
+            raise ValueError("window_seconds and window_slide must be positive")
+        if self.slide > self.length:
+            raise ValueError("window_slide cannot exceed window_seconds")
+        if self.group not in [GROUP_TASK, GROUP_CHANNEL, GROUP_TOPIC]:
+            raise ValueError(f"Unknown window_group '{self.group}'")
+
+
+    @staticmethod
+    def is_windowed(trigger):
+        return bool(trigger.parameters.get('window_seconds'))
+
+
+    def next_close(self, now):
+        return math.floor(now / self.slide) * self.slide + self.slide
+
+# --------------------------------------------------------------------------- #
+
+class WindowBuffer:
+    """
+    Buffers records per (task, trigger, group) until their window closes.
+    Only record IDs are held in memory; the records themselves are fetched in
+    one query when a window is analysed. Buffers are not persisted, so records
+    in windows that are still open are dropped if the analyser restarts.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+
+    def _group_keys(self, spec, record):
+        if spec.group == GROUP_CHANNEL:
+            return [str(record.channel.id)]
+        if spec.group == GROUP_TOPIC:
+            return [str(topic.id) for topic in record.channel.topics] or [None]
+        return [None]
+
+
+    def add(self, record, task, trigger, now=None):
+        """
+        Buffer a record for a windowed trigger. Yields (window, task, trigger)
+        for any window closed early by reaching its size cap.
+        """
+        now = now or time.time()
+        spec = WindowSpec(trigger.parameters)
+        trigger_index = task.triggers.index(trigger)
+
+        for group_key in self._group_keys(spec, record):
+            key = (str(task.id), trigger_index, group_key)
+            buffer = self.buffers.get(key)
+            if buffer is None:
+                buffer = {
+                    'task': task,
+                    'trigger': trigger,
+                    'spec': spec,
+                    'entries': [],
+                    # Records already analysed in a window closed early
+                    'emitted': set(),
+                    'close': spec.next_close(now),
+                }
+                self.buffers[key] = buffer
+
+            buffer['entries'].append((now, record.id))
+
+            if spec.cap and len(self._open_entries(buffer)) >= spec.cap:
+                logging.info(f"Window {key} reached its cap of {spec.cap}")
+                window = self._make_window(key, self._open_entries(buffer),
+                                           buffer['close'] - spec.length, now)
+
+                # Sliding windows overlap, so records from the start of the
+                # next window are kept for it, but not counted again in this
+                # one
+                next_start = buffer['close'] + spec.slide - spec.length
+                buffer['entries'] = [entry for entry in buffer['entries']
+                                     if entry[0] >= next_start]
+                buffer['emitted'] = {record_id
+                                     for _, record_id in buffer['entries']}
+                yield window, task, trigger
+
+
+    def _open_entries(self, buffer):
+        start = buffer['close'] - buffer['spec'].length
+        return [entry for entry in buffer['entries']
+                if entry[0] >= start and entry[1] not in buffer['emitted']]
+
+
+    def _make_window(self, key, entries, start, end):
+        to_datetime = datetime.datetime.utcfromtimestamp
+        return RecordWindow(key, [record_id for _, record_id in entries],
+                            to_datetime(start), to_datetime(end))
+
+
+    def collect_due(self, now=None):
+        """
+        Yields (window, task, trigger) for every window that has closed.
+        Empty windows are skipped, and buffers with nothing left are removed.
+        """
+        now = now or time.time()
+
+        for key in list(self.buffers):
+            buffer = self.buffers[key]
+            spec = buffer['spec']
+
+            while buffer['close'] <= now:
+                close = buffer['close']
+                start = close - spec.length
+                entries = [entry for entry in buffer['entries']
+                           if start <= entry[0] < close
+                           and entry[1] not in buffer['emitted']]
+
+                # Records before the start of the next window are done with
+                next_start = close + spec.slide - spec.length
+                buffer['entries'] = [entry for entry in buffer['entries']
+                                     if entry[0] >= next_start]
+                buffer['close'] = close + spec.slide
+                buffer['emitted'] = set()
+
+                if entries:
+                    yield (self._make_window(key, entries, start, close),
+                           buffer['task'], buffer['trigger'])
+
+            if not buffer['entries']:
+                del self.buffers[key]
+
+# --------------------------------------------------------------------------- #
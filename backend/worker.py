@@ -9,6 +9,11 @@ from shared.models import (
     AnalysisTask,
     WorkerBase
 )
+from shared import rollups, search, storage
+from window import WindowBuffer, WindowSpec
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 import traceback
 import logging
 import sys
@@ -20,6 +25,13 @@ logging.getLogger().setLevel(logging.DEBUG)
 
 EVENT_NEW_DATA     = "NEW_DATA"
 EVENT_NEW_ANALYSIS = "NEW_ANALYSIS_RESULT"
+EVENT_NEW_ERROR    = "NEW_ERROR"
+# Tells the frontend a result was saved. Analysers never subscribe to it, so
+# saving results can't trigger further analysis
+EVENT_RESULT_SAVED = "RESULT_SAVED"
+
+# How often (in seconds) analysers wake up to close due windows when idle
+WINDOW_TICK = 1.0
 
 # --------------------------------------------------------------------------- #
 
@@ -66,7 +78,7 @@ class NewDataEvent(Event):
 
 
     def get_db_record(self):
-        return CollectionData.objects(uuid=self.data['record_uuid']).first()
+        return storage.get_data(uuid=self.data['record_uuid'])
 
 # --------------------------------------------------------------------------- #
 
@@ -129,7 +141,7 @@ class Worker:
         
         logging.debug(traceback_str)
 
-        WorkerError(
+        error = WorkerError(
             worker_name=self.name,
             error_summary=error_summary,
             error_type=error_type,
@@ -137,6 +149,15 @@ class Worker:
             metadata=metadata
         ).save() 
 
+        # Published directly, as errors can occur before db_entry is set
+        try:
+            self.redis.publish(EVENT_NEW_ERROR, json.dumps({
+                'worker_name': self.name,
+                'error_uuid': str(error.uuid),
+            }))
+        except redis.RedisError as err:
+            logging.error(f"Failed to publish {EVENT_NEW_ERROR}: {err}")
+
 
     def raise_event(self, event_name, data=None):
         data = data or {}
@@ -144,8 +165,23 @@ class Worker:
         self.redis.publish(event_name, json.dumps(data))
 
 
-    def listen_for_events(self):
-        for message in self.pubsub.listen():
+    def listen_for_events(self, timeout=None):
+        """
+        Yield events from the Redis queue as they arrive. If a timeout is
+        given, None is yielded whenever no message arrives within it, allowing
+        the caller to do periodic work between events.
+        """
+        if timeout is None:
+            messages = self.pubsub.listen()
+        else:
+            messages = iter(lambda: self.pubsub.get_message(timeout=timeout)
+                            or {'type': 'idle'}, None)
+
+        for message in messages:
+            if message['type'] == 'idle':
+                yield None
+                continue
+
             if message['type'] != 'message':
                 continue
 
@@ -160,7 +196,7 @@ class Worker:
 
 
     def get_channel(self, uid):
-        return DataChannel.objects(uid=uid).first()
+        return DataChannel.objects(collector=self.db_entry, uid=uid).first()
 
 
     def add_channel(self, name, uid, description=None, metadata=None):
@@ -169,32 +205,161 @@ class Worker:
         if existing_channel:
             return existing_channel
 
-        return DataChannel(
+        channel = DataChannel(
             name=name,
             uid=str(uid),
             description=description,
             metadata=metadata,
             collector=self.db_entry
         ).save()
+        self._update_channel_count()
+        return channel
+
+
+    def _update_channel_count(self):
+        WorkerBase._get_collection().update_one(
+            {'_id': self.db_entry.id},
+            {'$set': {'channel_count':
+                      DataChannel.objects(collector=self.db_entry).count()}}
+        )
 
 # --------------------------------------------------------------------------- #
 # Collector Worker                                                            #
 # --------------------------------------------------------------------------- #
 
 class CollectorWorker(Worker):
+
+    # The payload field identifying an item at its source, e.g. a message ID.
+    # When set, re-collecting an item already stored for the channel does
+    # nothing. Channels can override it with 'natural_key_field' in metadata.
+    natural_key_field = None
+
     def __init__(self, name):
         super().__init__(name)
         self.db_entry = self._register_collector()
 
 
     def _register_collector(self):
-        existing = Collector.objects(name=self.name).first()
-        if existing:
-            return existing
-        return Collector(name=self.name).save()
+        collector = Collector.objects(name=self.name).first()
+        if not collector:
+            collector = Collector(name=self.name)
+
+        # Recorded so maintenance jobs know how this collector's data is keyed
+        key_field = self.natural_key_field
+        if not collector.pk or collector.metadata.get('natural_key_field') != key_field:
+            collector.metadata['natural_key_field'] = key_field
+            collector.save()
+        return collector
+
+
+    def natural_key(self, channel, payload):
+        field = ((channel.metadata or {}).get('natural_key_field')
+                 or self.natural_key_field)
+        if not field or payload.get(field) is None:
+            return None
+        return str(payload[field])
+
+
+    def _insert_new(self, records):
+        """
+        Insert records in one bulk write, skipping any whose natural key is
+        already stored for their channel. Returns a list of booleans saying
+        which records were inserted.
+        """
+        # Keys already rolled over into partitions aren't covered by the
+        # unique index on the hot collection
+        archived = storage.archived_natural_keys(records)
+
+        operations = []
+        # The index in records of the record each operation inserts
+        positions = []
+        for index, record in enumerate(records):
+            record.validate()
+            document = record.to_mongo().to_dict()
+
+            if (record.channel.id, record.natural_key) in archived:
+                continue
+            positions.append(index)
+
+            if record.natural_key is None:
+                record.id = document['_id'] = ObjectId()
+                operations.append(InsertOne(document))
+                continue
+
+            key_filter = {field: document[field] for field in
+                          ['_cls', 'channel', 'natural_key'] if field in document}
+            operations.append(UpdateOne(key_filter,
+                                        {'$setOnInsert': document},
+                                        upsert=True))
+
+        inserted = [False] * len(records)
+        if not operations:
+            return inserted
+
+        try:
+            result = CollectionData._get_collection().bulk_write(operations,
+                                                                 ordered=False)
+            upserted_ids = result.upserted_ids
+            failed = set()
+        except BulkWriteError as err:
+            # Duplicate keys from a concurrent insert of the same item are
+            # expected, anything else is a real failure
+            if any(error['code'] != 11000
+                   for error in err.details['writeErrors']):
+                raise
+            upserted_ids = {upsert['index']: upsert['_id']
+                            for upsert in err.details['upserted']}
+            failed = {error['index'] for error in err.details['writeErrors']}
+
+        for op_index, (index, operation) in enumerate(zip(positions,
+                                                          operations)):
+            if isinstance(operation, InsertOne):
+                inserted[index] = op_index not in failed
+            elif op_index in upserted_ids:
+                records[index].id = upserted_ids[op_index]
+                inserted[index] = True
+
+        return inserted
+
+
+    def _update_stats(self, channel, records):
+        """
+        Add newly inserted records to the stored entry counts and latest entry
+        times of their channel and this collector, and to the activity
+        rollups. Uses $inc and $max, so concurrent writers never lose each
+        other's updates.
+        """
+        if not records:
+            return
+
+        count = len(records)
+        latest = max(record.timestamp for record in records)
+
+        # Returns the channel's current topics for the rollups below, without
+        # an extra query to dereference them
+        updated = DataChannel._get_collection().find_one_and_update(
+            {'_id': channel.id},
+            {'$inc': {'entry_count': count},
+             '$max': {'latest_entry_time': latest}},
+            projection={'topics': 1}
+        )
+        WorkerBase._get_collection().update_one(
+            {'_id': self.db_entry.id},
+            {'$inc': {'entry_count': count},
+             '$max': {'last_data': latest}}
+        )
 
+        rollups.record_activity(channel.id, self.db_entry.id,
+                                (updated or {}).get('topics', []),
+                                [record.timestamp for record in records])
 
-    def add_data(self, channel_uid, payload, friendly_text=None):
+
+    def add_data(self, channel_uid, payload, friendly_text=None,
+                 timestamp=None):
+        """
+        Store an item and raise a NEW_DATA event for it. Returns the new
+        CollectionData, or None if the item was already stored.
+        """
         channel = self.get_channel(str(channel_uid))
 
         if channel is None:
@@ -204,10 +369,141 @@ class CollectorWorker(Worker):
         data = CollectionData(
             channel=channel,
             payload=payload,
-            friendly_text=friendly_text
-        ).save()
+            friendly_text=friendly_text,
+            natural_key=self.natural_key(channel, payload)
+        )
+        if timestamp:
+            data.timestamp = timestamp
+
+        if not self._insert_new([data])[0]:
+            logging.debug(f"Skipping duplicate {data.natural_key} in channel "
+                          f"{channel_uid}")
+            return None
 
+        self._update_stats(channel, [data])
+        search.index_data([data])
         self.raise_event(EVENT_NEW_DATA, { 'record_uuid': str(data.uuid) })
+        return data
+
+
+    def add_data_bulk(self, channel_uid, entries):
+        """
+        Insert many entries for one channel in a single write, raising a
+        NEW_DATA event for each. Each entry is a dict with a 'payload' and
+        optionally 'friendly_text' and 'timestamp'. Entries already stored are
+        skipped. Returns the new CollectionData records, in entry order.
+        """
+        channel = self.get_channel(str(channel_uid))
+
+        if channel is None:
+            logging.error(f"get_channel() returned None for UID {channel_uid}")
+            return []
+
+        if not entries:
+            return []
+
+        records = []
+        for entry in entries:
+            data = CollectionData(
+                channel=channel,
+                payload=entry['payload'],
+                friendly_text=entry.get('friendly_text'),
+                natural_key=self.natural_key(channel, entry['payload'])
+            )
+            if entry.get('timestamp'):
+                data.timestamp = entry['timestamp']
+            records.append(data)
+
+        inserted = self._insert_new(records)
+        new_records = [data for data, is_new in zip(records, inserted)
+                       if is_new]
+        self._update_stats(channel, new_records)
+        search.index_data(new_records)
+
+        for data in new_records:
+            self.raise_event(EVENT_NEW_DATA, { 'record_uuid': str(data.uuid) })
+
+        return new_records
+
+
+    def sync_channels(self, channels, deactivate_missing=True):
+        """
+        Bring this collector's DataChannels in line with the full list of
+        channels currently available at the source, given as dicts with a
+        'uid' and 'name', and optionally a 'description' and 'metadata'.
+        Stored channels are read in one query and all changes are applied in
+        one bulk write: new channels are added, renamed ones updated, and
+        those no longer listed marked inactive (unless deactivate_missing is
+        False, for sources that only list part of their channels).
+
+        Returns the UIDs affected, as a dict of lists keyed 'added',
+        'renamed', 'reactivated' and 'deactivated'.
+        """
+        current = {str(channel['uid']): channel for channel in channels}
+        stored = {
+            channel['uid']: channel for channel in
+            DataChannel.objects(collector=self.db_entry)
+                       .only('uid', 'name', 'active').as_pymongo()
+        }
+        changes = {'added': [], 'renamed': [], 'reactivated': [],
+                   'deactivated': []}
+        operations = []
+
+        for uid, channel in current.items():
+            existing = stored.get(uid)
+
+            if existing is None:
+                new_channel = DataChannel(
+                    name=channel['name'],
+                    uid=uid,
+                    description=channel.get('description'),
+                    metadata=channel.get('metadata') or {},
+                    collector=self.db_entry
+                )
+                new_channel.validate()
+                operations.append(InsertOne(new_channel.to_mongo().to_dict()))
+                changes['added'].append(uid)
+                continue
+
+            update = {}
+            if existing.get('name') != channel['name']:
+                update['name'] = channel['name']
+                changes['renamed'].append(uid)
+            if existing.get('active') is False:
+                update['active'] = True
+                changes['reactivated'].append(uid)
+            if update:
+                operations.append(UpdateOne({'_id': existing['_id']},
+                                            {'$set': update}))
+
+        if deactivate_missing:
+            for uid, existing in stored.items():
+                if uid not in current and existing.get('active', True):
+                    operations.append(UpdateOne({'_id': existing['_id']},
+                                                {'$set': {'active': False}}))
+                    changes['deactivated'].append(uid)
+
+        if operations:
+            DataChannel._get_collection().bulk_write(operations, ordered=False)
+            if changes['added']:
+                self._update_channel_count()
+            logging.info("Synced channels: " + ", ".join(
+                f"{len(uids)} {change}" for change, uids in changes.items()))
+
+        return changes
+
+
+    def advance_high_water_mark(self, channel_uid, value,
+                                key='last_message_id'):
+        """
+        Raise a channel's high-water mark (stored in its metadata) to value,
+        if it is higher than the current one. Atomic, so it is safe to call
+        from both live collection and a concurrent backfill.
+        """
+        DataChannel._get_collection().update_one(
+            {'collector': self.db_entry.id, 'uid': str(channel_uid)},
+            {'$max': {f'metadata.{key}': value}}
+        )
 
 # --------------------------------------------------------------------------- #
 # Analyser Worker                                                             #
@@ -217,6 +513,11 @@ class AnalyserWorker(Worker):
     def __init__(self, name):
         super().__init__(name)
         self.db_entry = self._register_analyser()
+        self.windows = WindowBuffer()
+        self.register_parameter('window_seconds', 'Optional. Analyse NEW_DATA in windows of this many seconds instead of per record.')
+        self.register_parameter('window_slide', 'Optional. Seconds between windows closing, for sliding windows (defaults to window_seconds).')
+        self.register_parameter('window_max', 'Optional. Close a window early once it holds this many records.')
+        self.register_parameter('window_group', 'Optional. Buffer windows per task (default), channel or topic.')
 
 
     def _register_analyser(self):
@@ -251,18 +552,45 @@ class AnalyserWorker(Worker):
 
 
     def register_parameter(self, key, value):
-        self.db_entry.task_parameters[key] = value
+        if self.db_entry.task_parameters.get(key) != value:
+            self.db_entry.task_parameters[key] = value
+            self.db_entry.save()
 
 
     def listen_for_tasks(self):
         """
         Read events from the Redis queue and return AnalysisTasks that should
         fire upon them.
+
+        Triggers with windowing parameters (see WindowSpec) buffer NEW_DATA
+        records instead, and yield a RecordWindow in place of the record once
+        the window closes.
         """
-        for event in self.listen_for_events():
-            record = event.get_db_record()
-            for task, trigger in self._get_tasks(event):
-                yield record, task, trigger
+        for event in self.listen_for_events(timeout=WINDOW_TICK):
+            if event:
+                record = event.get_db_record()
+                if record is None:
+                    # e.g. removed as a duplicate since the event was raised
+                    logging.warning(f"Skipping {event.name} event, its record "
+                                    f"{event.data.get('record_uuid')} no "
+                                    f"longer exists")
+                    continue
+
+                for task, trigger in self._get_tasks(event):
+                    if event.is_new_data() and WindowSpec.is_windowed(trigger):
+                        # One bad record or trigger mustn't stop windowing
+                        try:
+                            closed = list(self.windows.add(record, task,
+                                                           trigger))
+                        except Exception as err:
+                            self.on_error({'task': str(task.uuid),
+                                           'record': str(record.uuid)})
+                            continue
+                        yield from closed
+                    else:
+                        yield record, task, trigger
+
+            yield from self.windows.collect_due()
 
 
     def save_result(self, name, payload, record, task, **kwargs):
@@ -271,7 +599,7 @@ class AnalyserWorker(Worker):
 
         # TODO: Add support for saving result generated from another result
 
-        AnalysisResult(
+        result = AnalysisResult(
             name=name,
             hidden=False,
             analyser=self.db_entry,
@@ -280,5 +608,8 @@ class AnalyserWorker(Worker):
             task=task,
             **kwargs
         ).save()
+        search.index_result(result, record)
+        self.raise_event(EVENT_RESULT_SAVED, {'record_uuid': str(result.uuid)})
+        return result
 
 # --------------------------------------------------------------------------- #
@@ -1,7 +1,9 @@
 from flask import Flask
 from app.config import Config
 from app.database import init_db
+from app.events import bus
 from app.routes import main
+from app.api import api
 
 def create_app():
     app = Flask(__name__)
@@ -9,6 +11,8 @@ def create_app():
     app.config['SECRET_KEY'] = 'ojwadawjdawdawd'
 
     init_db(app)
+    bus.init_app(app)
 
     app.register_blueprint(main)
+    app.register_blueprint(api)
     return app
@@ -0,0 +1,170 @@
+from flask import Blueprint, Response, request
+from mongoengine.errors import LookUpError
+from shared.models import (
+    Analyser, AnalysisTask, Collector, WorkerBase, to_uuid
+)
+from bson import Binary, ObjectId
+import orjson
+
+api = Blueprint("api", __name__)
+
+# --------------------------------------------------------------------------- #
+
+DUMPS_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+# --------------------------------------------------------------------------- #
+# Serialisation                                                               #
+# --------------------------------------------------------------------------- #
+
+def _default(value):
+    """
+    Serialise the BSON types orjson doesn't know: IDs and binary UUIDs.
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Binary):
+        return str(to_uuid(value))
+    raise TypeError(f"Can't serialise {type(value).__name__}")
+
+
+def _document(model, raw):
+    """
+    A raw document keyed by field name rather than database field, with its
+    ID as 'id' and, for inherited models, its class as 'type'.
+    """
+    names = {field.db_field: name for name, field in model._fields.items()}
+    document = {}
+    for key, value in raw.items():
+        if key == '_cls':
+            document['type'] = value.split('.')[-1]
+        else:
+            document[names.get(key, key)] = value
+    return document
+
+
+def _documents(model, queryset):
+    """
+    The queryset's documents as dicts, read raw without building mongoengine
+    documents, and projected to the comma-separated 'fields' query argument
+    if given. Raises LookUpError on unknown fields.
+    """
+    fields = [name for name in request.args.get("fields", "").split(",")
+              if name]
+    if fields:
+        queryset = queryset.only(*fields)
+    return [_document(model, raw) for raw in queryset.as_pymongo()]
+
+
+def _respond(body):
+    """
+    A JSON response with an ETag of its content, so clients revalidating
+    with If-None-Match get an empty 304 if nothing has changed.
+    """
+    response = Response(orjson.dumps(body, default=_default,
+                                     option=DUMPS_OPTIONS),
+                        mimetype="application/json")
+    # Cached, but always revalidated
+    response.headers["Cache-Control"] = "no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def _error(message, status):
+    return Response(orjson.dumps({"error": message}), status=status,
+                    mimetype="application/json")
+
+
+def _list(model, queryset, resolve=None):
+    try:
+        documents = _documents(model, queryset)
+    except LookUpError as err:
+        return _error(str(err), 400)
+    if resolve:
+        resolve(documents)
+    return _respond(documents)
+
+
+def _detail(model, queryset, label, record_uuid, resolve=None):
+    try:
+        documents = _documents(model, queryset.limit(1))
+    except LookUpError as err:
+        return _error(str(err), 400)
+    if not documents:
+        return _error(f"{label} with UUID '{record_uuid}' not found", 404)
+    if resolve:
+        resolve(documents)
+    return _respond(documents[0])
+
+# --------------------------------------------------------------------------- #
+
+def _resolve_tasks(tasks):
+    """
+    Add the UUIDs of each task's analyser and trigger workers, as
+    analyser_uuid and worker_uuid, with one query for every task.
+    """
+    ids = set()
+    for task in tasks:
+        ids.add(task.get('analyser'))
+        ids.update(trigger.get('worker')
+                   for trigger in task.get('triggers', []))
+    ids.discard(None)
+
+    uuids = {}
+    if ids:
+        uuids = {raw['_id']: raw['uuid'] for raw in
+                 WorkerBase.objects(id__in=list(ids)).only('uuid').as_pymongo()}
+
+    for task in tasks:
+        if 'analyser' in task:
+            task['analyser_uuid'] = uuids.get(task['analyser'])
+        for trigger in task.get('triggers', []):
+            trigger['worker_uuid'] = uuids.get(trigger.get('worker'))
+
+# --------------------------------------------------------------------------- #
+# JSON Endpoints                                                              #
+# --------------------------------------------------------------------------- #
+
+@api.route("/workers/json")
+def workers_json():
+    return _list(WorkerBase, WorkerBase.objects())
+
+
+@api.route("/worker/<uuid:worker_uuid>/json")
+def worker_json(worker_uuid):
+    return _detail(WorkerBase, WorkerBase.objects(uuid=worker_uuid),
+                   "Worker", worker_uuid)
+
+
+@api.route("/analysers/json")
+def analysers_json():
+    return _list(Analyser, Analyser.objects())
+
+
+@api.route("/analyser/<uuid:analyser_uuid>/json")
+def analyser_json(analyser_uuid):
+    return _detail(Analyser, Analyser.objects(uuid=analyser_uuid),
+                   "Analyser", analyser_uuid)
+
+
+@api.route("/collectors/json")
+def collectors_json():
+    return _list(Collector, Collector.objects())
+
+
+@api.route("/collector/<uuid:collector_uuid>/json")
+def collector_json(collector_uuid):
+    return _detail(Collector, Collector.objects(uuid=collector_uuid),
+                   "Collector", collector_uuid)
+
+
+@api.route("/tasks/json")
+def tasks_json():
+    return _list(AnalysisTask, AnalysisTask.objects(), _resolve_tasks)
+
+
+@api.route("/task/<uuid:task_uuid>/json")
+def task_json(task_uuid):
+    return _detail(AnalysisTask, AnalysisTask.objects(uuid=task_uuid),
+                   "Task", task_uuid, _resolve_tasks)
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,137 @@
+from flask import request
+from app.events import (
+    bus, EVENT_NEW_DATA, EVENT_RESULT_SAVED, EVENT_NEW_ERROR,
+    EVENT_ERRORS_READ, EVENT_RESET
+)
+import functools
+import threading
+import time
+
+# --------------------------------------------------------------------------- #
+
+# What cached entries depend on, so events can invalidate them
+TAG_DATA    = "data"
+TAG_RESULTS = "results"
+TAG_ERRORS  = "errors"
+
+INVALIDATES = {
+    EVENT_NEW_DATA:     [TAG_DATA],
+    EVENT_RESULT_SAVED: [TAG_RESULTS],
+    EVENT_NEW_ERROR:    [TAG_ERRORS],
+    EVENT_ERRORS_READ:  [TAG_ERRORS],
+}
+
+MAX_ENTRIES = 1000
+
+# --------------------------------------------------------------------------- #
+# Response Cache                                                              #
+# --------------------------------------------------------------------------- #
+
+class ResponseCache:
+    """
+    An in-process cache of computed values and rendered pages, each with a
+    TTL and tags naming the data it depends on. It listens to the event bus
+    and drops the entries tagged with what each event changes, so entries
+    stay fresh between expiries without polling. Every frontend process
+    keeps, and invalidates, its own cache.
+
+    While the bus isn't connected, events could be missed, so nothing is
+    cached and every value is computed.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+
+    def on_event(self, event_name, data):
+        if event_name == EVENT_RESET:
+            self.clear()
+        else:
+            self.invalidate(*INVALIDATES.get(event_name, []))
+
+    # ----------------------------------------------------------------------- #
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value, _ = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            return value
+
+
+    def set(self, key, value, ttl, tags):
+        if not bus.connected.is_set():
+            return
+        with self.lock:
+            if len(self.entries) >= MAX_ENTRIES:
+                # Entries are kept in insertion order, so this is the oldest
+                del self.entries[next(iter(self.entries))]
+            self.entries[key] = (time.monotonic() + ttl, value, set(tags))
+
+
+    def get_or_set(self, key, compute, ttl, tags):
+        """
+        The cached value for key, or compute() cached for ttl seconds under
+        the given tags.
+        """
+        bus.start()
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value, ttl, tags)
+        return value
+
+
+    def invalidate(self, *tags):
+        tags = set(tags)
+        with self.lock:
+            for key in [key for key, (_, _, entry_tags) in self.entries.items()
+                        if entry_tags & tags]:
+                del self.entries[key]
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def notify(self, event_name):
+        """
+        Invalidate what an event changes here now, and in every other
+        frontend process through Redis.
+        """
+        self.invalidate(*INVALIDATES[event_name])
+        bus.publish(event_name)
+
+# --------------------------------------------------------------------------- #
+
+cache = ResponseCache()
+bus.add_listener(cache.on_event)
+
+# --------------------------------------------------------------------------- #
+
+def cached_page(ttl, *tags):
+    """
+    Cache a view's rendered page by its full path and query string. Every
+    page shows the unread error count, so is always tagged with errors too.
+    Only successful, fully rendered pages are cached.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = f"page:{request.full_path}"
+            page = cache.get(key)
+            if page is None:
+                bus.start()
+                page = view(*args, **kwargs)
+                if isinstance(page, str):
+                    cache.set(key, page, ttl, list(tags) + [TAG_ERRORS])
+            return page
+        return wrapper
+    return decorator
+
+# --------------------------------------------------------------------------- #
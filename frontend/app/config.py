@@ -7,3 +7,4 @@ class Config:
         'host': os.getenv('MONGO_HOST', 'database'),
         'port': int(os.getenv('MONGO_PORT', 27017))
     }
+    REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
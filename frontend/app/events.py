@@ -0,0 +1,272 @@
+from shared.models import AnalysisResult, CollectionData, to_uuid
+from shared import storage
+from app.prefetch import prefetch
+import json
+import logging
+import queue
+import threading
+import time
+import redis
+
+# --------------------------------------------------------------------------- #
+
+EVENT_NEW_DATA     = "NEW_DATA"
+# Published by analysers whenever they save a result
+EVENT_RESULT_SAVED = "RESULT_SAVED"
+EVENT_NEW_ERROR    = "NEW_ERROR"
+# Published by the frontend when errors are marked as read
+EVENT_ERRORS_READ  = "ERRORS_READ"
+
+EVENTS = [EVENT_NEW_DATA, EVENT_RESULT_SAVED, EVENT_NEW_ERROR,
+          EVENT_ERRORS_READ]
+
+# Passed to listeners when the bus connects or disconnects, as events may
+# have been missed
+EVENT_RESET = "RESET"
+
+# Seconds to wait before reconnecting to Redis
+RECONNECT_DELAY = 5
+
+# Notifications queued for a slow client before newer ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 100
+
+MAX_SUBSCRIBERS = 100
+
+# --------------------------------------------------------------------------- #
+# Event Bus                                                                   #
+# --------------------------------------------------------------------------- #
+
+class EventBus:
+    """
+    A single subscription to the workers' events on Redis for the whole
+    frontend process, started on first use. Each event is handed to the
+    registered listeners (such as the response cache), then described once
+    and fanned out to every subscribed browser stream whose filters it
+    matches.
+    """
+    def __init__(self):
+        self.redis = None
+        self.listeners = []
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.thread = None
+
+
+    def init_app(self, app):
+        self.redis = redis.Redis(host=app.config['REDIS_HOST'], port=6379,
+                                 db=0)
+
+
+    def add_listener(self, callback):
+        """
+        Call callback(event_name, data) for every event, and with
+        EVENT_RESET whenever events may have been missed.
+        """
+        self.listeners.append(callback)
+
+
+    def start(self):
+        with self.lock:
+            if self.thread is None and self.redis is not None:
+                self.thread = threading.Thread(target=self._listen,
+                                               name="event-bus", daemon=True)
+                self.thread.start()
+
+
+    def publish(self, event_name, data=None):
+        try:
+            self.redis.publish(event_name, json.dumps(data or {}))
+        except redis.RedisError as err:
+            logging.error(f"Failed to publish {event_name}: {err}")
+
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(*EVENTS)
+                self.connected.set()
+                self._notify_listeners(EVENT_RESET, {})
+
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    event_name = message['channel'].decode('ascii')
+                    try:
+                        data = json.loads(message['data'])
+                    except ValueError:
+                        logging.error(f"Invalid {event_name} event data: "
+                                      f"{message['data']!r}")
+                        continue
+                    self._dispatch(event_name, data)
+            except redis.RedisError as err:
+                logging.error(f"Event bus connection failed: {err}")
+
+            self.connected.clear()
+            self._notify_listeners(EVENT_RESET, {})
+            time.sleep(RECONNECT_DELAY)
+
+
+    def _notify_listeners(self, event_name, data):
+        for callback in self.listeners:
+            try:
+                callback(event_name, data)
+            except Exception as err:
+                logging.error(f"Event listener failed on {event_name}: {err}")
+
+
+    def _dispatch(self, event_name, data):
+        self._notify_listeners(event_name, data)
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+        if not subscribers:
+            return
+
+        # Looked up once here, however many browsers are listening
+        try:
+            notification = describe(event_name, data)
+        except Exception as err:
+            logging.error(f"Failed to describe {event_name} {data}: {err}")
+            return
+        if notification is None:
+            return
+
+        for subscriber in subscribers:
+            subscriber.offer(notification)
+
+    # ----------------------------------------------------------------------- #
+
+    def subscribe(self, types=None, channel=None, task=None, importance=None):
+        """
+        A Subscription receiving notifications that match the filters, or
+        None if too many are open already.
+        """
+        self.start()
+        subscription = Subscription(types, channel, task, importance)
+        with self.lock:
+            if len(self.subscribers) >= MAX_SUBSCRIBERS:
+                return None
+            self.subscribers.add(subscription)
+        return subscription
+
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+# --------------------------------------------------------------------------- #
+# Subscriptions                                                               #
+# --------------------------------------------------------------------------- #
+
+class Subscription:
+    """
+    One browser's stream of notifications. Each filter that is set only
+    passes notifications carrying a matching value, so e.g. filtering by
+    task passes no data notifications, which have no task.
+    """
+    def __init__(self, types=None, channel=None, task=None, importance=None):
+        self.types = set(types) if types else None
+        self.filters = {
+            'channel_uuid': channel,
+            'task_uuid': task,
+            'importance': importance,
+        }
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+
+    def matches(self, notification):
+        if self.types is not None and notification['type'] not in self.types:
+            return False
+        return all(notification.get(key) == value
+                   for key, value in self.filters.items()
+                   if value is not None)
+
+
+    def offer(self, notification):
+        if self.matches(notification):
+            try:
+                self.queue.put_nowait(notification)
+            except queue.Full:
+                pass
+
+
+    def get(self, timeout):
+        """
+        The next notification, or None if none arrives within timeout.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+# --------------------------------------------------------------------------- #
+# Notifications                                                               #
+# --------------------------------------------------------------------------- #
+
+def _format_time(timestamp):
+    return timestamp.strftime('%Y-%m-%d %H:%M') if timestamp else 'N/A'
+
+
+def _uuid_of(document):
+    return str(to_uuid(document.uuid)) if document is not None else None
+
+
+def describe(event_name, data):
+    """
+    What a browser needs to show an event's record, as a dict with a 'type'
+    of 'data', 'result' or 'error', or None for events that aren't shown.
+    """
+    if event_name == EVENT_NEW_DATA:
+        record = storage.get_data(uuid=data['record_uuid'])
+        if record is None:
+            return None
+        prefetch([record], "channel.collector")
+        channel = record.channel
+        collector = channel.collector if channel else None
+        return {
+            'type': 'data',
+            'uuid': _uuid_of(record),
+            'time': _format_time(record.timestamp),
+            'friendly_text': (record.friendly_text or '')[:200],
+            'channel_uuid': _uuid_of(channel),
+            'collector_uuid': _uuid_of(collector),
+            'collector_name': collector.name if collector else None,
+        }
+
+    if event_name == EVENT_RESULT_SAVED:
+        result = AnalysisResult.objects(uuid=data['record_uuid']).first()
+        if result is None:
+            return None
+        prefetch([result], "task", "origin_data.channel")
+        # Left as a reference if the record couldn't be found
+        origin = result._data.get('origin_data')
+        channel = None
+        if isinstance(origin, CollectionData):
+            channel = origin.channel
+        return {
+            'type': 'result',
+            'uuid': _uuid_of(result),
+            'time': _format_time(result.timestamp),
+            'name': result.name,
+            'importance': result.importance,
+            'task_uuid': _uuid_of(result.task),
+            'task_name': result.task.name if result.task else None,
+            'channel_uuid': _uuid_of(channel),
+        }
+
+    if event_name == EVENT_NEW_ERROR:
+        return {
+            'type': 'error',
+            'uuid': data.get('error_uuid'),
+            'worker_name': data.get('worker_name'),
+        }
+
+    return None
+
+# --------------------------------------------------------------------------- #
+
+bus = EventBus()
+
+# --------------------------------------------------------------------------- #
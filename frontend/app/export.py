@@ -0,0 +1,302 @@
+from shared.models import (
+    AnalysisResult, AnalysisTask, Analyser, CollectionData, DataChannel,
+    to_uuid
+)
+from shared import archive, storage
+import csv
+import io
+import json
+import zlib
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# --------------------------------------------------------------------------- #
+
+FORMAT_NDJSON  = "ndjson"
+FORMAT_CSV     = "csv"
+FORMAT_PARQUET = "parquet"
+
+FORMATS = [FORMAT_NDJSON, FORMAT_CSV, FORMAT_PARQUET]
+
+MIMETYPES = {
+    FORMAT_NDJSON:  "application/x-ndjson",
+    FORMAT_CSV:     "text/csv",
+    FORMAT_PARQUET: "application/vnd.apache.parquet",
+}
+
+# Records read from the database, and written out, at a time
+BATCH_SIZE = 1000
+
+OLDEST_FIRST = [('timestamp', 1), ('_id', 1)]
+
+# The keys of data exports are those read by backend/replay.py, so exports
+# can be replayed
+DATA_COLUMNS = ['uuid', 'timestamp', 'channel_uid', 'channel_name',
+                'friendly_text', 'payload']
+
+RESULT_COLUMNS = ['uuid', 'timestamp', 'name', 'importance', 'task_uuid',
+                  'task_name', 'analyser_name', 'origin_data_uuid', 'payload']
+
+# --------------------------------------------------------------------------- #
+# Reading                                                                     #
+# --------------------------------------------------------------------------- #
+
+def _batches(cursor):
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _rehydrate(documents):
+    """
+    Restore the archived fields of raw documents from their archive files,
+    in place. Neighbouring records share files, which archive keeps cached.
+    """
+    for document in documents:
+        if not document.get('archive'):
+            continue
+        try:
+            archived = archive.read_batch(document['archive']['path'])
+        except FileNotFoundError:
+            continue
+        restored = archived.get(document['_id'], {})
+        for field in archive.ARCHIVED_FIELDS:
+            if field in restored:
+                document[field] = restored[field]
+
+
+def _lookup(model, ids, known, *fields):
+    """
+    Add the raw documents with the given IDs that aren't already known to
+    known, by ID, with one query.
+    """
+    missing = [value for value in set(ids) if value and value not in known]
+    if missing:
+        for document in (model.objects(id__in=missing).only(*fields)
+                         .as_pymongo()):
+            known[document['_id']] = document
+
+
+def _uuid(document):
+    return str(to_uuid(document['uuid'])) if document else None
+
+
+def data_rows(**filters):
+    """
+    Yield batches of CollectionData matching the filters as export rows,
+    oldest first: the partitions oldest first, then the hot collection.
+    Channels are looked up once each, as they're first seen.
+    """
+    query = CollectionData.objects(**filters)._query
+    channels = {}
+
+    for collection in reversed(storage.data_collections()):
+        cursor = (collection.find(query).sort(OLDEST_FIRST)
+                  .batch_size(BATCH_SIZE))
+        for batch in _batches(cursor):
+            _rehydrate(batch)
+            _lookup(DataChannel,
+                    [document.get('channel') for document in batch],
+                    channels, 'uid', 'name')
+
+            rows = []
+            for document in batch:
+                channel = channels.get(document.get('channel'), {})
+                rows.append({
+                    'uuid': _uuid(document),
+                    'timestamp': document.get('timestamp'),
+                    'channel_uid': channel.get('uid'),
+                    'channel_name': channel.get('name'),
+                    'friendly_text': document.get('friendly_text'),
+                    'payload': document.get('payload', {}),
+                })
+            yield rows
+
+
+def result_rows(**filters):
+    """
+    Yield batches of AnalysisResults matching the filters as export rows,
+    oldest first, with their task, analyser and origin record resolved a
+    batch at a time.
+    """
+    cursor = (AnalysisResult.objects(**filters).order_by('timestamp', 'id')
+              .as_pymongo().batch_size(BATCH_SIZE))
+    tasks = {}
+    analysers = {}
+
+    for batch in _batches(cursor):
+        _rehydrate(batch)
+        _lookup(AnalysisTask, [document.get('task') for document in batch],
+                tasks, 'uuid', 'name')
+        _lookup(Analyser, [document.get('analyser') for document in batch],
+                analysers, 'name')
+
+        # Origin records may be in any partition, so only their UUIDs are
+        # read, and not kept beyond the batch
+        origins = {}
+        remaining = {document.get('origin_data') for document in batch}
+        remaining.discard(None)
+        for collection in storage.data_collections():
+            if not remaining:
+                break
+            for origin in collection.find({'_id': {'$in': list(remaining)}},
+                                          {'uuid': 1}):
+                origins[origin['_id']] = origin
+                remaining.discard(origin['_id'])
+
+        rows = []
+        for document in batch:
+            task = tasks.get(document.get('task'))
+            analyser = analysers.get(document.get('analyser'), {})
+            rows.append({
+                'uuid': _uuid(document),
+                'timestamp': document.get('timestamp'),
+                'name': document.get('name'),
+                'importance': document.get('importance'),
+                'task_uuid': _uuid(task),
+                'task_name': task.get('name') if task else None,
+                'analyser_name': analyser.get('name'),
+                'origin_data_uuid': _uuid(origins.get(
+                    document.get('origin_data'))),
+                'payload': document.get('payload', {}),
+            })
+        yield rows
+
+# --------------------------------------------------------------------------- #
+# Writing                                                                     #
+# --------------------------------------------------------------------------- #
+
+def _timestamp(value):
+    return value.isoformat() + "Z" if value else None
+
+
+def _json(value):
+    # Payloads can hold anything BSON can, such as dates and ObjectIds
+    return json.dumps(value, default=str)
+
+
+def write_ndjson(batches, columns):
+    for rows in batches:
+        yield "".join(
+            _json(dict(row, timestamp=_timestamp(row['timestamp']))) + "\n"
+            for row in rows
+        ).encode()
+
+
+def write_csv(batches, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for rows in batches:
+        for row in rows:
+            writer.writerow([
+                _timestamp(row[column]) if column == 'timestamp'
+                else _json(row[column]) if column == 'payload'
+                else row[column]
+                for column in columns
+            ])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _Sink:
+    """
+    A write-only file that holds what is written until it is drained, so
+    a Parquet file can be streamed out a row group at a time.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+
+    def tell(self):
+        return self.position
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        self.closed = True
+
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def write_parquet(batches, columns):
+    """
+    One row group per batch. Payloads are written as JSON strings, as they
+    don't share a schema.
+    """
+    schema = pyarrow.schema([
+        (column, pyarrow.timestamp('ms') if column == 'timestamp'
+         else pyarrow.string())
+        for column in columns
+    ])
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'),
+                                           schema, compression='zstd')
+
+    for rows in batches:
+        writer.write_table(pyarrow.Table.from_pydict({
+            column: [_json(row[column]) if column == 'payload'
+                     else row[column] for row in rows]
+            for column in columns
+        }, schema=schema))
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {
+    FORMAT_NDJSON:  write_ndjson,
+    FORMAT_CSV:     write_csv,
+    FORMAT_PARQUET: write_parquet,
+}
+
+# --------------------------------------------------------------------------- #
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(batches, columns, export_format, gzip=False):
+    """
+    The bytes of an export of the batches of rows in the given format, as a
+    generator, so only one batch is held in memory at a time.
+    """
+    chunks = WRITERS[export_format](batches, columns)
+    return gzipped(chunks) if gzip else chunks
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,94 @@
+from mongoengine import Document, EmbeddedDocument
+from mongoengine.fields import (
+    EmbeddedDocumentField,
+    ListField,
+    ReferenceField,
+)
+from bson import DBRef, ObjectId
+from shared.models import CollectionData
+from shared import storage
+
+# --------------------------------------------------------------------------- #
+
+def prefetch(documents, *paths):
+    """
+    Resolve the references along each dotted path (e.g. 'channel.collector'
+    or 'triggers.worker') for a whole list of documents before rendering,
+    with one $in query per referenced model at each step, rather than one
+    query per document as a template touches each reference in turn.
+
+    Paths can pass through lists of references and embedded documents.
+    References that no longer exist are left unresolved, so they behave as
+    they would have without prefetching. Returns the documents, as a list.
+    """
+    documents = [document for document in documents if document is not None]
+    for path in paths:
+        level = documents
+        for name in path.split('.'):
+            level = _prefetch_field(level, name)
+    return documents
+
+# --------------------------------------------------------------------------- #
+
+def _reference_id(value):
+    if isinstance(value, ObjectId):
+        return value
+    if isinstance(value, DBRef):
+        return value.id
+    return None
+
+
+def _fetch(model, ids):
+    # CollectionData may be in a partition, so is looked up through storage
+    if issubclass(model, CollectionData):
+        found = storage.get_data_by_ids(list(ids))
+    else:
+        found = model.objects(id__in=list(ids))
+    return {document.id: document for document in found}
+
+
+def _prefetch_field(documents, name):
+    """
+    Resolve one field of the documents, returning what it holds for all of
+    them (the referenced or embedded documents) for the next step.
+    """
+    if not documents:
+        return []
+
+    field = type(documents[0])._fields.get(name)
+    if isinstance(field, ListField):
+        field = field.field
+    if not isinstance(field, (ReferenceField, EmbeddedDocumentField)):
+        raise ValueError(f"Can't prefetch '{name}' of "
+                         f"{type(documents[0]).__name__}")
+
+    values = [document._data.get(name) for document in documents]
+
+    if isinstance(field, ReferenceField):
+        ids = set()
+        for value in values:
+            for item in (value if isinstance(value, list) else [value]):
+                if _reference_id(item) is not None:
+                    ids.add(_reference_id(item))
+
+        fetched = _fetch(field.document_type, ids) if ids else {}
+
+        # Set on _data so the documents aren't marked as changed
+        for document, value in zip(documents, values):
+            if isinstance(value, list):
+                document._data[name] = [
+                    fetched.get(_reference_id(item), item) for item in value
+                ]
+            elif _reference_id(value) is not None:
+                document._data[name] = fetched.get(_reference_id(value),
+                                                   value)
+
+    following = []
+    for document in documents:
+        value = document._data.get(name)
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, (Document, EmbeddedDocument)):
+                following.append(item)
+    return following
+
+# --------------------------------------------------------------------------- #
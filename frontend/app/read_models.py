@@ -0,0 +1,243 @@
+from shared.models import (
+    AnalysisResult,
+    AnalysisTask,
+    Collector,
+    DataChannel,
+    WorkerBase,
+    WorkerError,
+    to_uuid,
+)
+from shared import storage
+
+# --------------------------------------------------------------------------- #
+# Rows                                                                        #
+# --------------------------------------------------------------------------- #
+
+class Row:
+    """
+    A read-only row of a list page, holding just the values its template
+    shows. Slotted, so a page of them costs a few hundred bytes per row
+    rather than a hydrated document with its payload.
+    """
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+# --------------------------------------------------------------------------- #
+
+class DataRow(Row):
+    __slots__ = ('id', 'uuid', 'timestamp', 'friendly_text', 'collector_uuid',
+                 'collector_name')
+
+
+class ResultRow(Row):
+    __slots__ = ('id', 'uuid', 'timestamp', 'name', 'importance', 'task_uuid',
+                 'task_name')
+
+
+class ErrorRow(Row):
+    __slots__ = ('uuid', 'timestamp', 'worker_name', 'error_type',
+                 'error_summary', 'read')
+
+
+class CollectorRow(Row):
+    __slots__ = ('uuid', 'name', 'description', 'entry_count', 'last_data')
+
+
+class ChannelRow(Row):
+    __slots__ = ('uuid', 'name', 'description', 'collector_uuid',
+                 'collector_name', 'entry_count', 'latest_entry_time')
+
+# --------------------------------------------------------------------------- #
+# Row Queries                                                                 #
+# --------------------------------------------------------------------------- #
+
+class RowQuery:
+    """
+    A queryset (or storage.DataQuery) that can be counted and paged by
+    paginate_query() as usual, but reads only the given fields as raw
+    documents when iterated, and turns the page into rows with load().
+    The rows are read once, so templates can test and then loop over them.
+    """
+    def __init__(self, queryset, fields, load):
+        self.queryset = queryset
+        self.fields = fields
+        self.load = load
+        self._rows = None
+
+
+    def count(self):
+        return self.queryset.count()
+
+
+    def filter(self, **filters):
+        self.queryset = self.queryset.filter(**filters)
+        return self
+
+
+    def order_by(self, *keys):
+        self.queryset = self.queryset.order_by(*keys)
+        return self
+
+
+    def skip(self, count):
+        self.queryset = self.queryset.skip(count)
+        return self
+
+
+    def limit(self, count):
+        self.queryset = self.queryset.limit(count)
+        return self
+
+
+    def rows(self):
+        if self._rows is None:
+            documents = list(self.queryset.only(*self.fields).as_pymongo())
+            for document in documents:
+                _read_uuid(document)
+            self._rows = self.load(documents)
+        return self._rows
+
+
+    def __iter__(self):
+        return iter(self.rows())
+
+
+    def __bool__(self):
+        return bool(self.rows())
+
+# --------------------------------------------------------------------------- #
+
+def _read_uuid(document):
+    # Raw UUIDs may be stored as strings or binary (see CompatUUIDField)
+    if document.get('uuid') is not None:
+        document['uuid'] = to_uuid(document['uuid'])
+    return document
+
+
+def _by_id(model, ids, *fields):
+    """
+    Raw documents of a referenced model by ID, read in one query for a whole
+    page rather than dereferenced row by row.
+    """
+    ids = list({id for id in ids if id is not None})
+    if not ids:
+        return {}
+    return {document['_id']: _read_uuid(document) for document in
+            model.objects(id__in=ids).only(*fields).as_pymongo()}
+
+# --------------------------------------------------------------------------- #
+# List Pages                                                                  #
+# --------------------------------------------------------------------------- #
+
+def data_list(**filters):
+    """
+    CollectionData newest first, as DataRows with their collector.
+    """
+    def load(documents):
+        channels = _by_id(DataChannel,
+                          [document.get('channel') for document in documents],
+                          'collector')
+        collectors = _by_id(WorkerBase,
+                            [channel.get('collector')
+                             for channel in channels.values()],
+                            'uuid', 'name')
+        rows = []
+        for document in documents:
+            channel = channels.get(document.get('channel'), {})
+            collector = collectors.get(channel.get('collector'), {})
+            rows.append(DataRow(
+                id=document['_id'],
+                uuid=document['uuid'],
+                timestamp=document.get('timestamp'),
+                friendly_text=document.get('friendly_text'),
+                collector_uuid=collector.get('uuid'),
+                collector_name=collector.get('name'),
+            ))
+        return rows
+
+    return RowQuery(storage.data_query(**filters),
+                    ['uuid', 'timestamp', 'friendly_text', 'channel'], load)
+
+
+def result_list(**filters):
+    """
+    AnalysisResults newest first, as ResultRows with their task.
+    """
+    def load(documents):
+        tasks = _by_id(AnalysisTask,
+                       [document.get('task') for document in documents],
+                       'uuid', 'name')
+        rows = []
+        for document in documents:
+            task = tasks.get(document.get('task'), {})
+            rows.append(ResultRow(
+                id=document['_id'],
+                uuid=document['uuid'],
+                timestamp=document.get('timestamp'),
+                name=document.get('name'),
+                importance=document.get('importance'),
+                task_uuid=task.get('uuid'),
+                task_name=task.get('name'),
+            ))
+        return rows
+
+    return RowQuery(AnalysisResult.objects(**filters).order_by('-timestamp'),
+                    ['uuid', 'timestamp', 'name', 'importance', 'task'], load)
+
+
+def error_list(**filters):
+    """
+    WorkerErrors newest first, as ErrorRows without their tracebacks.
+    """
+    def load(documents):
+        return [ErrorRow(**document) for document in documents]
+
+    return RowQuery(WorkerError.objects(**filters).order_by('-timestamp'),
+                    ['uuid', 'timestamp', 'worker_name', 'error_type',
+                     'error_summary', 'read'], load)
+
+
+def collector_list(**filters):
+    """
+    Collectors, as CollectorRows without their config and metadata.
+    """
+    def load(documents):
+        # Collectors that have never stored data may predate entry_count
+        return [CollectorRow(**{'entry_count': 0, **document})
+                for document in documents]
+
+    return RowQuery(Collector.objects(**filters),
+                    ['uuid', 'name', 'description', 'entry_count',
+                     'last_data'], load)
+
+
+def channel_list(**filters):
+    """
+    DataChannels with the most recent data first, as ChannelRows with their
+    collector. Sorted and paged in the database on the stored statistics;
+    channels without data come last.
+    """
+    def load(documents):
+        collectors = _by_id(WorkerBase,
+                            [document.get('collector')
+                             for document in documents],
+                            'uuid', 'name')
+        rows = []
+        for document in documents:
+            collector = collectors.get(document.get('collector'), {})
+            rows.append(ChannelRow(
+                collector_uuid=collector.get('uuid'),
+                collector_name=collector.get('name'),
+                **{'entry_count': 0, **document}
+            ))
+        return rows
+
+    return RowQuery(DataChannel.objects(**filters)
+                               .order_by('-latest_entry_time'),
+                    ['uuid', 'name', 'description', 'collector',
+                     'entry_count', 'latest_entry_time'], load)
+
+# --------------------------------------------------------------------------- #
@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for
+from flask import Blueprint, render_template, request, jsonify, redirect, url_for, Response
 from flask_wtf import FlaskForm
 from wtforms import StringField, FieldList, FormField
 from mongoengine.errors import DoesNotExist
@@ -11,9 +11,15 @@ from collections import defaultdict
 from shared.models import (
     CollectionData, DataChannel, AnalysisTask, Collector,
     AnalysisResult, Analyser, WorkerError, Topic, WorkerBase,
-    AnalysisTaskTrigger
+    AnalysisTaskTrigger, uuid_forms
 )
-from utils import paginate_query
+from shared import archive, rollups, search, similarity, storage
+from utils import paginate_query, paginate_keyset
+from app import read_models
+from app.prefetch import prefetch
+from app.cache import cache, cached_page, TAG_DATA, TAG_ERRORS
+from app.events import bus, EVENT_ERRORS_READ
+from app import export
 
 main = Blueprint("main", __name__)
 
@@ -27,9 +33,10 @@ def index():
 
 
 @main.route("/home")
+@cached_page(60, TAG_DATA)
 def home():
     most_active_channels = DataChannel.objects.order_by('-latest_entry_time')[:5]
-    most_active_collectors = Collector.objects.order_by('-metadata__last_data')[:5]
+    most_active_collectors = Collector.objects.order_by('-last_data')[:5]
     return render_template(
         "home.html",
         time=int(time.time()),
@@ -45,46 +52,185 @@ def reports():
 
 @main.app_context_processor
 def inject_unread_errors():
-    unread_errors = WorkerError.objects(read=False).count()
+    unread_errors = cache.get_or_set(
+        "unread_errors", lambda: WorkerError.objects(read=False).count(),
+        ttl=60, tags=[TAG_ERRORS]
+    )
     return {'unread_errors': unread_errors}
 
+# --------------------------------------------------------------------------- #
+# Live Event Routes
+# --------------------------------------------------------------------------- #
+
+# Seconds between comments sent to keep idle streams open
+STREAM_KEEPALIVE = 15
+
+
+@main.route("/events/stream")
+def events_stream():
+    """
+    Server-Sent Events of new data, results and errors as they are saved,
+    optionally filtered by type (e.g. types=data,result), channel, task and
+    importance.
+    """
+    types = [name for name in request.args.get("types", "").split(",") if name]
+    subscription = bus.subscribe(
+        types=types,
+        channel=request.args.get("channel"),
+        task=request.args.get("task"),
+        importance=request.args.get("importance")
+    )
+    if subscription is None:
+        return jsonify({"error": "Too many open event streams"}), 503
+
+    def stream():
+        yield "retry: 5000\n\n"
+        while True:
+            notification = subscription.get(timeout=STREAM_KEEPALIVE)
+            if notification is None:
+                # Also finds out when the browser has gone
+                yield ": keepalive\n\n"
+            else:
+                yield (f"event: {notification['type']}\n"
+                       f"data: {json.dumps(notification)}\n\n")
+
+    response = Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    response.call_on_close(lambda: bus.unsubscribe(subscription))
+    return response
+
 # --------------------------------------------------------------------------- #
 # Data Management Routes
 # --------------------------------------------------------------------------- #
 
 @main.route("/data")
 def data():
-    collection_data_entries, total_records, total_pages, current_page, selected_limit = paginate_query(
-        CollectionData.objects.order_by("-timestamp")
+    collection_data_entries, prev_cursor, next_cursor, total_records, selected_limit = paginate_keyset(
+        read_models.data_list(), storage.estimated_count(CollectionData)
     )
     return render_template(
         "data.html",
         time=int(time.time()),
         collection_data=collection_data_entries,
         selected_limit=selected_limit,
-        current_page=current_page,
-        total_pages=total_pages
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        total_records=total_records
     )
 
 
 @main.route("/data/<uuid:data_uuid>")
 def data_entry_detail(data_uuid):
-    data_entry = CollectionData.objects(uuid=data_uuid).first()
+    data_entry = archive.rehydrate(storage.get_data(uuid=data_uuid))
     if not data_entry:
         return render_template("404.html", message=f"Data entry with UUID '{data_uuid}' not found"), 404
+
+    # The similarity store is optional, the page works without it
+    similar = []
+    try:
+        matches = similarity.store.similar_to(data_entry.id, k=10)
+        scores = dict(matches)
+        records = prefetch(storage.get_data_by_ids([record_id for record_id, _ in matches]), "channel")
+        similar = [(record, scores[record.id]) for record in records]
+    except (OSError, ValueError) as err:
+        logging.error(f"Similarity lookup for {data_uuid} failed: {err}")
+
     return render_template(
         "data_entry_detail.html",
         time=int(time.time()),
-        data_entry=data_entry
+        data_entry=data_entry,
+        similar=similar
+    )
+
+# --------------------------------------------------------------------------- #
+# Export Routes
+# --------------------------------------------------------------------------- #
+
+def _export_filters():
+    """
+    The date filters common to every export, from 'since' and 'until' query
+    arguments (ISO 8601, UTC). Raises ValueError if either isn't valid.
+    """
+    filters = {}
+    if request.args.get("since"):
+        filters["timestamp__gte"] = datetime.fromisoformat(request.args["since"])
+    if request.args.get("until"):
+        filters["timestamp__lt"] = datetime.fromisoformat(request.args["until"])
+    return filters
+
+
+def _export_response(name, batches, columns):
+    """
+    Stream an export in the format and compression given by the 'format'
+    (ndjson, csv or parquet) and 'gzip' query arguments.
+    """
+    export_format = request.args.get("format", export.FORMAT_NDJSON)
+    if export_format not in export.FORMATS:
+        return jsonify({"error": f"Unknown export format '{export_format}'"}), 400
+    if export_format == export.FORMAT_PARQUET and export.pyarrow is None:
+        return jsonify({"error": "Parquet exports need pyarrow installed"}), 400
+
+    # Parquet compresses itself
+    gzip = request.args.get("gzip") == "1" and export_format != export.FORMAT_PARQUET
+    filename = f"{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.{export_format}"
+    if gzip:
+        filename += ".gz"
+
+    return Response(
+        export.export(batches, columns, export_format, gzip=gzip),
+        mimetype="application/gzip" if gzip else export.MIMETYPES[export_format],
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
+
+@main.route("/data/export")
+def data_export():
+    try:
+        filters = _export_filters()
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+
+    if request.args.get("channel"):
+        try:
+            channel = DataChannel.objects(uuid=request.args["channel"]).first()
+        except ValueError:
+            return jsonify({"error": f"Invalid channel UUID '{request.args['channel']}'"}), 400
+        if not channel:
+            return jsonify({"error": "Channel not found"}), 404
+        filters["channel"] = channel
+
+    return _export_response("data", export.data_rows(**filters), export.DATA_COLUMNS)
+
+
+@main.route("/results/export")
+def results_export():
+    try:
+        filters = _export_filters()
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+
+    if request.args.get("task"):
+        try:
+            task = AnalysisTask.objects(uuid=request.args["task"]).first()
+        except ValueError:
+            return jsonify({"error": f"Invalid task UUID '{request.args['task']}'"}), 400
+        if not task:
+            return jsonify({"error": "Task not found"}), 404
+        filters["task"] = task
+    if request.args.get("importance"):
+        filters["importance"] = request.args["importance"]
+
+    return _export_response("results", export.result_rows(**filters), export.RESULT_COLUMNS)
+
 # --------------------------------------------------------------------------- #
 # Collector Routes
 # --------------------------------------------------------------------------- #
 
 @main.route("/collectors")
 def collectors():
-    collectors_entries, total_records, total_pages, current_page, selected_limit = paginate_query(Collector.objects)
+    collectors_entries, total_records, total_pages, current_page, selected_limit = paginate_query(read_models.collector_list())
     return render_template(
         "collectors.html",
         time=int(time.time()),
@@ -142,20 +288,23 @@ def analyser_detail(analyser_uuid):
 
 @main.route("/results")
 def analysis_results():
-    analysis_results_entries, total_records, total_pages, current_page, selected_limit = paginate_query(AnalysisResult.objects.order_by("-timestamp"))
+    analysis_results_entries, prev_cursor, next_cursor, total_records, selected_limit = paginate_keyset(
+        read_models.result_list(), storage.estimated_count(AnalysisResult)
+    )
     return render_template(
         "analysis_results.html",
         time=int(time.time()),
         results=analysis_results_entries,
         selected_limit=selected_limit,
-        current_page=current_page,
-        total_pages=total_pages
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        total_records=total_records
     )
 
 
 @main.route("/result/<uuid:result_uuid>")
 def analysis_result_detail(result_uuid):
-    result = AnalysisResult.objects(uuid=result_uuid).first()
+    result = archive.rehydrate(AnalysisResult.objects(uuid=result_uuid).first())
     if not result:
         return render_template("404.html", message=f"Analysis Result with UUID '{result_uuid}' not found"), 404
 
@@ -164,11 +313,18 @@ def analysis_result_detail(result_uuid):
     except DoesNotExist:
         task = None
 
+    # Looked up through the storage layer, as the record may be in a partition
+    origin_data = None
+    origin_id = storage.reference_id(result, 'origin_data')
+    if origin_id is not None:
+        origin_data = archive.rehydrate(storage.get_data(id=origin_id))
+
     return render_template(
         "analysis_result_detail.html",
         time=int(time.time()),
         result=result,
         task=task,
+        origin_data=origin_data,
     )
 
 # --------------------------------------------------------------------------- #
@@ -193,6 +349,7 @@ def task_detail(task_uuid):
     task = AnalysisTask.objects(uuid=task_uuid).first()
     if not task:
         return render_template("404.html", message=f"Task with UUID '{task_uuid}' not found"), 404
+    prefetch([task], "triggers.worker")
     return render_template(
         "task_detail.html",
         time=int(time.time()),
@@ -346,44 +503,12 @@ def new_task_post():
 # Channel Routes
 # --------------------------------------------------------------------------- #
 
-class ListQuerySet:
-    """A wrapper to provide .count(), .skip(), .limit(), and iteration on a list."""
-    def __init__(self, data):
-        self.data = data
-
-    def count(self):
-        return len(self.data)
-
-    def skip(self, num):
-        self.data = self.data[num:]
-        return self
-
-    def limit(self, num):
-        self.data = self.data[:num]
-        return self
-
-    def __iter__(self):
-        return iter(self.data)
-
-
 @main.route("/channels")
+@cached_page(60, TAG_DATA)
 def channels():
-    channels_entries = list(DataChannel.objects())
-    channel_timestamps = {
-        channel.id: CollectionData.objects(channel=channel).order_by("-timestamp").first()
-        for channel in channels_entries
-    }
-    sorted_channels = sorted(
-        channels_entries,
-        key=lambda c: channel_timestamps.get(c.id).timestamp if channel_timestamps.get(c.id) else datetime.min,
-        reverse=True
+    paginated_channels, total_records, total_pages, current_page, selected_limit = paginate_query(
+        read_models.channel_list()
     )
-    sorted_channels_queryset = ListQuerySet(sorted_channels)
-    paginated_channels, total_records, total_pages, current_page, selected_limit = paginate_query(sorted_channels_queryset)
-
-    if not sorted_channels:
-        paginated_channels = None
-
     return render_template(
         "channels.html",
         time=int(time.time()),
@@ -399,7 +524,7 @@ def channel_detail(channel_uuid):
     channel = DataChannel.objects(uuid=channel_uuid).first()
     if not channel:
         return render_template("404.html", message=f"Channel with UUID '{channel_uuid}' not found"), 404
-    collection_entries = CollectionData.objects(channel=channel).order_by("-timestamp").limit(10)
+    collection_entries = storage.data_query(channel=channel).limit(10)
     return render_template(
         "channel_detail.html",
         time=int(time.time()),
@@ -410,16 +535,22 @@ def channel_detail(channel_uuid):
 
 @main.route("/channel/<uuid:channel_uuid>/stats")
 def channel_data_stats(channel_uuid):
-    channel = DataChannel.objects(uuid=str(channel_uuid)).first()
-    end_date = datetime.utcnow().date()
-    start_date = end_date - timedelta(days=29)
-    date_counts = defaultdict(int)
-    entries = CollectionData.objects(channel=channel, timestamp__gte=start_date).only("timestamp")
-    for entry in entries:
-        date_str = entry.timestamp.strftime("%Y-%m-%d")
-        date_counts[date_str] += 1
-    labels = [(start_date + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(30)]
-    values = [date_counts[date] for date in labels]
+    channel = DataChannel.objects(uuid=str(channel_uuid)).only("id").first()
+    if not channel:
+        return jsonify({"error": "Channel not found"}), 404
+
+    # Served from the activity rollups, so the cost doesn't grow with the
+    # amount of data in the channel
+    days = max(1, min(request.args.get("days", 30, type=int), 365))
+    hourly = request.args.get("bucket") == "hour"
+    end = rollups.bucket_start(datetime.utcnow(), rollups.DAY) + timedelta(days=1)
+    buckets = rollups.series(
+        rollups.SCOPE_CHANNEL, channel.id, end - timedelta(days=days), end,
+        bucket_seconds=3600 if hourly else 86400
+    )
+    label_format = "%Y-%m-%d %H:00" if hourly else "%Y-%m-%d"
+    labels = [bucket.strftime(label_format) for bucket, _ in buckets]
+    values = [count for _, count in buckets]
     return jsonify({"labels": labels, "values": values})
 
 # --------------------------------------------------------------------------- #
@@ -447,7 +578,81 @@ def topic_detail(topic_uuid):
     return render_template(
         "topic_detail.html",
         time=int(time.time()),
-        topic=topic
+        topic=topic,
+        channels=prefetch(topic.channels, "collector")
+    )
+
+# --------------------------------------------------------------------------- #
+# Search Routes
+# --------------------------------------------------------------------------- #
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d") if value else None
+    except ValueError:
+        return None
+
+
+@main.route("/search")
+def search_page():
+    query = request.args.get("q", "").strip()
+    kind = request.args.get("kind") or None
+    channel_uuid = request.args.get("channel") or None
+    topic_uuid = request.args.get("topic") or None
+    since = parse_date(request.args.get("since"))
+    until = parse_date(request.args.get("until"))
+
+    channel_ids = None
+    if channel_uuid:
+        channel_ids = [channel.id for channel in DataChannel.objects(uuid=channel_uuid).only("id")]
+    if topic_uuid:
+        topic = Topic.objects(uuid=topic_uuid).first()
+        topic_channels = [channel.id for channel in DataChannel.objects(topics=topic).only("id")] if topic else []
+        channel_ids = topic_channels if channel_ids is None else [c for c in channel_ids if c in topic_channels]
+
+    hits = []
+    error = None
+    total_records = total_pages = 0
+    current_page, selected_limit = 1, 20
+
+    if query:
+        try:
+            page, total_records, total_pages, current_page, selected_limit = paginate_query(
+                search.SearchQuery(query, kind=kind, channels=channel_ids, since=since,
+                                   until=until + timedelta(days=1) if until else None)
+            )
+            matches = list(page)
+        except search.SearchError as err:
+            error = str(err)
+            matches = []
+
+        # Fetch the matched documents in two queries, then restore rank order
+        data_uuids = [uuid for match_kind, uuid in matches if match_kind == search.KIND_DATA]
+        result_uuids = [uuid for match_kind, uuid in matches if match_kind == search.KIND_RESULT]
+        # Matched on every stored form, whether or not UUID_DUAL_READ is on
+        documents = {str(entry.uuid): entry for entry in storage.data_query(__raw__={'uuid': {'$in': uuid_forms(data_uuids)}})} if data_uuids else {}
+        if result_uuids:
+            documents.update({str(result.uuid): result for result in AnalysisResult.objects(__raw__={'uuid': {'$in': uuid_forms(result_uuids)}})})
+        hits = [(match_kind, documents[uuid]) for match_kind, uuid in matches if uuid in documents]
+
+    return render_template(
+        "search.html",
+        time=int(time.time()),
+        query=query,
+        kind=kind,
+        channel_uuid=channel_uuid,
+        topic_uuid=topic_uuid,
+        since=request.args.get("since", ""),
+        until=request.args.get("until", ""),
+        channels=DataChannel.objects.only("uuid", "name").order_by("name"),
+        topics=Topic.objects.only("uuid", "name").order_by("name"),
+        hits=hits,
+        error=error,
+        total_records=total_records,
+        count_limit=search.COUNT_LIMIT,
+        selected_limit=selected_limit,
+        current_page=current_page,
+        total_pages=total_pages
     )
 
 # --------------------------------------------------------------------------- #
@@ -457,7 +662,7 @@ def topic_detail(topic_uuid):
 @main.route("/errors")
 def errors():
     errors_entries, total_records, total_pages, current_page, selected_limit = paginate_query(
-        WorkerError.objects.order_by("-timestamp")
+        read_models.error_list()
     )
     return render_template(
         "errors.html",
@@ -472,79 +677,14 @@ def errors():
 @main.route("/error/<uuid:error_uuid>")
 def error_detail(error_uuid):
     error = WorkerError.objects(uuid=error_uuid).first()
-    error.read = True
-    error.save()
     if not error:
         return render_template("404.html", message=f"Error entry with UUID '{error_uuid}' not found"), 404
+    if not error.read:
+        error.read = True
+        error.save()
+        cache.notify(EVENT_ERRORS_READ)
     return render_template(
         "error_detail.html",
         time=int(time.time()),
         error=error
     )
-
-# --------------------------------------------------------------------------- #
-# JSON Endpoints                                                              #
-# --------------------------------------------------------------------------- #
-
-@main.route("/workers/json")
-def workers_json():
-    workers = WorkerBase.objects()
-    print(workers.to_json())
-    return jsonify(json.loads(workers.to_json()))
-
-
-@main.route("/worker/<uuid:worker_uuid>/json")
-def worker_json(worker_uuid):
-    worker = WorkerBase.objects(uuid=worker_uuid).first()
-    if not worker:
-        return render_template("404.html", message=f"Worker with UUID '{worker_uuid}' not found"), 404
-    return jsonify(json.loads(worker.to_json()))
-
-
-@main.route("/analysers/json")
-def analysers_json():
-    analysers = Analyser.objects()
-    print(analysers.to_json())
-    return jsonify(json.loads(analysers.to_json()))
-
-
-@main.route("/analyser/<uuid:analyser_uuid>/json")
-def analyser_json(analyser_uuid):
-    analyser = Analyser.objects(uuid=analyser_uuid).first()
-    if not analyser:
-        return render_template("404.html", message=f"Analyser with UUID '{analyser_uuid}' not found"), 404
-    return jsonify(json.loads(analyser.to_json()))
-
-
-@main.route("/collectors/json")
-def collectors_json():
-    collectors = Collector.objects()
-    return jsonify(collectors)
-
-
-@main.route("/collector/<uuid:collector_uuid>/json")
-def collector_json(collector_uuid):
-    collector = Analyser.objects(uuid=collector_uuid).first()
-    if not collector:
-        return render_template("404.html", message=f"Analyser with UUID '{collector_uuid}' not found"), 404
-    return jsonify(json.loads(collector.to_json()))
-
-
-@main.route("/tasks/json")
-def tasks_json():
-    tasks = Tasks.objects()
-    return jsonify(tasks)
-
-
-@main.route("/task/<uuid:task_uuid>/json")
-def task_json(task_uuid):
-    task = AnalysisTask.objects(uuid=task_uuid).first()
-    if not task:
-        return render_template("404.html", message=f"Task with UUID '{task_uuid}' not found"), 404
-
-    # Dirty hack until I bin off UUIDs and replace them with native IDs
-    task_dict = json.loads(task.to_json())
-    for index, trigger in enumerate(task_dict['triggers']):
-        task_dict['triggers'][index]['worker_uuid'] = task.triggers[index].worker.uuid;
-
-    return jsonify(task_dict)
@@ -37,7 +37,7 @@ function warningModal(title, message) {
 
 async function getAnalyserParameters(analyserUuid) {
     try {
-        const response = await fetch(`/analyser/${analyserUuid}/json`);
+        const response = await fetch(`/analyser/${analyserUuid}/json?fields=task_parameters`);
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
@@ -55,7 +55,7 @@ async function getAnalyserParameters(analyserUuid) {
 
 async function getAnalysisTaskInfo(taskUuid) {
     try {
-        const response = await fetch(`/task/${taskUuid}/json`);
+        const response = await fetch(`/task/${taskUuid}/json?fields=triggers`);
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
@@ -71,7 +71,7 @@ async function getAnalysisTaskInfo(taskUuid) {
 
 async function getWorkerInfo(workerUuid) {
     try {
-        const response = await fetch(`/worker/${workerUuid}/json`);
+        const response = await fetch(`/worker/${workerUuid}/json?fields=name`);
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
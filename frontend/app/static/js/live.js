@@ -0,0 +1,103 @@
+/* ------------------------------------------------------------------------- */
+/* On Load                                                                   */
+/* ------------------------------------------------------------------------- */
+
+document.addEventListener("DOMContentLoaded", function () {
+    document.querySelectorAll("tbody[data-live]").forEach(listenForRows);
+});
+
+/* ------------------------------------------------------------------------- */
+/* Live Rows                                                                 */
+/* ------------------------------------------------------------------------- */
+
+// Prepend rows to a list as records are saved, from /events/stream. The
+// tbody's data-live names the type of record, and data-live-channel,
+// data-live-task and data-live-importance optionally filter them.
+function listenForRows(tbody) {
+    const type = tbody.dataset.live;
+    const limit = parseInt(tbody.dataset.liveLimit, 10) || 20;
+
+    const params = new URLSearchParams({ types: type });
+    ["channel", "task", "importance"].forEach(name => {
+        const value = tbody.dataset["live" + name[0].toUpperCase() + name.slice(1)];
+        if (value) {
+            params.set(name, value);
+        }
+    });
+
+    const source = new EventSource(`/events/stream?${params}`);
+    source.addEventListener(type, event => {
+        const record = JSON.parse(event.data);
+        const row = type === "result" ? resultRow(record) : dataRow(record);
+
+        tbody.querySelectorAll("[data-live-empty]").forEach(el => el.closest("tr").remove());
+        tbody.prepend(row);
+
+        // Keep the page the same length
+        while (tbody.rows.length > limit) {
+            tbody.deleteRow(-1);
+        }
+    });
+
+    window.addEventListener("beforeunload", () => source.close());
+}
+
+/* ------------------------------------------------------------------------- */
+
+function cell(className, ...children) {
+    const td = document.createElement("td");
+    if (className) {
+        td.className = className;
+    }
+    td.append(...children);
+    return td;
+}
+
+/* ------------------------------------------------------------------------- */
+
+function link(href, text) {
+    const a = document.createElement("a");
+    a.href = href;
+    a.textContent = text;
+    return a;
+}
+
+/* ------------------------------------------------------------------------- */
+
+function dataRow(record) {
+    const tr = document.createElement("tr");
+    tr.append(
+        cell("text-muted", record.time),
+        cell(null, link(`/data/${record.uuid}`,
+                        record.friendly_text || "No preview available")),
+        cell(null, link(`/collector/${record.collector_uuid}`,
+                        record.collector_name || ""))
+    );
+    return tr;
+}
+
+/* ------------------------------------------------------------------------- */
+
+function resultRow(record) {
+    const importance = document.createElement("i");
+    importance.className = "fas fa-circle " +
+        (record.importance === "high" ? "text-danger" : "text-secondary");
+    importance.style.cssText = "font-size: 8px; vertical-align: middle; margin-right: 5px;";
+
+    const time = cell("text-muted align-middle", record.time);
+    time.style.fontSize = "9pt";
+    const task = cell(null, link(`/task/${record.task_uuid}`,
+                                 record.task_name || ""));
+    task.style.fontSize = "9pt";
+
+    const tr = document.createElement("tr");
+    tr.append(
+        time,
+        cell("text-muted", importance),
+        cell(null, link(`/result/${record.uuid}`, record.name)),
+        task
+    );
+    return tr;
+}
+
+/* ------------------------------------------------------------------------- */
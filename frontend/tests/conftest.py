@@ -0,0 +1,15 @@
+import os
+import sys
+
+# --------------------------------------------------------------------------- #
+
+# The frontend imports 'app' from frontend/ and 'shared' from the repository
+# root (both live under /app in the container), so the tests can be run from
+# either directory
+FRONTEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for path in [os.path.dirname(FRONTEND), FRONTEND]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# --------------------------------------------------------------------------- #
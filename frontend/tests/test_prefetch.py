@@ -0,0 +1,62 @@
+import mongomock
+import pytest
+from mongoengine import connect, disconnect
+from shared.models import Collector, CollectionData, DataChannel
+from app.prefetch import prefetch
+
+# --------------------------------------------------------------------------- #
+
+@pytest.fixture
+def database():
+    connect("silvermoon-test", host="mongodb://localhost",
+            mongo_client_class=mongomock.MongoClient)
+    yield
+    disconnect()
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """
+    Counts the find() calls made to the database.
+    """
+    calls = []
+    find = mongomock.collection.Collection.find
+
+    def counting_find(self, *args, **kwargs):
+        calls.append(self.name)
+        return find(self, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock.collection.Collection, "find",
+                        counting_find)
+    return calls
+
+# --------------------------------------------------------------------------- #
+
+def make_records(count):
+    """
+    count records spread over a channel per record and a collector per two
+    channels, so every reference is to a different document.
+    """
+    collectors = [Collector(name=f"collector-{i}").save()
+                  for i in range(count // 2)]
+    for i in range(count):
+        channel = DataChannel(uid=str(i), name=f"channel-{i}",
+                              collector=collectors[i // 2]).save()
+        CollectionData(channel=channel, payload={'id': i}).save()
+    return list(CollectionData.objects())
+
+
+@pytest.mark.parametrize("count", [20, 40])
+def test_prefetch_query_count_is_constant(database, queries, count):
+    records = make_records(count)
+    del queries[:]
+
+    prefetch(records, "channel.collector")
+    # One query for the channels and one for their collectors
+    assert len(queries) == 2
+
+    names = {record.channel.collector.name for record in records}
+    assert len(names) == count // 2
+    assert len(queries) == 2
+
+# --------------------------------------------------------------------------- #
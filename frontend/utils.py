@@ -1,4 +1,10 @@
+import base64
+import binascii
+import datetime
+import json
 import math
+from bson import ObjectId
+from bson.errors import InvalidId
 from flask import request
 
 def paginate_query(queryset, limit_default=20):
@@ -19,3 +25,80 @@ def paginate_query(queryset, limit_default=20):
     paginated_results = queryset.skip(skip).limit(limit)
 
     return paginated_results, total_records, total_pages, page, limit
+
+
+def encode_cursor(direction, record):
+    """
+    An opaque cursor for the page before or after a record, from its
+    position in (timestamp, _id) order.
+    """
+    position = [direction, record.timestamp.isoformat(), str(record.id)]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    The direction, timestamp and ID in a cursor, or None if it isn't valid.
+    """
+    try:
+        direction, timestamp, record_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()))
+        if direction not in ("next", "prev"):
+            return None
+        return (direction, datetime.datetime.fromisoformat(timestamp),
+                ObjectId(record_id))
+    except (binascii.Error, ValueError, TypeError, InvalidId):
+        return None
+
+
+def paginate_keyset(queryset, total_records=None, limit_default=20):
+    """
+    Page through a queryset newest first by (timestamp, _id), starting each
+    page from the record the previous one ended on rather than skipping
+    over every record before it. Every page, however deep, costs the same
+    as the first. The queryset needs filter(), order_by() and limit(), and
+    a ['-timestamp', '-id'] index to page on.
+
+    Pages are addressed by opaque 'cursor' query arguments. Nothing is
+    counted; callers can pass an estimated total_records to show instead.
+    Returns the page, the cursors of the pages before and after it (None
+    at either end), the total and the limit.
+    """
+    limit = max(1, min(int(request.args.get("limit", limit_default)), 100))
+    position = decode_cursor(request.args.get("cursor", ""))
+
+    if position is None:
+        direction = "next"
+        page = queryset.order_by('-timestamp', '-id')
+    else:
+        direction, timestamp, record_id = position
+        # Bounded on timestamp alone so the index range scan does the work,
+        # with _id breaking ties between records at the same time
+        if direction == "next":
+            page = queryset.filter(__raw__={
+                'timestamp': {'$lte': timestamp},
+                '$or': [{'timestamp': {'$lt': timestamp}},
+                        {'_id': {'$lt': record_id}}],
+            }).order_by('-timestamp', '-id')
+        else:
+            page = queryset.filter(__raw__={
+                'timestamp': {'$gte': timestamp},
+                '$or': [{'timestamp': {'$gt': timestamp}},
+                        {'_id': {'$gt': record_id}}],
+            }).order_by('timestamp', 'id')
+
+    # One extra record says whether there is another page in this direction
+    results = list(page.limit(limit + 1))
+    more = len(results) > limit
+    results = results[:limit]
+    if direction == "prev":
+        results.reverse()
+
+    next_cursor = prev_cursor = None
+    if results:
+        if more or direction == "prev":
+            next_cursor = encode_cursor("next", results[-1])
+        if position is not None and (more or direction == "next"):
+            prev_cursor = encode_cursor("prev", results[0])
+
+    return results, prev_cursor, next_cursor, total_records, limit
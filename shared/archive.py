@@ -0,0 +1,121 @@
+from bson import json_util
+import datetime
+import functools
+import logging
+import os
+import uuid
+import zstandard
+
+# --------------------------------------------------------------------------- #
+
+ARCHIVE_PATH = os.environ.get('ARCHIVE_PATH', '/data/archive')
+
+# Length of friendly_text kept on CollectionData stubs, for list pages
+PREVIEW_LENGTH = 200
+
+# Fields removed from archived records, the bulk of their size. Everything
+# else stays, so stubs still list, sort and deduplicate like live records.
+ARCHIVED_FIELDS = ['payload', 'metadata', 'display', 'friendly_text']
+
+# --------------------------------------------------------------------------- #
+# Archive Files                                                               #
+# --------------------------------------------------------------------------- #
+
+def write_batch(kind, documents, root=ARCHIVE_PATH):
+    """
+    Write raw documents to a new zstd-compressed NDJSON archive file, one
+    extended JSON document per line so types round-trip. Files are grouped
+    by kind and month archived, and written to a temporary name first so
+    readers never see a partial file. Returns the path relative to root.
+    """
+    now = datetime.datetime.utcnow()
+    relative_path = os.path.join(kind, f"{now:%Y}", f"{now:%m}",
+                                 f"{uuid.uuid4().hex}.ndjson.zst")
+    path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    lines = b"".join(json_util.dumps(document).encode() + b"\n"
+                     for document in documents)
+    compressed = zstandard.ZstdCompressor(level=10).compress(lines)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(compressed)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+    return relative_path
+
+
+@functools.lru_cache(maxsize=16)
+def read_batch(relative_path, root=ARCHIVE_PATH):
+    """
+    Every document in an archive file, by ID. Recently read files are kept
+    in memory, as neighbouring records are often viewed together.
+    """
+    with open(os.path.join(root, relative_path), 'rb') as file:
+        lines = zstandard.ZstdDecompressor().decompress(file.read())
+
+    documents = {}
+    for line in lines.splitlines():
+        if line:
+            document = json_util.loads(line)
+            documents[document['_id']] = document
+    return documents
+
+# --------------------------------------------------------------------------- #
+# Stubs                                                                       #
+# --------------------------------------------------------------------------- #
+
+def stub_update(document, relative_path):
+    """
+    The update turning a raw document into a stub pointing at its archive.
+    """
+    update = {
+        '$set': {
+            'archive': {
+                'path': relative_path,
+                'archived_at': datetime.datetime.utcnow(),
+            },
+        },
+        '$unset': {field: "" for field in ARCHIVED_FIELDS
+                   if field in document},
+    }
+    preview = document.get('friendly_text')
+    if preview:
+        del update['$unset']['friendly_text']
+        update['$set']['friendly_text'] = preview[:PREVIEW_LENGTH]
+
+    # Mongo 4.4 rejects an empty $unset
+    if not update['$unset']:
+        del update['$unset']
+    return update
+
+
+def rehydrate(record):
+    """
+    Restore an archived StoredData record's fields from its archive file,
+    in place. Records that aren't archived are returned unchanged, as are
+    those whose archive file is missing, which are logged.
+    """
+    if record is None or not record.archive:
+        return record
+
+    try:
+        document = read_batch(record.archive['path']).get(record.id)
+    except FileNotFoundError:
+        document = None
+
+    if document is None:
+        logging.error(f"Archive of {type(record).__name__} {record.uuid} not "
+                      f"found in '{record.archive['path']}'")
+        return record
+
+    restored = type(record)._from_son(document)
+    for field in ARCHIVED_FIELDS:
+        if field in record._fields:
+            setattr(record, field, getattr(restored, field))
+    return record
+
+# --------------------------------------------------------------------------- #
@@ -1,6 +1,8 @@
 import datetime
 import logging
+import os
 import uuid
+from bson import Binary
 from mongoengine import (
     Document,
     EmbeddedDocument,
@@ -13,6 +15,8 @@ from mongoengine import (
     UUIDField,
     BooleanField,
     EmbeddedDocumentField,
+    ObjectIdField,
+    QuerySet,
 )
 
 # --------------------------------------------------------------------------- #
@@ -20,6 +24,143 @@ from mongoengine import (
 logging.getLogger().setLevel(logging.DEBUG)
 logging.getLogger("pymongo").setLevel(logging.WARNING)
 
+# --------------------------------------------------------------------------- #
+
+# How StoredData is laid out in the database (see shared/storage.py):
+#
+#   shared      - CollectionData and AnalysisResult share 'stored_data'
+#   split       - They each have their own collection, without _cls
+#   partitioned - As split, but CollectionData older than STORAGE_HOT_MONTHS
+#                 is rolled over into a collection per month
+LAYOUT_SHARED      = "shared"
+LAYOUT_SPLIT       = "split"
+LAYOUT_PARTITIONED = "partitioned"
+
+STORAGE_LAYOUT = os.environ.get('STORAGE_LAYOUT', LAYOUT_SHARED)
+
+# How UUIDs are written (see CompatUUIDField):
+#
+#   string - 36-character strings, as originally stored
+#   binary - 16-byte BSON binary (subtype 4), less than half the size in
+#            documents and indexes
+UUID_STRING = "string"
+UUID_BINARY = "binary"
+
+UUID_STORAGE = os.environ.get('UUID_STORAGE', UUID_STRING)
+
+# Whether UUID lookups match both forms, while 'manage.py convert-uuids' is
+# moving stored UUIDs from one to the other. Can be turned off once done.
+UUID_DUAL_READ = os.environ.get('UUID_DUAL_READ', '1') == '1'
+
+# --------------------------------------------------------------------------- #
+# UUIDs                                                                       #
+# --------------------------------------------------------------------------- #
+
+def to_uuid(value):
+    """
+    A uuid.UUID from a UUID in any stored or submitted form: a string, a
+    BSON binary or a UUID.
+    """
+    if isinstance(value, uuid.UUID):
+        return value
+    if isinstance(value, Binary):
+        return value.as_uuid()
+    return uuid.UUID(str(value))
+
+
+def stored_uuid(value, storage=None):
+    """
+    A UUID in the form it is written to the database, per UUID_STORAGE.
+    """
+    value = to_uuid(value)
+    if (storage or UUID_STORAGE) == UUID_BINARY:
+        return Binary.from_uuid(value)
+    return str(value)
+
+
+def uuid_forms(values):
+    """
+    Every form the given UUIDs may be stored in, for raw $in queries.
+    """
+    forms = []
+    for value in values:
+        forms += [stored_uuid(value, UUID_BINARY),
+                  stored_uuid(value, UUID_STRING)]
+    return forms
+
+# --------------------------------------------------------------------------- #
+
+class CompatUUIDField(UUIDField):
+    """
+    A UUIDField that reads UUIDs stored as strings or as BSON binary, and
+    writes them as set by UUID_STORAGE. Values are always uuid.UUIDs.
+
+    With UUID_DUAL_READ, equality lookups (uuid=...) match both forms, so
+    records are found whichever side of a conversion they are on, as do
+    __in and __nin lookups on models using CompatQuerySet. Other operators
+    only match the form being written; raw queries can use uuid_forms().
+    """
+    def __init__(self, **kwargs):
+        super().__init__(binary=False, **kwargs)
+
+    def to_python(self, value):
+        try:
+            return to_uuid(value)
+        except (ValueError, TypeError, AttributeError):
+            return value
+
+    def to_mongo(self, value):
+        return stored_uuid(value)
+
+    def prepare_query_value(self, op, value):
+        if value is None:
+            return None
+        if op is None and UUID_DUAL_READ:
+            return {'$in': uuid_forms([value])}
+        return self.to_mongo(value)
+
+# --------------------------------------------------------------------------- #
+
+def _widen_uuid_lists(query, keys):
+    """
+    The query with the $in and $nin lists of the given keys widened to
+    every form their UUIDs may be stored in.
+    """
+    if isinstance(query, list):
+        return [_widen_uuid_lists(part, keys) for part in query]
+    if not isinstance(query, dict):
+        return query
+
+    widened = {}
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            value = _widen_uuid_lists(value, keys)
+        elif key in keys and isinstance(value, dict):
+            value = {op: uuid_forms(operand)
+                     if op in ('$in', '$nin') and isinstance(operand, list)
+                     else operand
+                     for op, operand in value.items()}
+        widened[key] = value
+    return widened
+
+
+class CompatQuerySet(QuerySet):
+    """
+    The QuerySet of models with CompatUUIDFields. With UUID_DUAL_READ, their
+    __in and __nin lookups match both stored forms. mongoengine prepares
+    those values one at a time, so the field can't widen them itself.
+    """
+    @property
+    def _query(self):
+        if self._mongo_query is None:
+            query = super()._query
+            if UUID_DUAL_READ:
+                keys = {field.db_field
+                        for field in self._document._fields.values()
+                        if isinstance(field, CompatUUIDField)}
+                self._mongo_query = _widen_uuid_lists(query, keys)
+        return self._mongo_query
+
 # --------------------------------------------------------------------------- #
 # Worker Definitions                                                          #
 # --------------------------------------------------------------------------- #
@@ -30,7 +171,7 @@ class WorkerBase(Document):
     Both worker types share many of the same values, and can both be acted upon
     by an analyser.
     """
-    uuid = UUIDField(binary=False, default=uuid.uuid4, unique=True)
+    uuid = CompatUUIDField(default=uuid.uuid4, unique=True)
     name = StringField(max_length=255, required=True)
     description = StringField(required=False)
     config = DictField()
@@ -39,6 +180,8 @@ class WorkerBase(Document):
     meta = {
         'allow_inheritance': True,
         'collection': 'worker',
+        'queryset_class': CompatQuerySet,
+        'indexes': ['name'],
     }
 
     def get_config(self, name):
@@ -56,17 +199,12 @@ class Collector(WorkerBase):
     and saves it into the database (as CollectionData) for later processing or
     review.
     """
-
-    @property
-    def last_data(self):
-        channels = DataChannel.objects(collector=self)
-        last_entry = CollectionData.objects(channel__in=channels).order_by('-timestamp').first()
-        return last_entry.timestamp if last_entry else None
-
-    @property
-    def entry_count(self):
-        channels = DataChannel.objects(collector=self)
-        return CollectionData.objects(channel__in=channels).count()
+    # Statistics kept up to date by the collector as it stores data, so they
+    # can be listed and sorted on without querying the data itself. They can
+    # be recomputed from scratch with 'manage.py repair-stats'.
+    entry_count = IntField(default=0)
+    last_data = DateTimeField()
+    channel_count = IntField(default=0)
 
 # --------------------------------------------------------------------------- #
 
@@ -99,17 +237,27 @@ class StoredData(Document):
     (AnalysisResult). Both contain their core information within a 'payload'
     field, and additional information in a 'metadata' field.
     """
-    uuid = UUIDField(binary=False, default=uuid.uuid4, unique=True)
+    uuid = CompatUUIDField(default=uuid.uuid4, unique=True)
     name = StringField()
     timestamp = DateTimeField(default=datetime.datetime.utcnow)
     payload = DictField()
     metadata = DictField()
     display = DictField()
-
-    meta = {
-        'allow_inheritance': True,
-        'collection': 'stored_data',
-    }
+    # Set once the record has been moved to the cold archive, leaving this
+    # as a stub without its payload (see shared/archive.py)
+    archive = DictField()
+
+    if STORAGE_LAYOUT == LAYOUT_SHARED:
+        meta = {
+            'allow_inheritance': True,
+            'collection': 'stored_data',
+            'queryset_class': CompatQuerySet,
+        }
+    else:
+        meta = {
+            'abstract': True,
+            'queryset_class': CompatQuerySet,
+        }
 
 # --------------------------------------------------------------------------- #
 
@@ -122,6 +270,25 @@ class CollectionData(StoredData):
     """
     friendly_text = StringField()
     channel = ReferenceField("DataChannel", required=True)
+    # Identifies the item at its source (e.g. a Telegram message ID), so the
+    # same item is only stored once per channel. Not set by every collector.
+    natural_key = StringField()
+
+    # Indexes on subclasses of StoredData are prefixed with _cls, in the
+    # shared layout
+    meta = {
+        'indexes': [
+            {
+                'fields': ['channel', 'natural_key'],
+                'unique': True,
+                'partialFilterExpression': {'natural_key': {'$exists': True}},
+            },
+            ['channel', '-timestamp'],
+            ['-timestamp', '-id'],
+        ],
+    }
+    if STORAGE_LAYOUT != LAYOUT_SHARED:
+        meta['collection'] = 'collection_data'
 
 # --------------------------------------------------------------------------- #
 
@@ -139,9 +306,22 @@ class AnalysisResult(StoredData):
     task = ReferenceField("AnalysisTask", required=True)
     # Reference to the CollectionData this was generated from
     origin_data = ReferenceField("CollectionData", required=True)
+    # References to every CollectionData this was generated from, for results
+    # produced from a window of records (origin_data is the latest of these)
+    origin_records = ListField(ReferenceField("CollectionData"))
     # Reference to the AnalysisResult this was generated from (optional)
     origin_analysis_result = ReferenceField('self', null=True)
 
+    meta = {
+        'indexes': [
+            ['-timestamp', '-id'],
+            ['task', '-timestamp'],
+            'origin_data',
+        ],
+    }
+    if STORAGE_LAYOUT != LAYOUT_SHARED:
+        meta['collection'] = 'analysis_result'
+
 # --------------------------------------------------------------------------- #
 # Analysis Tasks and Triggers                                                 #
 # --------------------------------------------------------------------------- #
@@ -173,7 +353,7 @@ class AnalysisTaskTrigger(EmbeddedDocument):
 # --------------------------------------------------------------------------- #
 
 class AnalysisTask(Document):
-    uuid = UUIDField(binary=False, default=uuid.uuid4, unique=True)
+    uuid = CompatUUIDField(default=uuid.uuid4, unique=True)
     name = StringField(max_length=255, required=True)
     description = StringField(max_length=500, required=False)
     # Link to the Analyser that will be tasked
@@ -192,7 +372,11 @@ class AnalysisTask(Document):
     # fire.
     triggers = ListField(EmbeddedDocumentField("AnalysisTaskTrigger"))
 
-    meta = {'collection': 'analysis_task'}
+    meta = {
+        'collection': 'analysis_task',
+        'queryset_class': CompatQuerySet,
+        'indexes': [['analyser', 'triggers.events']],
+    }
 
 # --------------------------------------------------------------------------- #
 # Data Categorisation                                                         #
@@ -203,11 +387,17 @@ class Topic(Document):
     A thematic label/category, e.g. 'ukraine-war', 'financial-news'.
     A channel or an analysis requirement can link to multiple topics.
     """
-    uuid = UUIDField(binary=False, default=uuid.uuid4, unique=True)
+    uuid = CompatUUIDField(default=uuid.uuid4, unique=True)
     name = StringField(max_length=100, required=True, unique=True)
     description = StringField(max_length=500)
+    # Days to keep data from the topic's channels before archiving it. Used
+    # for channels without their own retention_days; the longest applies.
+    retention_days = IntField()
 
-    meta = {'collection': 'topic'}
+    meta = {
+        'collection': 'topic',
+        'queryset_class': CompatQuerySet,
+    }
 
     @property
     def channels(self):
@@ -216,31 +406,69 @@ class Topic(Document):
 # --------------------------------------------------------------------------- #
 
 class DataChannel(Document):
-    uuid = UUIDField(binary=False, default=uuid.uuid4, unique=True)
+    uuid = CompatUUIDField(default=uuid.uuid4, unique=True)
     uid = StringField(max_length=255, required=True)
     name = StringField(max_length=255, required=True)
     description = StringField(required=False)
     collector = ReferenceField("Collector", required=True)
     topics = ListField(ReferenceField("Topic"))
     metadata = DictField()
+    # False once the channel is no longer available to its collector
+    active = BooleanField(default=True)
+    # Days to keep the channel's data before archiving it, overriding its
+    # topics' retention_days. Kept forever if neither is set.
+    retention_days = IntField()
+    # Statistics kept up to date by the collector, as on Collector
+    entry_count = IntField(default=0)
+    latest_entry_time = DateTimeField()
 
-    meta = {'collection': 'data_channel'}
+    meta = {
+        'collection': 'data_channel',
+        'queryset_class': CompatQuerySet,
+        'indexes': [
+            ['collector', 'uid'],
+            'uid',
+            'topics',
+            '-latest_entry_time',
+        ],
+    }
 
-    @property
-    def entry_count(self):
-        return CollectionData.objects(channel=self).count()
+# --------------------------------------------------------------------------- #
+# Statistics                                                                  #
+# --------------------------------------------------------------------------- #
 
-    @property
-    def latest_entry_time(self):
-        latest_entry = CollectionData.objects(channel=self).order_by('-timestamp').first()
-        return latest_entry.timestamp if latest_entry else None
+class ActivityRollup(Document):
+    """
+    The number of CollectionData records stored in one hour or day (UTC) for
+    a channel, collector or topic. Incremented as data is stored, so activity
+    charts never have to read the data itself (see shared/rollups.py).
+    """
+    # What is counted ['channel', 'collector', 'topic']
+    scope = StringField(required=True)
+    # The ID of the DataChannel, Collector or Topic
+    scope_id = ObjectIdField(required=True)
+    # Size of the bucket ['hour', 'day']
+    granularity = StringField(required=True)
+    # Start of the bucket
+    bucket = DateTimeField(required=True)
+    count = IntField(default=0)
+
+    meta = {
+        'collection': 'activity_rollup',
+        'indexes': [
+            {
+                'fields': ['scope', 'scope_id', 'granularity', 'bucket'],
+                'unique': True,
+            },
+        ],
+    }
 
 # --------------------------------------------------------------------------- #
 # Miscellaneous                                                               #
 # --------------------------------------------------------------------------- #
 
 class WorkerError(Document):
-    uuid = UUIDField(binary=False, default=uuid.uuid4, unique=True)
+    uuid = CompatUUIDField(default=uuid.uuid4, unique=True)
     worker_name = StringField(max_length=255, required=True)
     error_summary = StringField(required=True)
     error_type = StringField(max_length=255, required=True)
@@ -249,7 +477,15 @@ class WorkerError(Document):
     metadata = DictField()
     read = BooleanField(default=False)
 
-    meta = {'collection': 'worker_error', 'ordering': ['-timestamp']}
+    meta = {
+        'collection': 'worker_error',
+        'queryset_class': CompatQuerySet,
+        'ordering': ['-timestamp'],
+        'indexes': [
+            '-timestamp',
+            ['read', '-timestamp'],
+        ],
+    }
 
 # --------------------------------------------------------------------------- #
 
@@ -0,0 +1,201 @@
+from shared.models import (
+    ActivityRollup,
+    CollectionData,
+    DataChannel,
+)
+from shared import storage
+from collections import Counter, defaultdict
+from pymongo import UpdateOne
+import datetime
+import logging
+
+# --------------------------------------------------------------------------- #
+
+SCOPE_CHANNEL   = "channel"
+SCOPE_COLLECTOR = "collector"
+SCOPE_TOPIC     = "topic"
+
+HOUR = "hour"
+DAY  = "day"
+
+GRANULARITY_SECONDS = {
+    HOUR: 3600,
+    DAY: 86400,
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# --------------------------------------------------------------------------- #
+# Buckets                                                                     #
+# --------------------------------------------------------------------------- #
+
+def bucket_start(timestamp, granularity):
+    if granularity == DAY:
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def granularity_for(bucket_seconds):
+    """
+    The coarsest stored granularity that bucket_seconds can be built from.
+    """
+    if bucket_seconds % GRANULARITY_SECONDS[DAY] == 0:
+        return DAY
+    if bucket_seconds % GRANULARITY_SECONDS[HOUR] == 0:
+        return HOUR
+    raise ValueError("Bucket size must be a whole number of hours")
+
+# --------------------------------------------------------------------------- #
+# Recording                                                                   #
+# --------------------------------------------------------------------------- #
+
+def _increments(scopes, timestamps):
+    counts = Counter()
+    for timestamp in timestamps:
+        for granularity in GRANULARITY_SECONDS:
+            bucket = bucket_start(timestamp, granularity)
+            for scope, scope_id in scopes:
+                counts[(scope, scope_id, granularity, bucket)] += 1
+    return counts
+
+
+def record_activity(channel_id, collector_id, topic_ids, timestamps):
+    """
+    Count newly stored records, given by their timestamps, into the hourly
+    and daily rollups of their channel, its collector and its topics. A
+    single bulk write of $inc upserts, so it is safe from any number of
+    concurrent collectors.
+    """
+    scopes = [(SCOPE_CHANNEL, channel_id), (SCOPE_COLLECTOR, collector_id)]
+    scopes += [(SCOPE_TOPIC, topic_id) for topic_id in topic_ids]
+
+    operations = [
+        UpdateOne({'scope': scope, 'scope_id': scope_id,
+                   'granularity': granularity, 'bucket': bucket},
+                  {'$inc': {'count': count}}, upsert=True)
+        for (scope, scope_id, granularity, bucket), count
+        in _increments(scopes, timestamps).items()
+    ]
+
+    if operations:
+        ActivityRollup._get_collection().bulk_write(operations, ordered=False)
+
+# --------------------------------------------------------------------------- #
+# Querying                                                                    #
+# --------------------------------------------------------------------------- #
+
+def series(scope, scope_id, start, end, bucket_seconds=86400):
+    """
+    Record counts for a channel, collector or topic from start to end, in
+    buckets of bucket_seconds (a whole number of hours) aligned to the epoch.
+    Returns a list of (bucket_start, count), including empty buckets. Reads
+    one rollup per hour or day in the range, however much data it holds.
+    """
+    granularity = granularity_for(bucket_seconds)
+    first = _align(start, bucket_seconds)
+
+    rollups = ActivityRollup.objects(
+        scope=scope, scope_id=scope_id, granularity=granularity,
+        bucket__gte=first, bucket__lt=end
+    ).only('bucket', 'count').as_pymongo()
+
+    counts = defaultdict(int)
+    for rollup in rollups:
+        counts[_align(rollup['bucket'], bucket_seconds)] += rollup['count']
+
+    buckets = []
+    bucket = first
+    step = datetime.timedelta(seconds=bucket_seconds)
+    while bucket < end:
+        buckets.append((bucket, counts[bucket]))
+        bucket += step
+    return buckets
+
+
+def _align(timestamp, bucket_seconds):
+    offset = (timestamp - EPOCH).total_seconds()
+    return EPOCH + datetime.timedelta(
+        seconds=offset - offset % bucket_seconds)
+
+# --------------------------------------------------------------------------- #
+# Backfill                                                                    #
+# --------------------------------------------------------------------------- #
+
+def backfill(batch_size=1000):
+    """
+    Rebuild every rollup from the stored data, with one aggregation over
+    CollectionData counting records per channel per hour. Daily, collector
+    and topic rollups are summed from those, using each channel's current
+    topics. Counts are overwritten rather than incremented and rollups with
+    no data left are removed, so it is safe to re-run; data stored while it
+    runs may be miscounted until it is re-run.
+    """
+    channels = {
+        channel['_id']: channel for channel in
+        DataChannel.objects.only('id', 'collector', 'topics').as_pymongo()
+    }
+
+    pipeline = [
+        {'$match': CollectionData.objects()._query},
+        {'$group': {
+            '_id': {
+                'channel': '$channel',
+                'year': {'$year': '$timestamp'},
+                'month': {'$month': '$timestamp'},
+                'day': {'$dayOfMonth': '$timestamp'},
+                'hour': {'$hour': '$timestamp'},
+            },
+            'count': {'$sum': 1},
+        }},
+    ]
+    hourly = (group for collection in storage.data_collections()
+              for group in collection.aggregate(pipeline, allowDiskUse=True))
+
+    totals = Counter()
+    for group in hourly:
+        key = group['_id']
+        channel = channels.get(key['channel'])
+        if channel is None:
+            continue
+
+        hour = datetime.datetime(key['year'], key['month'], key['day'],
+                                 key['hour'])
+        scopes = [(SCOPE_CHANNEL, channel['_id']),
+                  (SCOPE_COLLECTOR, channel['collector'])]
+        scopes += [(SCOPE_TOPIC, topic) for topic in channel.get('topics', [])]
+
+        for granularity in GRANULARITY_SECONDS:
+            bucket = bucket_start(hour, granularity)
+            for scope, scope_id in scopes:
+                totals[(scope, scope_id, granularity, bucket)] += group['count']
+
+    logging.info(f"Writing {len(totals)} rollups")
+
+    collection = ActivityRollup._get_collection()
+    operations = []
+    for (scope, scope_id, granularity, bucket), count in totals.items():
+        operations.append(UpdateOne(
+            {'scope': scope, 'scope_id': scope_id,
+             'granularity': granularity, 'bucket': bucket},
+            {'$set': {'count': count}}, upsert=True))
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            operations = []
+
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+    # Remove rollups for data that no longer exists
+    stale = [
+        rollup['_id'] for rollup in
+        collection.find({}, {'scope': 1, 'scope_id': 1, 'granularity': 1,
+                             'bucket': 1})
+        if (rollup['scope'], rollup['scope_id'], rollup['granularity'],
+            rollup['bucket']) not in totals
+    ]
+    for i in range(0, len(stale), batch_size):
+        collection.delete_many({'_id': {'$in': stale[i:i + batch_size]}})
+
+    return len(totals)
+
+# --------------------------------------------------------------------------- #
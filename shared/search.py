@@ -0,0 +1,352 @@
+from shared.models import (
+    AnalysisResult,
+    CollectionData,
+    to_uuid,
+)
+from shared import storage
+import atexit
+import calendar
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+# --------------------------------------------------------------------------- #
+
+SEARCH_PATH = os.environ.get('SEARCH_PATH', '/data/search/search.db')
+
+KIND_DATA   = "data"
+KIND_RESULT = "result"
+
+# Counting every match of a common term is as slow as ranking them, so
+# counts stop here and the UI shows "10000+"
+COUNT_LIMIT = 10000
+
+# Documents waiting to be indexed before new ones are dropped, and the most
+# added in one transaction
+INDEX_QUEUE_SIZE = 10000
+INDEX_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    rowid INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    uuid TEXT NOT NULL UNIQUE,
+    channel TEXT,
+    timestamp INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_filter
+    ON documents (kind, channel, timestamp);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    text,
+    content='',
+    tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+# --------------------------------------------------------------------------- #
+
+class SearchError(Exception):
+    pass
+
+# --------------------------------------------------------------------------- #
+# Search Index                                                                #
+# --------------------------------------------------------------------------- #
+
+class SearchIndex:
+    """
+    Full-text index of collected data and analysis results, in an SQLite
+    FTS5 database on local disk. The text itself isn't stored (the FTS table
+    is contentless), only the tokens, along with each document's kind, UUID,
+    channel and timestamp for filtering. Matches are ranked by BM25.
+
+    Runs in WAL mode so the frontend can search while workers index, and
+    keeps one connection per thread.
+    """
+    def __init__(self, path=SEARCH_PATH):
+        self.path = path
+        self.local = threading.local()
+
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self.local.db = db
+        return db
+
+
+    def add(self, documents):
+        """
+        Index documents given as (kind, uuid, channel, timestamp, text)
+        tuples, in one transaction. Documents already indexed are skipped.
+        """
+        with self.db as db:
+            for kind, uuid, channel, timestamp, text in documents:
+                if not text or not isinstance(text, str):
+                    continue
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO documents "
+                    "(kind, uuid, channel, timestamp) VALUES (?, ?, ?, ?)",
+                    (kind, str(uuid), channel and str(channel),
+                     calendar.timegm(timestamp.utctimetuple())))
+                if cursor.rowcount:
+                    db.execute("INSERT INTO documents_fts (rowid, text) "
+                               "VALUES (?, ?)", (cursor.lastrowid, text))
+
+
+    def search(self, query, kind=None, channels=None, since=None, until=None,
+               limit=20, offset=0):
+        """
+        Search with FTS5 query syntax: words, "phrases", AND/OR/NOT, prefix*
+        and NEAR(). Optionally filtered to a kind, a list of channel IDs and
+        a date range. Returns the total number of matches (up to
+        COUNT_LIMIT + 1) and a page of (kind, uuid) pairs, best first.
+        """
+        conditions = ["documents_fts MATCH ?"]
+        params = [query]
+
+        if kind:
+            conditions.append("documents.kind = ?")
+            params.append(kind)
+        if channels is not None:
+            if not channels:
+                return 0, []
+            conditions.append("documents.channel IN (%s)" %
+                              ", ".join("?" * len(channels)))
+            params += [str(channel) for channel in channels]
+        if since:
+            conditions.append("documents.timestamp >= ?")
+            params.append(calendar.timegm(since.utctimetuple()))
+        if until:
+            conditions.append("documents.timestamp < ?")
+            params.append(calendar.timegm(until.utctimetuple()))
+
+        matches = ("FROM documents_fts JOIN documents "
+                   "ON documents.rowid = documents_fts.rowid "
+                   "WHERE " + " AND ".join(conditions))
+
+        try:
+            total = self.db.execute(
+                f"SELECT COUNT(*) FROM (SELECT 1 {matches} LIMIT ?)",
+                params + [COUNT_LIMIT + 1]).fetchone()[0]
+            rows = self.db.execute(
+                f"SELECT documents.kind, documents.uuid {matches} "
+                f"ORDER BY documents_fts.rank LIMIT ? OFFSET ?",
+                params + [limit, offset]).fetchall()
+        except sqlite3.OperationalError as err:
+            raise SearchError(f"Invalid search query: {err}")
+
+        return total, rows
+
+
+    def clear(self):
+        with self.db as db:
+            db.execute("DELETE FROM documents")
+            # Contentless tables can't be deleted from row by row
+            db.execute("INSERT INTO documents_fts (documents_fts) "
+                       "VALUES ('delete-all')")
+
+# --------------------------------------------------------------------------- #
+
+class SearchQuery:
+    """
+    A search, with the count(), skip() and limit() of a queryset so it can be
+    paginated like one. Iterating yields the page of (kind, uuid) matches.
+    """
+    def __init__(self, query, **filters):
+        self.query = query
+        self.filters = filters
+        self._skip = 0
+        self._limit = 20
+        self._total = None
+
+
+    def count(self):
+        if self._total is None:
+            self._total, _ = index.search(self.query, limit=0, **self.filters)
+        return self._total
+
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+
+    def __iter__(self):
+        _, rows = index.search(self.query, limit=self._limit,
+                               offset=self._skip, **self.filters)
+        return iter(rows)
+
+# --------------------------------------------------------------------------- #
+
+class BackgroundIndexer:
+    """
+    Adds documents to a SearchIndex from a background thread, so workers
+    never wait on SQLite, or on its lock while another process writes.
+    Documents are queued and added in batches as they arrive. If the queue
+    fills up, new documents are dropped and logged.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.queue = queue.Queue(maxsize=INDEX_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+    def submit(self, documents):
+        """
+        Queue (kind, uuid, channel, timestamp, text) tuples to be indexed.
+        Never blocks.
+        """
+        self._start()
+        dropped = 0
+        for document in documents:
+            try:
+                self.queue.put_nowait(document)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            logging.error(f"Search index queue full, dropped {dropped} "
+                          f"documents")
+
+
+    def flush(self):
+        """
+        Wait until every queued document has been indexed.
+        """
+        self.queue.join()
+
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name="search-indexer",
+                                               daemon=True)
+                self.thread.start()
+                # Index what's still queued when the worker exits
+                atexit.register(self.flush)
+
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < INDEX_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.index.add(batch)
+            except sqlite3.Error as err:
+                logging.error(f"Failed to index {len(batch)} documents: {err}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+# --------------------------------------------------------------------------- #
+
+index = SearchIndex()
+indexer = BackgroundIndexer(index)
+
+# --------------------------------------------------------------------------- #
+# Indexing                                                                    #
+# --------------------------------------------------------------------------- #
+
+def data_document(record):
+    return (KIND_DATA, record.uuid, record.channel.id, record.timestamp,
+            record.friendly_text)
+
+
+def result_document(result, channel_id):
+    return (KIND_RESULT, result.uuid, channel_id, result.timestamp,
+            (result.payload or {}).get('result'))
+
+
+def index_data(records):
+    """
+    Queue newly stored CollectionData for indexing in the background.
+    Indexing failures are logged rather than raised, so search never holds
+    up collection; 'manage.py rebuild-search' fills any gaps.
+    """
+    indexer.submit([data_document(record) for record in records])
+
+
+def index_result(result, record):
+    """
+    Queue a new AnalysisResult for indexing under the channel of the record
+    it was produced from, as for index_data().
+    """
+    indexer.submit([result_document(result,
+                                    storage.reference_id(record, 'channel'))])
+
+
+def rebuild(batch_size=5000):
+    """
+    Rebuild the index from scratch from every CollectionData and
+    AnalysisResult. Archived records are indexed by their preview only.
+    """
+    index.clear()
+    count = 0
+
+    query = CollectionData.objects()._query
+    fields = {'uuid': 1, 'channel': 1, 'timestamp': 1, 'friendly_text': 1}
+    for collection in storage.data_collections():
+        batch = []
+        for document in collection.find(query, fields):
+            batch.append((KIND_DATA, to_uuid(document['uuid']),
+                          document['channel'],
+                          document['timestamp'],
+                          document.get('friendly_text')))
+            if len(batch) >= batch_size:
+                index.add(batch)
+                count += len(batch)
+                batch = []
+        index.add(batch)
+        count += len(batch)
+        logging.info(f"Indexed {count} records")
+
+    results = AnalysisResult.objects.only('uuid', 'timestamp', 'payload',
+                                          'origin_data')
+    batch = []
+    for document in results.as_pymongo().batch_size(batch_size):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            count += _index_result_batch(batch)
+            batch = []
+    count += _index_result_batch(batch)
+
+    logging.info(f"Indexed {count} records and results")
+    return count
+
+
+def _index_result_batch(documents):
+    origin_ids = [document['origin_data'] for document in documents
+                  if document.get('origin_data')]
+    channels = {}
+    for collection in storage.data_collections():
+        for record in collection.find({'_id': {'$in': origin_ids}},
+                                      {'channel': 1}):
+            channels[record['_id']] = record['channel']
+    index.add([
+        (KIND_RESULT, to_uuid(document['uuid']),
+         channels.get(document.get('origin_data')),
+         document['timestamp'], (document.get('payload') or {}).get('result'))
+        for document in documents
+    ])
+    return len(documents)
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,360 @@
+from bson import ObjectId
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import numpy as np
+
+# --------------------------------------------------------------------------- #
+
+SIMILARITY_PATH = os.environ.get('SIMILARITY_PATH', '/data/similarity')
+
+ID_BYTES = 12
+
+# Below this many vectors a brute-force scan is fast enough, and clustering
+# would give poor lists
+IVF_MIN_VECTORS = 20000
+# Retrain once this fraction of the vectors isn't covered by the index
+IVF_RETRAIN_FRACTION = 0.2
+IVF_SAMPLE_SIZE = 50000
+IVF_ITERATIONS = 10
+IVF_NPROBE = 16
+
+# --------------------------------------------------------------------------- #
+# Embedders                                                                   #
+# --------------------------------------------------------------------------- #
+
+class Embedder:
+    """
+    Turns texts into unit-length float32 vectors, as an (n, dimensions)
+    array. The name identifies the embedding space, so vectors from
+    different embedders are never mixed in one store.
+    """
+    name = None
+    dimensions = None
+
+    def embed(self, texts):
+        raise NotImplementedError("Subclasses must implement this method")
+
+# --------------------------------------------------------------------------- #
+
+class HashingEmbedder(Embedder):
+    """
+    A deterministic, dependency-free stand-in for a real embedding model:
+    words and character trigrams are hashed into a fixed number of signed
+    buckets. Captures shared vocabulary and spelling, not meaning, so it is
+    for tests and development rather than cross-language similarity.
+    """
+    TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+        self.name = f"hashing-{dimensions}"
+
+
+    def _features(self, text):
+        words = self.TOKEN_PATTERN.findall(text.lower())
+        for word in words:
+            yield word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text or ""):
+                digest = hashlib.blake2b(feature.encode(), digest_size=8)
+                value = int.from_bytes(digest.digest(), 'little')
+                sign = 1.0 if value & 1 else -1.0
+                vectors[row, (value >> 1) % self.dimensions] += sign * weight
+        return normalise(vectors)
+
+# --------------------------------------------------------------------------- #
+
+def normalise(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+# --------------------------------------------------------------------------- #
+# Vector Store                                                                #
+# --------------------------------------------------------------------------- #
+
+class VectorStore:
+    """
+    Append-only store of unit vectors for CollectionData records, as flat
+    float16 and ObjectId files that are memory-mapped for reading. Written
+    by a single embedding worker and read by any number of processes, which
+    pick up new rows as the files grow. An IVF index over the vectors
+    (ivf.npz) is rebuilt in the background as the store grows; rows added
+    since are searched by brute force.
+
+    A write interrupted between the two files leaves one longer than the
+    other. Readers ignore the extra bytes, and the writer truncates them
+    away before appending, so the files always stay row-aligned.
+    """
+    def __init__(self, path=SIMILARITY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.meta = self._read_meta()
+        self._vectors = None
+        self._ids = None
+        # The row of each record ID, for the first _indexed rows
+        self._rows = {}
+        self._indexed = 0
+        self._ivf = None
+        self._ivf_mtime = None
+
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+
+    def _read_meta(self):
+        try:
+            with open(self._file('meta.json')) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+
+    @property
+    def dimensions(self):
+        return self.meta['dimensions'] if self.meta else None
+
+
+    def create(self, embedder):
+        """
+        Prepare the store for the embedder's vectors, or check that an
+        existing store holds vectors from the same embedder.
+        """
+        if self.meta:
+            if self.meta['embedder'] != embedder.name:
+                raise ValueError(f"'{self.path}' holds vectors from "
+                                 f"'{self.meta['embedder']}', not "
+                                 f"'{embedder.name}'; move it aside to "
+                                 f"re-embed")
+            self._truncate()
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        self.meta = {'embedder': embedder.name,
+                     'dimensions': embedder.dimensions}
+        with open(self._file('meta.json'), 'w') as file:
+            json.dump(self.meta, file)
+
+    # ----------------------------------------------------------------------- #
+
+    def __len__(self):
+        # Readers may start before the embedding worker creates the store
+        if not self.meta:
+            self.meta = self._read_meta()
+        if not self.meta:
+            return 0
+        try:
+            vectors = os.path.getsize(self._file('vectors.f16'))
+            ids = os.path.getsize(self._file('ids.bin'))
+        except FileNotFoundError:
+            return 0
+        # The IDs are written after the vectors, so a row only counts once
+        # both are there
+        return min(vectors // (self.dimensions * 2), ids // ID_BYTES)
+
+
+    def _maps(self):
+        """
+        Memory maps of the vectors and IDs, remapped when the store grows.
+        """
+        count = len(self)
+        with self.lock:
+            if self._vectors is None or len(self._vectors) != count:
+                if count == 0:
+                    return None, None
+                self._vectors = np.memmap(self._file('vectors.f16'),
+                                          dtype=np.float16, mode='r',
+                                          shape=(count, self.dimensions))
+                self._ids = np.memmap(self._file('ids.bin'),
+                                      dtype=f'S{ID_BYTES}', mode='r',
+                                      shape=(count,))
+                # Only the new rows are added, so this grows with the store
+                # rather than being rebuilt
+                for row in range(self._indexed, count):
+                    # Trailing zero bytes are stripped from S dtypes
+                    record_id = bytes(self._ids[row]).ljust(ID_BYTES, b"\0")
+                    self._rows.setdefault(record_id, row)
+                self._indexed = count
+            return self._vectors, self._ids
+
+
+    def _truncate(self):
+        """
+        Cut both files back to the rows that are complete in each.
+        """
+        count = len(self)
+        for name, row_size in [('vectors.f16', self.dimensions * 2),
+                               ('ids.bin', ID_BYTES)]:
+            try:
+                with open(self._file(name), 'r+b') as file:
+                    file.truncate(count * row_size)
+            except FileNotFoundError:
+                pass
+
+
+    def append(self, record_ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float16)
+        self._truncate()
+        with open(self._file('vectors.f16'), 'ab') as file:
+            file.write(vectors.tobytes())
+        with open(self._file('ids.bin'), 'ab') as file:
+            file.write(b"".join(record_id.binary for record_id in record_ids))
+
+
+    def contains(self, record_ids):
+        """
+        Which of the given record IDs already have a vector, as a set.
+        """
+        self._maps()
+        return {record_id for record_id in record_ids
+                if record_id.binary in self._rows}
+
+
+    def row_of(self, record_id):
+        self._maps()
+        return self._rows.get(record_id.binary)
+
+    # ----------------------------------------------------------------------- #
+
+    def _load_ivf(self):
+        try:
+            mtime = os.path.getmtime(self._file('ivf.npz'))
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if mtime != self._ivf_mtime:
+                with np.load(self._file('ivf.npz')) as ivf:
+                    self._ivf = {key: ivf[key] for key in ivf.files}
+                self._ivf_mtime = mtime
+            return self._ivf
+
+
+    def needs_training(self):
+        count = len(self)
+        if count < IVF_MIN_VECTORS:
+            return False
+        ivf = self._load_ivf()
+        indexed = int(ivf['count']) if ivf else 0
+        return count - indexed > count * IVF_RETRAIN_FRACTION
+
+
+    def train(self, seed=0):
+        """
+        Build the IVF index: k-means clusters over a sample of the vectors,
+        then every vector listed under its nearest cluster. Written to a
+        temporary file and swapped in, so readers keep using the old index
+        until it is done.
+        """
+        vectors, _ = self._maps()
+        count = len(vectors)
+        lists = int(min(4096, max(16, math.sqrt(count)), count))
+        random = np.random.default_rng(seed)
+
+        sample = vectors[np.sort(random.choice(
+            count, min(count, IVF_SAMPLE_SIZE), replace=False))]
+        sample = sample.astype(np.float32)
+        centroids = sample[random.choice(len(sample), lists, replace=False)]
+
+        for _ in range(IVF_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(lists):
+                members = sample[assignments == cluster]
+                if len(members):
+                    centroids[cluster] = members.mean(axis=0)
+            centroids = normalise(centroids)
+
+        assignments = np.empty(count, dtype=np.int32)
+        for start in range(0, count, 100000):
+            chunk = vectors[start:start + 100000].astype(np.float32)
+            assignments[start:start + len(chunk)] = np.argmax(
+                chunk @ centroids.T, axis=1)
+
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assignments[order], np.arange(lists + 1))
+
+        tmp_path = self._file('ivf.tmp.npz')
+        np.savez(tmp_path, centroids=centroids, order=order, offsets=offsets,
+                 count=np.array(count))
+        os.replace(tmp_path, self._file('ivf.npz'))
+        logging.info(f"Trained IVF index of {lists} lists over {count} "
+                     f"vectors")
+
+    # ----------------------------------------------------------------------- #
+
+    def _candidates(self, query, count):
+        """
+        Rows worth scoring for a query: those in the nearest IVF lists plus
+        any added since the index was built, or every row without an index.
+        """
+        ivf = self._load_ivf()
+        if ivf is None:
+            return None
+
+        nearest = np.argsort(ivf['centroids'] @ query)[::-1][:IVF_NPROBE]
+        offsets = ivf['offsets']
+        rows = [ivf['order'][offsets[cluster]:offsets[cluster + 1]]
+                for cluster in nearest]
+        rows.append(np.arange(int(ivf['count']), count))
+        return np.sort(np.concatenate(rows))
+
+
+    def search(self, query, k=10, exclude=None):
+        """
+        The k rows most similar to a query vector, as (record ID, score)
+        pairs, best first.
+        """
+        vectors, ids = self._maps()
+        if vectors is None:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+
+        rows = self._candidates(query, len(vectors))
+        if rows is None:
+            scores = np.concatenate([
+                vectors[start:start + 100000].astype(np.float32) @ query
+                for start in range(0, len(vectors), 100000)
+            ])
+            rows = np.arange(len(vectors))
+        else:
+            scores = vectors[rows].astype(np.float32) @ query
+
+        if exclude is not None:
+            scores[rows == exclude] = -np.inf
+
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k] if k else []
+        best = sorted(best, key=lambda i: -scores[i])
+        return [(ObjectId(bytes(ids[rows[i]]).ljust(ID_BYTES, b"\0")),
+                 float(scores[i]))
+                for i in best if np.isfinite(scores[i])]
+
+
+    def similar_to(self, record_id, k=10):
+        """
+        The k records most similar to a stored record, by cosine similarity.
+        Empty if the record hasn't been embedded.
+        """
+        row = self.row_of(record_id)
+        if row is None:
+            return []
+        vectors, _ = self._maps()
+        return self.search(vectors[row].astype(np.float32), k, exclude=row)
+
+# --------------------------------------------------------------------------- #
+
+store = VectorStore()
+
+# --------------------------------------------------------------------------- #
@@ -0,0 +1,387 @@
+from shared.models import (
+    CollectionData,
+    STORAGE_LAYOUT,
+    LAYOUT_SHARED,
+    LAYOUT_PARTITIONED,
+)
+from mongoengine.queryset import transform
+from pymongo.errors import BulkWriteError
+from collections import defaultdict
+import datetime
+import logging
+import os
+import re
+
+# --------------------------------------------------------------------------- #
+
+# In the partitioned layout, CollectionData from the current month and the
+# STORAGE_HOT_MONTHS - 1 before it stays in the 'hot' collection_data
+# collection, which all new data is written to. Older data is rolled over
+# into a collection per month, named collection_data_YYYY_MM.
+HOT_MONTHS = int(os.environ.get('STORAGE_HOT_MONTHS', 2))
+
+PARTITION_PREFIX = "collection_data_"
+PARTITION_PATTERN = re.compile(r'^collection_data_\d{4}_\d{2}$')
+
+NEWEST_FIRST = [('timestamp', -1), ('_id', -1)]
+
+# --------------------------------------------------------------------------- #
+# Collections                                                                 #
+# --------------------------------------------------------------------------- #
+
+def is_partitioned():
+    return STORAGE_LAYOUT == LAYOUT_PARTITIONED
+
+
+def partition_name(timestamp):
+    return f"{PARTITION_PREFIX}{timestamp.year:04d}_{timestamp.month:02d}"
+
+
+def partition_names():
+    """
+    Names of the monthly partitions that exist, newest first.
+    """
+    names = CollectionData._get_db().list_collection_names(
+        filter={'name': {'$regex': PARTITION_PATTERN.pattern}})
+    return sorted(names, reverse=True)
+
+
+def data_collections():
+    """
+    Every pymongo collection holding CollectionData: the hot collection,
+    then any partitions newest first.
+    """
+    collections = [CollectionData._get_collection()]
+    if is_partitioned():
+        db = CollectionData._get_db()
+        collections += [db[name] for name in partition_names()]
+    return collections
+
+
+def estimated_count(model=CollectionData):
+    """
+    Roughly how many records of a StoredData model are stored, from the
+    collection metadata rather than a count. None in the shared layout,
+    where one collection holds both models.
+    """
+    if STORAGE_LAYOUT == LAYOUT_SHARED:
+        return None
+    if model is CollectionData:
+        collections = data_collections()
+    else:
+        collections = [model._get_collection()]
+    return sum(collection.estimated_document_count()
+               for collection in collections)
+
+# --------------------------------------------------------------------------- #
+# Queries                                                                     #
+# --------------------------------------------------------------------------- #
+
+class DataQuery:
+    """
+    A stand-in for a CollectionData queryset ordered newest first, reading
+    across the hot collection and every partition. Supports what the pages
+    need: count(), skip(), limit(), filter(), order_by(), only(),
+    as_pymongo(), first() and iteration. Partitions that are skipped over
+    entirely are only counted, not read.
+
+    Results are newest first within each collection, and collections are
+    read newest first, so old data imported into the hot collection is
+    listed ahead of the partitions until the next rollover. An explicit
+    order_by() orders across collections instead.
+    """
+    def __init__(self, **filters):
+        self.query = CollectionData.objects(**filters)._query
+        self._skip = 0
+        self._limit = None
+        self._fields = None
+        self._raw = False
+        self._sort = None
+
+
+    def skip(self, count):
+        self._skip = count
+        return self
+
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+
+    def filter(self, **filters):
+        self.query = {'$and': [self.query,
+                               CollectionData.objects(**filters)._query]}
+        return self
+
+
+    def order_by(self, *keys):
+        """
+        Order by mongoengine-style keys (e.g. '-timestamp', '-id'), all in
+        the same direction, across every collection: the first limit()
+        records of each are read in order and merged. For keyset paging,
+        so skip() isn't supported with it.
+        """
+        self._sort = [
+            (CollectionData._fields[key.lstrip('-+')].db_field,
+             -1 if key.startswith('-') else 1)
+            for key in keys
+        ]
+        return self
+
+
+    def only(self, *fields):
+        self._fields = {CollectionData._fields[field].db_field: 1
+                        for field in fields}
+        return self
+
+
+    def as_pymongo(self):
+        self._raw = True
+        return self
+
+
+    def count(self):
+        return sum(collection.count_documents(self.query)
+                   for collection in data_collections())
+
+
+    def first(self):
+        for collection in data_collections():
+            document = collection.find_one(self.query, sort=NEWEST_FIRST)
+            if document:
+                return CollectionData._from_son(document)
+        return None
+
+
+    def _merged(self):
+        documents = []
+        for collection in data_collections():
+            cursor = collection.find(self.query, self._fields).sort(self._sort)
+            if self._limit is not None:
+                cursor = cursor.limit(self._limit)
+            documents += list(cursor)
+
+        documents.sort(key=lambda document: [document.get(field)
+                                             for field, _ in self._sort],
+                       reverse=self._sort[0][1] == -1)
+        return documents[:self._limit]
+
+
+    def __iter__(self):
+        if self._sort:
+            for document in self._merged():
+                yield (document if self._raw
+                       else CollectionData._from_son(document))
+            return
+
+        skip = self._skip
+        remaining = self._limit
+
+        for collection in data_collections():
+            if remaining is not None and remaining <= 0:
+                return
+
+            if skip:
+                count = collection.count_documents(self.query)
+                if skip >= count:
+                    skip -= count
+                    continue
+
+            cursor = collection.find(self.query, self._fields)
+            cursor = cursor.sort(NEWEST_FIRST).skip(skip)
+            skip = 0
+            if remaining is not None:
+                cursor = cursor.limit(remaining)
+
+            for document in cursor:
+                if remaining is not None:
+                    remaining -= 1
+                yield (document if self._raw
+                       else CollectionData._from_son(document))
+
+
+    def __bool__(self):
+        return next(iter(self), None) is not None
+
+# --------------------------------------------------------------------------- #
+
+def reference_id(document, field):
+    """
+    The ID a document's reference field points at, without dereferencing it
+    (which would look in the wrong collection for partitioned data).
+    """
+    value = document._data.get(field)
+    return getattr(value, 'id', value)
+
+
+def data_query(**filters):
+    """
+    CollectionData matching the filters, newest first, from wherever the
+    storage layout keeps it. A plain queryset unless partitioned.
+    """
+    if is_partitioned():
+        return DataQuery(**filters)
+    return CollectionData.objects(**filters).order_by('-timestamp')
+
+
+def get_data(**filters):
+    """
+    The first CollectionData matching the filters, looking in the hot
+    collection before the partitions. For lookups by unique fields.
+    """
+    if not is_partitioned():
+        return CollectionData.objects(**filters).first()
+
+    query = CollectionData.objects(**filters)._query
+    for collection in data_collections():
+        document = collection.find_one(query)
+        if document:
+            return CollectionData._from_son(document)
+    return None
+
+
+def get_data_by_ids(record_ids):
+    """
+    The CollectionData with the given IDs, in the same order, skipping any
+    that don't exist.
+    """
+    remaining = set(record_ids)
+    by_id = {}
+
+    for collection in data_collections():
+        if not remaining:
+            break
+        for document in collection.find({'_id': {'$in': list(remaining)}}):
+            by_id[document['_id']] = CollectionData._from_son(document)
+            remaining.discard(document['_id'])
+
+    return [by_id[record_id] for record_id in record_ids
+            if record_id in by_id]
+
+
+def update_data(record_uuid, **update):
+    """
+    Apply a mongoengine-style update (e.g. set__payload__media=...) to the
+    CollectionData with the given UUID, wherever it is stored. Returns True
+    if the record was found.
+    """
+    query = CollectionData.objects(uuid=record_uuid)._query
+    update = transform.update(CollectionData, **update)
+    for collection in data_collections():
+        if collection.update_one(query, update).matched_count:
+            return True
+    return False
+
+
+def archived_natural_keys(records):
+    """
+    Which of the records' natural keys are already stored for their channel
+    in a partition, as a set of (channel ID, natural key). The unique index
+    only covers each collection on its own, so collectors check the
+    partitions before inserting into the hot collection. Only records older
+    than hot_cutoff() can be in a partition, and only the one their timestamp
+    falls in, so recent records need no queries at all.
+    """
+    if not is_partitioned():
+        return set()
+
+    cutoff = hot_cutoff()
+    keys = defaultdict(lambda: defaultdict(set))
+    for record in records:
+        if (record.natural_key is None or record.timestamp is None
+                or record.timestamp >= cutoff):
+            continue
+        name = partition_name(record.timestamp)
+        keys[name][record.channel.id].add(record.natural_key)
+
+    db = CollectionData._get_db()
+    found = set()
+    for name, channel_keys in keys.items():
+        for channel_id, natural_keys in channel_keys.items():
+            found.update((channel_id, document['natural_key']) for document in
+                         db[name].find({'channel': channel_id,
+                                        'natural_key': {'$in':
+                                                        list(natural_keys)}},
+                                       {'natural_key': 1}))
+    return found
+
+# --------------------------------------------------------------------------- #
+# Partition Rollover                                                          #
+# --------------------------------------------------------------------------- #
+
+def hot_cutoff(now=None):
+    """
+    The start of the oldest month kept in the hot collection.
+    """
+    now = now or datetime.datetime.utcnow()
+    months = now.year * 12 + now.month - 1 - (HOT_MONTHS - 1)
+    return datetime.datetime(months // 12, months % 12 + 1, 1)
+
+
+def _ensure_partition(name):
+    """
+    Create a partition with the same indexes as the hot collection.
+    """
+    db = CollectionData._get_db()
+    if name in db.list_collection_names(filter={'name': name}):
+        return db[name]
+
+    partition = db[name]
+    indexes = CollectionData._get_collection().index_information()
+    for index_name, info in indexes.items():
+        if index_name == '_id_':
+            continue
+        options = {key: info[key] for key in
+                   ['unique', 'sparse', 'partialFilterExpression']
+                   if key in info}
+        partition.create_index(info['key'], name=index_name, **options)
+
+    logging.info(f"Created partition '{name}'")
+    return partition
+
+
+def rollover(batch_size=1000, now=None):
+    """
+    Move CollectionData older than the hot months from the hot collection
+    into its monthly partitions. Each batch is copied into the partitions
+    before being deleted from the hot collection, and records already copied
+    by an interrupted run are skipped, so it can run while collectors are
+    writing and be resumed. Returns the number of records moved.
+    """
+    if not is_partitioned():
+        raise ValueError("Rollover only applies to the partitioned layout")
+
+    hot = CollectionData._get_collection()
+    cutoff = hot_cutoff(now)
+    partitions = {}
+    moved = 0
+
+    while True:
+        batch = list(hot.find({'timestamp': {'$lt': cutoff}})
+                        .sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+
+        by_partition = defaultdict(list)
+        for document in batch:
+            by_partition[partition_name(document['timestamp'])].append(document)
+
+        for name, documents in by_partition.items():
+            if name not in partitions:
+                partitions[name] = _ensure_partition(name)
+            try:
+                partitions[name].insert_many(documents, ordered=False)
+            except BulkWriteError as err:
+                if any(error['code'] != 11000
+                       for error in err.details['writeErrors']):
+                    raise
+
+        hot.delete_many({'_id': {'$in': [document['_id']
+                                         for document in batch]}})
+        moved += len(batch)
+        logging.info(f"Rolled over {moved} records older than {cutoff}")
+
+    return moved
+
+# --------------------------------------------------------------------------- #